@@ -15,7 +15,10 @@ import logging
 import os
 import re
 import signal
+import sqlite3
 import sys
+import time
+from contextlib import contextmanager
 from importlib import util as importlib_util
 from datetime import timedelta
 from logging import handlers as logging_handlers  # type: ignore
@@ -29,12 +32,16 @@ import tornado.web
 from tornado.locks import Semaphore
 from tornado.log import enable_pretty_logging
 
-from typing import Sequence, Iterable, Type, List, Tuple, Any  # noqa: F401
+from typing import Sequence, Iterable, Type, Dict, List, Optional, Tuple, Any  # noqa: F401
 
 from apertium_apy import BYPASS_TOKEN, missing_freqs_db  # noqa: F401
 from apertium_apy import missingdb
 from apertium_apy import systemd
-from apertium_apy.mode_search import search_path, search_prefs
+from apertium_apy.autoscaler import Autoscaler, parse_pipe_limits
+from apertium_apy.mode_search import SearchIndex, search_path, search_prefs
+from apertium_apy.translation_memory import TranslationMemory
+from apertium_apy.utils import optional_import
+from apertium_apy.utils.paths import parse_pair_weights
 from apertium_apy.utils.wiki import wiki_login, wiki_get_token
 
 from apertium_apy.handlers import (
@@ -54,11 +61,13 @@ from apertium_apy.handlers import (
     SpellerHandler,
     StatsHandler,
     SuggestionHandler,
+    TranslateBatchHandler,
     TranslateChainHandler,
     TranslateDocHandler,
     TranslateHandler,
     PairPrefsHandler,
     TranslateRawHandler,
+    TranslateSocketHandler,
     TranslateWebpageHandler,
 )
 
@@ -74,10 +83,65 @@ def sig_handler(sig, frame):
             # we are one of the children
             missing_freqs_db.commit()
         missing_freqs_db.close_db()
+    if BaseHandler.translation_memory is not None:
+        BaseHandler.translation_memory.close_db()
     logging.warning('Caught signal: %s', sig)
     exit()
 
 
+class StartupProfile(object):
+    """How long each step of starting up took, logged once we're about
+    to serve so that slow start-ups show up in the logs."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []  # type: List[Tuple[str, float]]
+
+    @contextmanager
+    def phase(self, name):
+        before = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - before))
+
+    def report(self, background=()):
+        logging.info('Started up in %.2fs (%s)%s', time.time() - self.started,
+                     ', '.join('%s: %.2fs' % phase for phase in self.phases),
+                     '; in the background: ' + ', '.join(background) if background else '')
+
+
+startup = StartupProfile()
+
+
+def run_in_background(name, step):
+    """Whether step worked; for the handler's ready, see
+    BaseHandler.wait_until_ready."""
+    before = time.time()
+    try:
+        step()
+        logging.info('Background start-up step %s took %.2fs', name, time.time() - before)
+        return True
+    except Exception:
+        logging.exception('Background start-up step %s failed', name)
+        return False
+
+
+def load_fasttext_model(path):
+    IdentifyLangHandler.fasttext = optional_import('fasttext').FastText.load_model(path)
+
+
+def log_in_to_wiki(username, password):
+    logging.info('Logging into Apertium Wiki with username %s', username)
+    SuggestionHandler.wiki_session = optional_import('requests').Session()
+    SuggestionHandler.auth_token = wiki_login(
+        SuggestionHandler.wiki_session,
+        username,
+        password)
+    SuggestionHandler.wiki_edit_token = wiki_get_token(
+        SuggestionHandler.wiki_session, 'edit', 'info|revisions')
+
+
 class RootHandler(BaseHandler):
     def get(self):
         self.render('../index.html')
@@ -96,7 +160,10 @@ def setup_handler(
     pairs_path, nonpairs_path, lang_names, missing_freqs_path, timeout,
     max_pipes_per_pair, min_pipes_per_pair, max_users_per_pipe, max_idle_secs,
     restart_pipe_after, max_doc_pipes, verbosity=0, scale_mt_logs=False,
-    memory=1000, apy_keys=None,
+    memory=1000, apy_keys=None, max_inflight_per_pipe=1, native_formatters=False, pipe_size=0,
+    scatter_spawn_chars=0, pair_pipe_limits=None, restart_pipe_rss=0, restart_pipe_cpu=0,
+    translation_cache_size=0, segment_cache_size=0, translation_memory_path=None, pair_weights=None,
+    mode_index_path=None,
 ):
 
     global missing_freqs_db
@@ -109,45 +176,114 @@ def setup_handler(
     handler.max_pipes_per_pair = max_pipes_per_pair
     handler.min_pipes_per_pair = min_pipes_per_pair
     handler.max_users_per_pipe = max_users_per_pipe
+    handler.max_inflight_per_pipe = max_inflight_per_pipe
+    handler.native_formatters = native_formatters
+    handler.pipe_size = pipe_size
+    handler.scatter_spawn_chars = scatter_spawn_chars
+    handler.pair_pipe_limits = pair_pipe_limits or {}
+    handler.pair_weights = pair_weights or {}
     handler.max_idle_secs = max_idle_secs
     handler.restart_pipe_after = restart_pipe_after
+    handler.restart_pipe_rss = restart_pipe_rss * 1024 * 1024
+    handler.restart_pipe_cpu = restart_pipe_cpu
+    handler.result_cache.max_size = translation_cache_size * 1024 * 1024
+    handler.segment_cache_size = segment_cache_size * 1024 * 1024
     handler.scale_mt_logs = scale_mt_logs
     handler.verbosity = verbosity
     handler.doc_pipe_sem = Semaphore(max_doc_pipes)
     handler.api_keys_conf = apy_keys
 
-    modes = search_path(pairs_path, verbosity=verbosity)
+    handler.mode_search_paths = (pairs_path, nonpairs_path, mode_index_path)
+    with startup.phase('finding modes'):
+        found, handler.pairprefs = find_modes(pairs_path, nonpairs_path, verbosity, mode_index_path)
+    for kind, modes in found.items():
+        setattr(handler, kind, modes)
+
+    if translation_memory_path:
+        with startup.phase('translation memory'):
+            handler.translation_memory = TranslationMemory(translation_memory_path)
+            forget_outdated_translations(handler.translation_memory, handler.pairs)
+            # Each process connects on its own after forking:
+            handler.translation_memory.close_db()
+
+    # Paths between languages are only looked for when first asked for:
+    with startup.phase('mode indexes and pairs graph'):
+        handler.init_mode_indexes()
+        handler.init_pairs_graph()
+        handler.init_paths()
+
+
+def find_modes(pairs_path, nonpairs_path, verbosity=0, mode_index_path=None):
+    """The installed modes, as {kind: {code: mode}} for each of
+    BaseHandler.mode_kinds, and the pair preferences."""
+    index = SearchIndex(mode_index_path).load() if mode_index_path else None
+    modes = search_path(pairs_path, verbosity=verbosity, index=index)
     if nonpairs_path:
-        src_modes = search_path(nonpairs_path, include_pairs=False, verbosity=verbosity)
+        src_modes = search_path(nonpairs_path, include_pairs=False, verbosity=verbosity, index=index)
         for mtype in modes:
             modes[mtype] += src_modes[mtype]
-    handler.pairprefs = search_prefs(pairs_path)
+    pairprefs = search_prefs(pairs_path, index=index)
+    if index is not None:
+        index.save()
 
     for mtype in modes:
         logging.info('%d %s modes found', len(modes[mtype]), mtype)
 
+    found = {kind: {} for kind in BaseHandler.mode_kinds}  # type: Dict[str, Dict[str, Any]]
     for path, lang_src, lang_trg in modes['pair']:
-        handler.pairs['%s-%s' % (lang_src, lang_trg)] = path
+        found['pairs']['%s-%s' % (lang_src, lang_trg)] = path
     for dirpath, modename, lang_pair in modes['analyzer']:
-        handler.analyzers[lang_pair] = (dirpath, modename)
+        found['analyzers'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['generator']:
-        handler.generators[lang_pair] = (dirpath, modename)
+        found['generators'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['tagger']:
-        handler.taggers[lang_pair] = (dirpath, modename)
+        found['taggers'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_src in modes['spell']:
         if (any(lang_src == elem[2] for elem in modes['tokenise'])):
-            handler.spellers[lang_src] = (dirpath, modename)
+            found['spellers'][lang_src] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['guesser']:
-        handler.guessers[lang_pair] = (dirpath, modename)
+        found['guessers'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['bilsearch']:
-        handler.bilsearch[lang_pair] = (dirpath, modename)
+        found['bilsearch'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['billookup']:
-        handler.billookup[lang_pair] = (dirpath, modename)
+        found['billookup'][lang_pair] = (dirpath, modename)
     for dirpath, modename, lang_pair in modes['embeddings']:
-        handler.embeddings[lang_pair] = (dirpath, modename)
-
-    handler.init_pairs_graph()
-    handler.init_paths()
+        found['embeddings'][lang_pair] = (dirpath, modename)
+    return found, pairprefs
+
+
+def forget_outdated_translations(memory, pairs):
+    memory.forget_other_versions({pair: os.path.getmtime(path) for pair, path in pairs.items()})
+
+
+async def reload_modes():
+    """Pick up modes installed, upgraded or removed since start-up.
+    Looking for them can take a while, so requests are served
+    meanwhile, by the old modes."""
+    handler = TranslateHandler
+    pairs_path, nonpairs_path, mode_index_path = handler.mode_search_paths
+    loop = tornado.ioloop.IOLoop.current()
+    try:
+        found, pairprefs = await loop.run_in_executor(None, find_modes, pairs_path, nonpairs_path,
+                                                      handler.verbosity, mode_index_path)
+    except OSError as e:
+        logging.error('Could not reload modes, keeping the old ones: %s', e)
+        return
+    handler.replace_modes(found, pairprefs)
+    if handler.translation_memory is not None:
+        try:
+            await loop.run_in_executor(None, forget_outdated_translations, handler.translation_memory, dict(handler.pairs))
+        except (OSError, sqlite3.Error) as e:
+            logging.warning('Could not forget outdated translations: %s', e)
+
+
+def hup_handler(sig, frame):
+    if 'children' in frame.f_locals:
+        for child in frame.f_locals['children']:
+            os.kill(child, signal.SIGHUP)
+    else:
+        logging.warning('Caught signal: %s, reloading modes', sig)
+        tornado.ioloop.IOLoop.current().add_callback(reload_modes)
 
 
 def check_utf8():
@@ -222,10 +358,52 @@ def parse_args(cli_args=sys.argv[1:]):
     parser.add_argument('-u', '--max-users-per-pipe',
                         help='how many concurrent requests per pipeline before we consider spinning up a new one (default = 5)',
                         type=int, default=5)
+    parser.add_argument('-mi', '--max-inflight-per-pipe',
+                        help='how many chunks a pipeline may be translating at once; above 1, '
+                             'concurrent requests are multiplexed through the pipeline (default = 1)',
+                        type=int, default=1)
+    parser.add_argument('-ps', '--pipe-size',
+                        help='try to give pipelines pipes of this many bytes (capped by /proc/sys/fs/pipe-max-size), '
+                             'and send them chunks sized to fit (default = 0, use the system default)',
+                        type=int, default=0)
+    parser.add_argument('-sp', '--scatter-spawn-chars',
+                        help='requests of at least this many chars may start pipelines up to --max-pipes-per-pair '
+                             'to spread their chunks across (default = 0, only use pipelines already running)',
+                        type=int, default=0)
+    parser.add_argument('-pl', '--pair-pipe-limits',
+                        help='min:max pipelines for some pairs, overriding -i and -n, e.g. eng-spa=1:4,nob-nno=0:2',
+                        default=None)
+    parser.add_argument('-as', '--autoscale-interval',
+                        help='every this many seconds, start or stop pipelines by how long requests queue for them '
+                             '(default = 0, no autoscaling)', type=float, default=0)
     parser.add_argument('-m', '--max-idle-secs',
                         help='if specified, shut down pipelines that have not been used in this many seconds', type=int, default=0)
     parser.add_argument('-r', '--restart-pipe-after',
-                        help='restart a pipeline if it has had this many requests (default = 1000)', type=int, default=1000)
+                        help='restart a pipeline if it has had this many requests (default = 1000, 0 = never)',
+                        type=int, default=1000)
+    parser.add_argument('-rr', '--restart-pipe-rss',
+                        help='restart a pipeline if its processes use this many MB of resident memory in total '
+                             '(default = 0, no limit)', type=int, default=0)
+    parser.add_argument('-rc', '--restart-pipe-cpu',
+                        help='restart a pipeline if its processes have used this many secs of CPU time in total '
+                             '(default = 0, no limit)', type=float, default=0)
+    parser.add_argument('-tc', '--translation-cache-size',
+                        help='cache up to this many MB of /translate results, and let identical concurrent requests '
+                             'share one translation (default = 0, no caching)', type=int, default=0)
+    parser.add_argument('-sg', '--segment-cache-size',
+                        help='translate text and html sentence by sentence, each distinct sentence once per request, '
+                             'caching up to this many MB of sentences per pair (default = 0, translate in chunks)',
+                        type=int, default=0)
+    parser.add_argument('-tm', '--translation-memory',
+                        help='keep sentence translations in this SQLite database, shared by all processes and kept '
+                             'across restarts; implies translating sentence by sentence as with --segment-cache-size',
+                        default=None)
+    parser.add_argument('-cw', '--chain-weights',
+                        help='how much using a pair in /translateChain costs, e.g. eng-spa=2,spa-cat=0.5 (default = 1 per pair; '
+                             'with --autoscale-interval, slow pairs cost more)', default=None)
+    parser.add_argument('-mx', '--mode-index',
+                        help='remember the modes found in pairs_path and --nonpairs-path in this file, and on start-up '
+                             'only look through directories that changed since', default=None)
     parser.add_argument('-v', '--verbosity', help='logging verbosity', type=int, default=0)
     parser.add_argument('-V', '--version', help='show APY version', action='version', version='%(prog)s version ' + __version__)
     parser.add_argument('-S', '--scalemt-logs', help='generates ScaleMT-like logs; use with --log-path; disables', action='store_true')
@@ -240,6 +418,9 @@ def parse_args(cli_args=sys.argv[1:]):
     parser.add_argument('-rs', '--recaptcha-secret', help='ReCAPTCHA secret for suggestion validation', default=None)
     parser.add_argument('-md', '--max-doc-pipes',
                         help='how many concurrent document translation pipelines we allow (default = 3)', type=int, default=3)
+    parser.add_argument('-nf', '--native-formatters',
+                        help='deformat and reformat txt and html in-process instead of running apertium-des*/apertium-re*',
+                        action='store_true')
     parser.add_argument('-C', '--config', help='Configuration file to load options from', default=None)
     parser.add_argument('-ak', '--api-keys', help='Configuration file to load API keys', default=None)
 
@@ -265,14 +446,21 @@ def parse_args(cli_args=sys.argv[1:]):
     return args
 
 
-def setup_application(args):
+def setup_application(args, deferred=None):
+    """If deferred is a list, slow set-up that some handlers can do
+    without for a while is added to it as (name, handler class, step)
+    instead of being done here; see run_in_background."""
     if args.stat_period_max_age:
         BaseHandler.stat_period_max_age = timedelta(0, args.stat_period_max_age, 0)
 
     setup_handler(args.pairs_path, args.nonpairs_path, args.lang_names, args.missing_freqs, args.timeout,
                   args.max_pipes_per_pair, args.min_pipes_per_pair, args.max_users_per_pipe, args.max_idle_secs,
                   args.restart_pipe_after, args.max_doc_pipes, args.verbosity, args.scalemt_logs,
-                  args.unknown_memory_limit, args.api_keys)
+                  args.unknown_memory_limit, args.api_keys, args.max_inflight_per_pipe,
+                  args.native_formatters, args.pipe_size, args.scatter_spawn_chars,
+                  parse_pipe_limits(args.pair_pipe_limits or ''), args.restart_pipe_rss, args.restart_pipe_cpu,
+                  args.translation_cache_size, args.segment_cache_size, args.translation_memory,
+                  parse_pair_weights(args.chain_weights or ''), args.mode_index)
 
     handlers = [
         (r'/', RootHandler),
@@ -281,10 +469,12 @@ def setup_application(args):
         (r'/stats', StatsHandler),
         (r'/pairprefs', PairPrefsHandler),
         (r'/translate', TranslateHandler),
+        (r'/translateBatch', TranslateBatchHandler),
         (r'/translateChain', TranslateChainHandler),
         (r'/translateDoc', TranslateDocHandler),
         (r'/translatePage', TranslateWebpageHandler),
         (r'/translateRaw', TranslateRawHandler),
+        (r'/translateSocket', TranslateSocketHandler),
         (r'/analy[sz]e', AnalyzeHandler),
         (r'/guesser', GuesserHandler),
         (r'/generate', GenerateHandler),
@@ -302,25 +492,24 @@ def setup_application(args):
     if importlib_util.find_spec('streamparser'):
         handlers.append((r'/speller', SpellerHandler))
 
+    slow_steps = []  # type: List[Tuple[str, Type[BaseHandler], Any]]
     if all([args.wiki_username, args.wiki_password]) and importlib_util.find_spec('requests'):
-        import requests
-        logging.info('Logging into Apertium Wiki with username %s', args.wiki_username)
-
         SuggestionHandler.SUGGEST_URL = 'User:' + args.wiki_username
         SuggestionHandler.recaptcha_secret = args.recaptcha_secret
-        SuggestionHandler.wiki_session = requests.Session()
-        SuggestionHandler.auth_token = wiki_login(
-            SuggestionHandler.wiki_session,
-            args.wiki_username,
-            args.wiki_password)
-        SuggestionHandler.wiki_edit_token = wiki_get_token(
-            SuggestionHandler.wiki_session, 'edit', 'info|revisions')
-
+        slow_steps.append(('wiki login', SuggestionHandler,
+                           lambda: log_in_to_wiki(args.wiki_username, args.wiki_password)))
         handlers.append((r'/suggest', SuggestionHandler))
 
     if args.fasttext_model and importlib_util.find_spec('fasttext') is not None:
-        import fasttext
-        IdentifyLangHandler.fasttext = fasttext.FastText.load_model(args.fasttext_model)
+        slow_steps.append(('fastText model', IdentifyLangHandler,
+                           lambda: load_fasttext_model(args.fasttext_model)))
+
+    for name, handler, step in slow_steps:
+        if deferred is not None:
+            deferred.append((name, handler, step))
+        else:
+            with startup.phase(name):
+                step()
 
     # TODO: fix mypy. Application expects List but List is invariant and we use subclasses
     return tornado.web.Application(handlers)  # type:ignore
@@ -353,8 +542,9 @@ def setup_logging(args):
 
 def main():
     check_utf8()
-    args = parse_args()
-    setup_logging(args)  # before we start logging anything!
+    with startup.phase('reading options'):
+        args = parse_args()
+        setup_logging(args)  # before we start logging anything!
 
     if importlib_util.find_spec('fasttext') is None:
         logging.warning('Unable to import fastText, trying CLD2')
@@ -375,7 +565,10 @@ def main():
     if args.bypass_token:
         logging.info('reCaptcha bypass for testing: %s', BYPASS_TOKEN)
 
-    application = setup_application(args)
+    # Threads and forking don't mix, and with several processes the
+    # results are shared if we get them before forking:
+    deferred = [] if args.num_processes == 1 else None  # type: Optional[List[Tuple[str, Type[BaseHandler], Any]]]
+    application = setup_application(args, deferred)
 
     if args.ssl_cert and args.ssl_key:
         http_server = tornado.httpserver.HTTPServer(application, ssl_options={
@@ -389,16 +582,28 @@ def main():
 
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGHUP, hup_handler)
 
-    http_server.bind(args.port)
+    with startup.phase('binding port'):
+        http_server.bind(args.port)
+    startup.report([name for name, _, _ in deferred or []])
     http_server.start(args.num_processes)
 
     loop = tornado.ioloop.IOLoop.instance()
+    for name, handler, step in deferred or []:
+        handler.ready = loop.run_in_executor(None, run_in_background, name, step)
     wd = systemd.setup_watchdog()
     if wd is not None:
         wd.systemd_ready()
         logging.info('Initialised systemd watchdog, pinging every {}s'.format(1000 * wd.period))
         tornado.ioloop.PeriodicCallback(wd.watchdog_ping, 1000 * wd.period).start()
+    if args.autoscale_interval:
+        BaseHandler.autoscaler = Autoscaler(TranslateHandler, args.autoscale_interval)
+        tornado.ioloop.PeriodicCallback(BaseHandler.autoscaler.tick, 1000 * args.autoscale_interval).start()
+        tornado.ioloop.PeriodicCallback(BaseHandler.refresh_path_weights, 1000 * BaseHandler.path_index.refresh_secs).start()
+    if BaseHandler.translation_memory is not None:
+        tornado.ioloop.PeriodicCallback(BaseHandler.translation_memory.commit_in_background,
+                                        1000 * BaseHandler.translation_memory.commit_interval_secs).start()
     loop.start()
 
 
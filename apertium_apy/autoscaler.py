@@ -0,0 +1,171 @@
+"""Grow and shrink each pair's pool of pipelines with its load.
+
+Runs every --autoscale-interval seconds in each server process, next
+to the on-demand start-up in TranslateHandler.get_pipeline and the
+restarts in TranslateHandler.clean_pairs.
+"""
+
+import heapq
+import logging
+import weakref
+from time import time
+
+if False:
+    from typing import Dict, Tuple  # noqa: F401
+
+
+def parse_pipe_limits(spec):
+    """Parse e.g. 'eng-spa=1:4,nob-nno=0:2' into
+    {('eng', 'spa'): (1, 4), ('nob', 'nno'): (0, 2)}."""
+    limits = {}  # type: Dict[Tuple[str, str], Tuple[int, int]]
+    for item in filter(None, spec.split(',')):
+        try:
+            pair, min_max = item.strip().split('=')
+            l1, l2 = pair.split('-')
+            lo, hi = map(int, min_max.split(':'))
+        except ValueError:
+            raise ValueError('Expected pair=min:max, e.g. eng-spa=1:4, got %r' % item)
+        if not 0 <= lo <= hi or hi < 1:
+            raise ValueError('Need 0 ≤ min ≤ max and max ≥ 1, got %r' % item)
+        limits[(l1, l2)] = (lo, hi)
+    return limits
+
+
+class PairLoad:
+    """What the autoscaler has seen of one pair over recent ticks."""
+
+    def __init__(self):
+        self.queue = 0.0            # requests waiting to get into a pipeline
+        self.wait_secs = 0.0        # how long they had to wait, on average
+        self.chars_per_sec = 0.0
+        # The most a single pipeline has been seen to manage (decays slowly):
+        self.pipe_chars_per_sec = 0.0
+        # Chars translated and seconds the pipelines were busy doing it (both decaying slowly):
+        self.busy_chars = 0.0
+        self.busy_secs = 0.0
+        self.hot_ticks = 0
+        self.cold_ticks = 0
+        self.last_change = 0.0
+
+    def speed(self):
+        """Chars per second a pipeline translates while it has work,
+        unlike chars_per_sec, which is just how much traffic there is;
+        0 if we haven't seen it work yet."""
+        return self.busy_chars / self.busy_secs if self.busy_secs > 0 else 0.0
+
+    def to_json(self):
+        return {
+            'queue': round(self.queue, 2),
+            'waitSecs': round(self.wait_secs, 3),
+            'charsPerSec': round(self.chars_per_sec, 2),
+        }
+
+
+class Autoscaler:
+    # Start another pipeline when requests have waited this long on average …
+    max_wait_secs = 0.5
+    # … or when there are this many queued per pipeline,
+    max_queue_per_pipe = 2.0
+    # for this many ticks in a row:
+    up_ticks = 2
+    # Shut a pipeline down once the pair has been quiet for this many ticks in a row,
+    down_ticks = 30
+    # where quiet means nothing waiting, and traffic below this share
+    # of what the remaining pipelines can handle:
+    quiet_share = 0.5
+    # Leave a pair alone for this long after starting or stopping one of its pipelines:
+    cooldown_secs = 10.0
+    # Don't start more than this many pipelines per tick, over all pairs:
+    max_starts_per_tick = 2
+    # Weight of the newest tick in the moving averages:
+    smoothing = 0.5
+    # How much of pipe_chars_per_sec is kept each tick:
+    decay = 0.99
+
+    def __init__(self, handler, interval):
+        """handler is the TranslateHandler class, whose pipelines we manage."""
+        self.handler = handler
+        self.interval = interval
+        self.loads = {}  # type: Dict[Tuple[str, str], PairLoad]
+        # pipeline: (waited, wait_secs, chars, busy_time()) at the previous tick
+        self.seen = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+        self.last_tick = time()
+
+    def sample(self, pair, pipes, elapsed):
+        load = self.loads.setdefault(pair, PairLoad())
+        waited, wait_secs, chars, busy_secs = 0, 0.0, 0, 0.0
+        for p in pipes:
+            last = self.seen.get(p, (0, 0.0, 0, 0.0))
+            busy_time = p.busy_time()
+            waited += p.waited - last[0]
+            wait_secs += p.wait_secs - last[1]
+            chars += p.chars - last[2]
+            busy_secs += busy_time - last[3]
+            self.seen[p] = (p.waited, p.wait_secs, p.chars, busy_time)
+        a = self.smoothing
+        load.queue = a * sum(p.waiting for p in pipes) + (1 - a) * load.queue
+        load.wait_secs = a * (wait_secs / waited if waited else 0.0) + (1 - a) * load.wait_secs
+        load.chars_per_sec = a * chars / elapsed + (1 - a) * load.chars_per_sec
+        load.busy_chars = self.decay * load.busy_chars + chars
+        load.busy_secs = self.decay * load.busy_secs + busy_secs
+        if pipes:
+            load.pipe_chars_per_sec = max(load.chars_per_sec / len(pipes),
+                                          self.decay * load.pipe_chars_per_sec)
+        return load
+
+    def is_hot(self, load, n):
+        return (n > 0 and
+                (load.queue / n > self.max_queue_per_pipe or load.wait_secs > self.max_wait_secs))
+
+    def is_cold(self, load, n):
+        return (load.queue < 1 and
+                load.wait_secs < self.max_wait_secs / 4 and
+                load.chars_per_sec <= self.quiet_share * load.pipe_chars_per_sec * (n - 1))
+
+    def tick(self):
+        now = time()
+        elapsed = max(now - self.last_tick, 1e-3)
+        self.last_tick = now
+        starts = 0
+        pairs = set(self.handler.pipelines) | set(self.handler.pair_pipe_limits)
+        for pair in sorted(pairs, key=lambda pair: -self.loads.get(pair, PairLoad()).queue):
+            if '%s-%s' % pair not in self.handler.pairs:
+                continue
+            pipes = [p for p in self.handler.pipelines.get(pair, []) if not p.stuck]
+            load = self.sample(pair, pipes, elapsed)
+            n = len(pipes)
+            lo, hi = self.handler.pipe_limits(pair)
+            hot, cold = self.is_hot(load, n), self.is_cold(load, n)
+            load.hot_ticks = load.hot_ticks + 1 if hot else 0
+            load.cold_ticks = load.cold_ticks + 1 if cold else 0
+            cooling = now - load.last_change < self.cooldown_secs
+            if n < lo or (n < hi and not cooling and load.hot_ticks >= self.up_ticks):
+                if starts >= self.max_starts_per_tick:
+                    continue
+                logging.info('Autoscaler: %s-%s has %d pipes, queue %.1f, wait %.2fs; starting another',
+                             pair[0], pair[1], n, load.queue, load.wait_secs)
+                self.handler.start_pipe(pair)
+                starts += 1
+                load.last_change = now
+                load.hot_ticks = 0
+            elif n > lo and not cooling and load.cold_ticks >= self.down_ticks:
+                if self.stop_idle_pipe(pair):
+                    logging.info('Autoscaler: %s-%s has been quiet for %d ticks; stopped one of its %d pipes',
+                                 pair[0], pair[1], load.cold_ticks, n)
+                    load.last_change = now
+                    load.cold_ticks = 0
+
+    def stop_idle_pipe(self, pair):
+        pipes = self.handler.pipelines[pair]
+        idle = [p for p in pipes if p.users == 0 and not p.stuck]
+        if not idle:
+            return False
+        # Keep the pipes that have been used most recently, they're warmest:
+        pipes.remove(min(idle, key=lambda p: p.last_usage))
+        heapq.heapify(pipes)
+        return True
+
+    def to_json(self):
+        return {'%s-%s' % pair: load.to_json()
+                for pair, load in self.loads.items()
+                if pair in self.handler.pipelines}
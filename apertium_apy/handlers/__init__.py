@@ -13,9 +13,11 @@ from apertium_apy.handlers.stats import StatsHandler  # noqa: F401
 from apertium_apy.handlers.suggestion import SuggestionHandler  # noqa: F401
 from apertium_apy.handlers.translate import TranslateHandler  # noqa: F401
 from apertium_apy.handlers.translate import PairPrefsHandler  # noqa: F401
+from apertium_apy.handlers.translate_batch import TranslateBatchHandler  # noqa: F401
 from apertium_apy.handlers.translate_chain import TranslateChainHandler  # noqa: F401
 from apertium_apy.handlers.translate_doc import TranslateDocHandler  # noqa: F401
 from apertium_apy.handlers.translate_raw import TranslateRawHandler  # noqa: F401
+from apertium_apy.handlers.translate_socket import TranslateSocketHandler  # noqa: F401
 from apertium_apy.handlers.translate_webpage import TranslateWebpageHandler  # noqa: F401
 from apertium_apy.handlers.bilsearch import BilsearchHandler  # noqa: F401
 from apertium_apy.handlers.billookup import BillookupHandler  # noqa: F401
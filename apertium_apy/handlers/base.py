@@ -1,19 +1,28 @@
+import asyncio
 import json
 import logging
 import os
 import sys
+import time
 from datetime import datetime, timedelta
 
 import tornado
 import tornado.gen
 import tornado.web
+import tornado.iostream
 from tornado.escape import utf8
 from tornado.locks import Semaphore
 
-from apertium_apy.utils import to_fallback_code
+from apertium_apy.utils import ModeIndex
+from apertium_apy.utils.cache import LRUCache
+from apertium_apy.utils.formatting import prefer_native
+from apertium_apy.utils.paths import PathIndex
+from apertium_apy.utils.translation import make_pipeline, parse_mode_file, translate_simple
 # Typing imports that flake8 doesn't understand:
 from typing import Union, Dict, Optional, List, Any, Tuple  # noqa: F401
 from apertium_apy.utils.translation import FlushingPipeline, SimplePipeline  # noqa: F401
+from apertium_apy.autoscaler import Autoscaler  # noqa: F401
+from apertium_apy.translation_memory import TranslationMemory  # noqa: F401
 
 
 def dump_json(data):
@@ -27,6 +36,11 @@ class Stats:
     usecount = {}               # type: Dict[Tuple[str, str], int]
     vmsize = 0
     timing = []                 # type: List[Tuple[datetime, datetime, int]]
+    coalesced = 0               # requests that shared another's translation
+
+
+def sizeof_cached_translation(key, translated):
+    return sys.getsizeof(key[1]) + sys.getsizeof(translated)
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -43,6 +57,19 @@ class BaseHandler(tornado.web.RequestHandler):
     # (l1, l2): [translation.Pipeline], only contains flushing pairs!
     pipelines = {}  # type: Dict[Tuple[str, str], List[Union[FlushingPipeline, SimplePipeline]]]
     pipelines_holding = []  # type: List
+    # (path, mode): translation.Pipeline, for the non-pair modes
+    mode_pipelines = {}  # type: Dict[Tuple[str, str], Union[FlushingPipeline, SimplePipeline]]
+    # (path, mode): mtime of the mode file its pipeline was started from
+    mode_versions = {}  # type: Dict[Tuple[str, str], float]
+    # The mode in the mode_pipelines key of the bilingual lookups of
+    # per_word, whose path is the autobil.bin rather than a mode dir:
+    bilingual_mode = 'lt-proc -b'
+    # (path, mode): whether its pipeline flushes on NUL, see mode_flushes
+    mode_flushing = {}  # type: Dict[Tuple[str, str], bool]
+    flush_probe_secs = 5
+    # pairs_path, nonpairs_path and mode index file to look for modes in again on SIGHUP
+    mode_search_paths = (None, None, None)  # type: Tuple[Optional[str], Optional[str], Optional[str]]
+    autoscaler = None  # type: Optional[Autoscaler]
     callback = None
     timeout = 10
     lang_names = None           # type: Optional[str]
@@ -50,18 +77,23 @@ class BaseHandler(tornado.web.RequestHandler):
     verbosity = 0
     api_keys_conf = None
     stat_period_max_age = timedelta.max
+    # Set-up the handler needs that is still running in the background
+    # (e.g. loading a model), resolving to whether it worked, see wait_until_ready:
+    ready = None  # type: Optional[asyncio.Future]
+    startup_wait_secs = 2
 
     # dict representing a graph of translation pairs; keys are source languages
     # e.g. pairs_graph['eng'] = ['fra', 'spa']
     pairs_graph = {}  # type: Dict[str, List[str]]
-    # 2-D dict storing the shortest path for a chained translation pair
-    # keys are source and target languages
-    # e.g. paths['eng']['fra'] = ['eng', 'spa', 'fra']
-    paths = {}  # type: Dict[str, Dict[str, List[str]]]
+    # cheapest chains of pairs, e.g. path_index.path('eng', 'fra') == ['eng', 'spa', 'fra']
+    path_index = PathIndex(pairs_graph)
+    # (l1, l2): how much using this pair in a chain costs (default 1)
+    pair_weights = {}  # type: Dict[Tuple[str, str], float]
 
-    # dict representing equivalent languages and pairs
-    # keys are languages or pairs with variants
-    fallback_codes = {}  # type: Dict[str, str]
+    # e.g. mode_indexes['pairs'].resolve('en_US-es') == 'eng-spa', see resolve_mode
+    mode_indexes = {}  # type: Dict[str, ModeIndex]
+    mode_kinds = ('pairs', 'analyzers', 'generators', 'taggers', 'spellers',
+                  'guessers', 'bilsearch', 'billookup', 'embeddings')
 
     stats = Stats()
 
@@ -70,8 +102,16 @@ class BaseHandler(tornado.web.RequestHandler):
     max_pipes_per_pair = 1
     min_pipes_per_pair = 0
     max_users_per_pipe = 5
+    # (l1, l2): (min, max), overriding min_pipes_per_pair and max_pipes_per_pair:
+    pair_pipe_limits = {}  # type: Dict[Tuple[str, str], Tuple[int, int]]
+    max_inflight_per_pipe = 1
+    pipe_size = 0
+    native_formatters = False
     max_idle_secs = 0
+    scatter_spawn_chars = 0
     restart_pipe_after = 1000
+    restart_pipe_rss = 0        # bytes
+    restart_pipe_cpu = 0.0      # secs
     doc_pipe_sem = Semaphore(3)
     # Empty the url_cache[pair] when it's this full:
     max_inmemory_url_cache = 1000  # type: int
@@ -79,12 +119,24 @@ class BaseHandler(tornado.web.RequestHandler):
     url_cache_path = None  # type: Optional[str]
     # Keep half a gig free when storing url_cache to disk:
     min_free_space_disk_url_cache = 512 * 1024 * 1024  # type: int
+    # (pair, text, deformat, reformat, prefs, mark_unknown): translation;
+    # holds up to max_size bytes (0 turns it off)
+    result_cache = LRUCache(0, sizeof_cached_translation)
+    # (l1, l2): LRUCache of (prefs, deformatted sentence): translation,
+    # each holding up to segment_cache_size bytes (0 turns segmenting off)
+    segment_caches = {}  # type: Dict[Tuple[str, str], LRUCache]
+    segment_cache_size = 0
+    # On-disk store behind the segment caches, shared by all processes:
+    translation_memory = None  # type: Optional[TranslationMemory]
+    # (l1, l2): mtime of the mode file the pair's pipelines were started from
+    pair_versions = {}  # type: Dict[Tuple[str, str], float]
 
     def initialize(self):
         self.callback = self.get_argument('callback', default=None)
 
     @classmethod
     def init_pairs_graph(cls):
+        cls.pairs_graph = {}
         for pair in cls.pairs:
             lang1, lang2 = pair.split('-')
             if lang1 in cls.pairs_graph:
@@ -93,38 +145,100 @@ class BaseHandler(tornado.web.RequestHandler):
                 cls.pairs_graph[lang1] = [lang2]
 
     @classmethod
-    def calculate_paths(cls, start):
-        nodes = set()
-        for pair in map(lambda x: x.split('-'), cls.pairs):
-            nodes.add(pair[0])
-            nodes.add(pair[1])
-        dists = {}
-        prevs = {}
-        dists[start] = 0
-
-        while nodes:
-            u = min(nodes, key=lambda u: dists.get(u, sys.maxsize))
-            nodes.remove(u)
-            for v in cls.pairs_graph.get(u, []):
-                if v in nodes:
-                    other = dists.get(u, sys.maxsize) + 1   # TODO: weight(u, v) -- lower weight = better translation
-                    if other < dists.get(v, sys.maxsize):
-                        dists[v] = other
-                        prevs[v] = u
-
-        cls.paths[start] = {}
-        for u in prevs:
-            prev = prevs[u]     # type: Optional[str]
-            path = [u]
-            while prev:
-                path.append(prev)
-                prev = prevs.get(prev)
-            cls.paths[start][u] = list(reversed(path))
+    def init_paths(cls):
+        cls.path_index = PathIndex(cls.pairs_graph, cls.pair_weights)
 
     @classmethod
-    def init_paths(cls):
-        for lang in cls.pairs_graph:
-            cls.calculate_paths(lang)
+    def refresh_path_weights(cls):
+        """Make chains avoid pairs the autoscaler has seen to be slow."""
+        if cls.autoscaler is not None:
+            cls.path_index.set_rates({pair: load.speed()
+                                      for pair, load in cls.autoscaler.loads.items()
+                                      if load.speed() > 0})
+
+    @classmethod
+    def mode_file(cls, path, mode):
+        """The file a mode pipeline is started from, whose mtime is
+        kept in mode_versions."""
+        if mode == cls.bilingual_mode:
+            return path
+        return os.path.join(path, 'modes', mode + '.mode')
+
+    @classmethod
+    def get_mode_pipeline(cls, path, mode):
+        """A running pipeline for path/modes/mode.mode, started the
+        first time it's needed and kept until it's idle for
+        max_idle_secs (if set) or gets stuck."""
+        if cls.max_idle_secs:
+            for key, idle in list(cls.mode_pipelines.items()):
+                if idle.users == 0 and time.time() - idle.last_usage > cls.max_idle_secs:
+                    logging.info("Pipeline for mode %s hasn't been used in %d secs, shutting down", key[1], cls.max_idle_secs)
+                    del cls.mode_pipelines[key]
+                    cls.mode_versions.pop(key, None)
+        pipeline = cls.mode_pipelines.get((path, mode))
+        if pipeline is None or pipeline.stuck:
+            logging.info('Starting up a new pipeline for mode %s …', mode)
+            mode_path = cls.mode_file(path, mode)
+            cls.mode_versions[(path, mode)] = os.path.getmtime(mode_path)
+            pipeline = make_pipeline(parse_mode_file(mode_path), cls.timeout, cls.max_inflight_per_pipe, cls.pipe_size)
+            cls.mode_pipelines[(path, mode)] = pipeline
+        return pipeline
+
+    async def wait_until_ready(self):
+        """Wait up to startup_wait_secs for the background set-up in
+        self.ready; False (after sending a 503) if it's still running,
+        or if it failed (see apy.run_in_background)."""
+        if self.ready is None:
+            return True
+        if not self.ready.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.ready), self.startup_wait_secs)
+            except asyncio.TimeoutError:
+                self.send_error(503, explanation='Still starting up, please try again in a little while')
+                return False
+        if not self.ready.result():
+            self.send_error(503, explanation='This service failed to start up')
+            return False
+        return True
+
+    async def run_mode(self, text, path, mode, formatting='none'):
+        """Like `apertium -d path -f formatting mode`, but on a warm
+        pipeline from get_mode_pipeline."""
+        if formatting == 'none':
+            deformat, reformat = False, False
+        else:
+            deformat, reformat = 'apertium-des' + formatting, 'apertium-re' + formatting
+            if self.native_formatters:
+                deformat, reformat = prefer_native(deformat, reformat)
+        if not await self.mode_flushes(path, mode):
+            return await translate_simple(text, [['apertium', '-d', path, '-f', formatting, mode]])
+        pipeline = self.get_mode_pipeline(path, mode)
+        return await pipeline.translate(text, nosplit=True, deformat=deformat, reformat=reformat)
+
+    @classmethod
+    async def mode_flushes(cls, path, mode):
+        """Whether the mode's programs flush their output on NUL (with
+        the -z that parse_mode_file gives them), so it can run on a
+        warm pipeline. We find out the first time by sending an empty
+        block, which should come straight back; modes that don't
+        answer within flush_probe_secs are run once per request, with
+        the apertium script, like before warm pipelines."""
+        key = (path, mode)
+        if key not in cls.mode_flushing:
+            pipeline = cls.get_mode_pipeline(path, mode)
+            flushes = isinstance(pipeline, FlushingPipeline)
+            if flushes:
+                try:
+                    with pipeline.use():
+                        await pipeline.send(b'', timeout=cls.flush_probe_secs)
+                except (asyncio.TimeoutError, tornado.iostream.StreamClosedError):
+                    flushes = False
+            if not flushes:
+                logging.warning('Mode %s does not flush on NUL, running it once per request', mode)
+                if cls.mode_pipelines.get(key) is pipeline:
+                    del cls.mode_pipelines[key]
+            cls.mode_flushing[key] = flushes
+        return cls.mode_flushing[key]
 
     def log_vmsize(self):
         if self.verbosity < 1:
@@ -196,16 +310,18 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_header('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
         self.set_header('Access-Control-Allow-Headers', 'accept, cache-control, origin, x-requested-with, x-file-name, content-type')
 
-    def find_fallback_mode(self, in_mode, installed_modes):
-        if in_mode not in installed_modes and '_' in in_mode:
-            if in_mode in self.fallback_codes:
-                in_mode = self.fallback_codes[in_mode]
-            else:
-                fallback_mode = to_fallback_code(in_mode, installed_modes)
-                if fallback_mode is not None:
-                    self.fallback_codes[in_mode] = fallback_mode
-                    in_mode = fallback_mode
-        return in_mode
+    @classmethod
+    def init_mode_indexes(cls):
+        cls.mode_indexes = {kind: ModeIndex(getattr(cls, kind)) for kind in cls.mode_kinds}
+
+    def resolve_mode(self, kind, code):
+        """The installed mode of kind (e.g. 'pairs' or 'analyzers') for
+        code, which may be e.g. en, eng_US, en-es or eng-spa; code in
+        alpha-3 if there's none."""
+        index = self.mode_indexes.get(kind)
+        if index is None or index.modes is not getattr(self, kind):
+            index = self.mode_indexes[kind] = ModeIndex(getattr(self, kind))
+        return index.resolve(code)
 
     @tornado.gen.coroutine
     def post(self):
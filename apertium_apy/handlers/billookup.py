@@ -3,20 +3,18 @@ import re
 from tornado import gen
 
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils.translation import translate_simple
-from apertium_apy.utils import to_alpha3_code
 
 
 class BillookupHandler(BaseHandler):
     def get_pair_or_error(self, langpair):
         try:
-            l1, l2 = map(to_alpha3_code, langpair.split('|'))
+            l1, l2 = langpair.split('|')
             in_mode = f'{l1}-{l2}'
         except ValueError:
             self.send_error(400, explanation='That pair is invalid, use e.g. eng|spa')
             return None
 
-        in_mode = self.find_fallback_mode(in_mode, self.pairs)
+        in_mode = self.resolve_mode('pairs', in_mode)
         if in_mode not in self.pairs:
             self.send_error(400, explanation='That pair is not installed')
             return None
@@ -26,9 +24,7 @@ class BillookupHandler(BaseHandler):
     def lookup_and_respond(self, pair, query):
         try:
             path, mode = self.billookup['-'.join(pair)]
-            formatting = 'none'
-            commands = [['apertium', '-d', path, '-f', formatting, mode]]
-            result = yield translate_simple(query, commands)
+            result = yield self.run_mode(query, path, mode)
 
             entries = result.strip().split('^')
             raw_results = []
@@ -3,17 +3,13 @@ from datetime import timedelta
 from tornado import gen
 
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils import to_alpha3_code, get_coverage
+from apertium_apy.utils import get_coverage
 
 
 class CoverageHandler(BaseHandler):
     @gen.coroutine
     def get(self):
-        mode = to_alpha3_code(self.get_argument('lang'))
-        if '-' in mode:
-            l1, l2 = map(to_alpha3_code, mode.split('-', 1))
-            mode = '%s-%s' % (l1, l2)
-        mode = self.find_fallback_mode(mode, self.analyzers)
+        mode = self.resolve_mode('analyzers', self.get_argument('lang'))
         text = self.get_argument('q')
         if not text:
             self.send_error(400, explanation='Missing q argument')
@@ -3,20 +3,18 @@ import os
 from tornado import gen
 
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils.translation import translate_simple
-from apertium_apy.utils import to_alpha3_code
 
 
 class EmbeddingsHandler(BaseHandler):
     def get_pair_or_error(self, langpair):
         try:
-            l1, l2 = map(to_alpha3_code, langpair.split('|'))
+            l1, l2 = langpair.split('|')
             in_mode = f'{l1}-{l2}'
         except ValueError:
             self.send_error(400, explanation='That pair is invalid, use e.g. eng|spa')
             return None
 
-        in_mode = self.find_fallback_mode(in_mode, self.pairs)
+        in_mode = self.resolve_mode('pairs', in_mode)
         if in_mode not in self.pairs:
             self.send_error(400, explanation='That pair is not installed')
             return None
@@ -27,9 +25,7 @@ class EmbeddingsHandler(BaseHandler):
         try:
             raw_path, mode = self.embeddings['-'.join(pair)]
             path = os.path.abspath(raw_path)
-
-            commands = [['apertium', '-d', path, '-f', 'none', mode]]
-            raw = yield translate_simple(query + '\n', commands)
+            raw = yield self.run_mode(query + '\n', path, mode)
 
             segments = [seg for seg in raw.strip().split('^') if seg and '/' in seg]
             results = []
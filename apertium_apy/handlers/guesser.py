@@ -3,8 +3,7 @@ import re
 from tornado import gen
 
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils import to_alpha3_code, remove_dot_from_deformat
-from apertium_apy.utils.translation import translate_simple
+from apertium_apy.utils import remove_dot_from_deformat
 
 
 class GuesserHandler(BaseHandler):
@@ -18,16 +17,10 @@ class GuesserHandler(BaseHandler):
     @gen.coroutine
     def get(self):
         in_text = self.get_argument('q')
-        in_mode = to_alpha3_code(self.get_argument('lang'))
-        if '-' in in_mode:
-            l1, l2 = map(to_alpha3_code, in_mode.split('-', 1))
-            in_mode = '%s-%s' % (l1, l2)
-        in_mode = self.find_fallback_mode(in_mode, self.guessers)
+        in_mode = self.resolve_mode('guessers', self.get_argument('lang'))
         if in_mode in self.guessers:
             [path, mode] = self.guessers[in_mode]
-            formatting = 'txt'
-            commands = [['apertium', '-d', path, '-f', formatting, mode]]
-            result = yield translate_simple(in_text, commands)
+            result = yield self.run_mode(in_text, path, mode, formatting='txt')
             self.send_response(self.postproc_text(in_text, result))
         else:
             self.send_error(400, explanation='That mode is not installed')
@@ -3,17 +3,8 @@ import re
 
 from tornado import gen
 
-try:
-    import fasttext
-except ImportError:
-    fasttext = None
-try:
-    import cld2full as cld2  # type: ignore
-except ImportError:
-    cld2 = None
-
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils import get_coverages, to_alpha3_code
+from apertium_apy.utils import get_coverages, optional_import, to_alpha3_code
 
 
 def fasttext_strip_prefix(s):
@@ -46,7 +37,7 @@ def fasttext_identify(model, text):
         return {'nob': 1.0}  # TODO: better default
 
 
-def cld_identify(text):
+def cld_identify(cld2, text):
     cld_results = cld2.detect(text)
     if cld_results[0]:
         possible_langs = filter(lambda x: x[1] != 'un', cld_results[2])
@@ -57,6 +48,7 @@ def cld_identify(text):
 
 
 class IdentifyLangHandler(BaseHandler):
+    # The fastText model, loaded in the background at start-up:
     fasttext = None
 
     @gen.coroutine
@@ -64,11 +56,14 @@ class IdentifyLangHandler(BaseHandler):
         text = self.get_argument('q')
         if not text:
             return self.send_error(400, explanation='Missing q argument')
+        if not (yield self.wait_until_ready()):
+            return
 
+        cld2 = optional_import('cld2full')
         if self.fasttext is not None:
             self.send_response(fasttext_identify(self.fasttext, text))
         elif cld2:
-            self.send_response(cld_identify(text))
+            self.send_response(cld_identify(cld2, text))
         else:
             try:
                 coverages = yield gen.with_timeout(
@@ -13,7 +13,7 @@ class ListHandler(BaseHandler):
             src = self.get_argument('src', default=None)
             response_data = []
             if src:
-                pairs = [(src, trg) for trg in self.paths[src]]
+                pairs = [(src, trg) for trg in self.path_index.paths_from(src)]
             else:
                 pairs = [(p[0], p[1]) for par in self.pairs for p in [par.split('-')]]
             for (l1, l2) in pairs:
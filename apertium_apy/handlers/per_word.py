@@ -1,14 +1,38 @@
+import asyncio
+import os
 import re
-from asyncio.subprocess import create_subprocess_exec, PIPE
 
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils import apertium, remove_dot_from_deformat, to_alpha3_code
-
-
-async def bilingual_translate(to_translate, mode_dir, mode):
-    proc = await create_subprocess_exec('lt-proc', '-b', mode, stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=mode_dir)
-    (output, _stderr) = await proc.communicate(input=to_translate.encode('utf-8'))
-    return output.decode('utf-8')
+from apertium_apy.utils import remove_dot_from_deformat, to_alpha3_code
+from apertium_apy.utils.translation import FlushingPipeline
+
+lexical_unit_re = r'\^([^\$]*)\$'
+
+
+def get_bilingual_pipeline(self, autobil):
+    """A running `lt-proc -b -z autobil`, kept with the mode pipelines."""
+    key = (autobil, self.bilingual_mode)
+    pipeline = self.mode_pipelines.get(key)
+    if pipeline is None or pipeline.stuck:
+        self.mode_versions[key] = os.path.getmtime(autobil)
+        pipeline = FlushingPipeline(self.timeout, [['lt-proc', '-b', '-z', autobil]], self.max_inflight_per_pipe)
+        self.mode_pipelines[key] = pipeline
+    return pipeline
+
+
+async def bilingual_translate_units(self, lexical_units, mode_dir, autobil):
+    """Look up the analyses of every unit in the bilingual dictionary
+    with a single write: units are separated by NUL, so lt-proc -z
+    flushes (and we can split) after each."""
+    units = [''.join('^%s$' % form for form in (lu.split('/')[1:] or [lu]))
+             for lu in lexical_units]
+    to_translate = '\0'.join(units)
+    pipeline = get_bilingual_pipeline(self, os.path.abspath(os.path.join(mode_dir, autobil)))
+    with pipeline.use():
+        output = await pipeline.send(bytes(to_translate, 'utf-8'))
+    raw_translations = output.decode('utf-8').split('\0')[:len(lexical_units)]
+    return [['/'.join(x.split('/')[1:]) for x in re.findall(lexical_unit_re, raw)]
+            for raw in raw_translations]
 
 
 def strip_tags(analysis):
@@ -18,61 +42,53 @@ def strip_tags(analysis):
         return analysis
 
 
+async def analyse(self, query, mode_info):
+    analysis = await self.run_mode(query, mode_info[0], mode_info[1], formatting='txt')
+    return remove_dot_from_deformat(query, re.findall(lexical_unit_re, analysis))
+
+
 async def process_per_word(self, lang, modes, query):
     outputs = {}
     morph_lexical_units = None
     tagger_lexical_units = None
-    lexical_unit_re = r'\^([^\$]*)\$'
+    morph_lang, tagger_lang = lang, lang
 
+    analyses = []
     if 'morph' in modes or 'biltrans' in modes:
-        lang = self.find_fallback_mode(lang, self.analyzers)
-        if lang in self.analyzers:
-            mode_info = self.analyzers[lang]
-            analysis = await apertium(query, mode_info[0], mode_info[1])
-            morph_lexical_units = remove_dot_from_deformat(query, re.findall(lexical_unit_re, analysis))
-            outputs['morph'] = [lu.split('/')[1:] for lu in morph_lexical_units]
-            outputs['morph_inputs'] = [strip_tags(lu.split('/')[0]) for lu in morph_lexical_units]
-        else:
+        morph_lang = self.resolve_mode('analyzers', lang)
+        if morph_lang not in self.analyzers:
             return
-
+        analyses.append(analyse(self, query, self.analyzers[morph_lang]))
     if 'tagger' in modes or 'disambig' in modes or 'translate' in modes:
-        lang = self.find_fallback_mode(lang, self.taggers)
-        if lang in self.taggers:
-            mode_info = self.taggers[lang]
-            analysis = await apertium(query, mode_info[0], mode_info[1])
-            tagger_lexical_units = remove_dot_from_deformat(query, re.findall(lexical_unit_re, analysis))
-            outputs['tagger'] = [lu.split('/')[1:] if '/' in lu else lu for lu in tagger_lexical_units]
-            outputs['tagger_inputs'] = [strip_tags(lu.split('/')[0]) for lu in tagger_lexical_units]
-        else:
+        tagger_lang = self.resolve_mode('taggers', lang)
+        if tagger_lang not in self.taggers:
             return
+        analyses.append(analyse(self, query, self.taggers[tagger_lang]))
+    # The morph and tagger analyses don't depend on each other:
+    results = await asyncio.gather(*analyses)
+
+    if 'morph' in modes or 'biltrans' in modes:
+        morph_lexical_units = results.pop(0)
+        outputs['morph'] = [lu.split('/')[1:] for lu in morph_lexical_units]
+        outputs['morph_inputs'] = [strip_tags(lu.split('/')[0]) for lu in morph_lexical_units]
+    if 'tagger' in modes or 'disambig' in modes or 'translate' in modes:
+        tagger_lexical_units = results.pop(0)
+        outputs['tagger'] = [lu.split('/')[1:] if '/' in lu else lu for lu in tagger_lexical_units]
+        outputs['tagger_inputs'] = [strip_tags(lu.split('/')[0]) for lu in tagger_lexical_units]
 
     if 'biltrans' in modes:
         if morph_lexical_units:
-            outputs['biltrans'] = []
-            for lu in morph_lexical_units:
-                split_unit = lu.split('/')
-                forms = split_unit[1:] if len(split_unit) > 1 else split_unit
-                raw_translations = await bilingual_translate(''.join(['^%s$' % form for form in forms]),
-                                                             mode_info[0],
-                                                             lang + '.autobil.bin')
-                translations = re.findall(lexical_unit_re, raw_translations)
-                outputs['biltrans'].append(list(map(lambda x: '/'.join(x.split('/')[1:]), translations)))
-                outputs['translate_inputs'] = outputs['morph_inputs']
+            outputs['biltrans'] = await bilingual_translate_units(
+                self, morph_lexical_units, self.analyzers[morph_lang][0], morph_lang + '.autobil.bin')
+            outputs['translate_inputs'] = outputs['morph_inputs']
         else:
             return
 
     if 'translate' in modes:
         if tagger_lexical_units:
-            outputs['translate'] = []
-            for lu in tagger_lexical_units:
-                split_unit = lu.split('/')
-                forms = split_unit[1:] if len(split_unit) > 1 else split_unit
-                raw_translations = await bilingual_translate(''.join(['^%s$' % form for form in forms]),
-                                                             mode_info[0],
-                                                             lang + '.autobil.bin')
-                translations = re.findall(lexical_unit_re, raw_translations)
-                outputs['translate'].append(list(map(lambda x: '/'.join(x.split('/')[1:]), translations)))
-                outputs['translate_inputs'] = outputs['tagger_inputs']
+            outputs['translate'] = await bilingual_translate_units(
+                self, tagger_lexical_units, self.taggers[tagger_lang][0], tagger_lang + '.autobil.bin')
+            outputs['translate_inputs'] = outputs['tagger_inputs']
         else:
             return
 
@@ -2,6 +2,7 @@ from tornado import gen
 
 from apertium_apy.handlers.base import BaseHandler
 from apertium_apy.utils import to_alpha3_code
+from apertium_apy.utils.formatting import prefer_native
 from apertium_apy.utils.translation import parse_mode_file, translate_pipeline
 
 
@@ -23,7 +24,10 @@ class PipeDebugHandler(BaseHandler):
             self.send_error(500)
             return
 
-        res = yield translate_pipeline(to_translate, commands)
+        deformat, reformat = 'apertium-deshtml', 'apertium-rehtml-noent'
+        if self.native_formatters:
+            deformat, reformat = prefer_native(deformat, reformat)
+        res = yield translate_pipeline(to_translate, commands, deformat, reformat)
         if self.get_status() != 200:
             self.send_error(self.get_status())
             return
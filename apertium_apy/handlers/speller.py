@@ -2,25 +2,70 @@ import logging
 
 from tornado import gen
 
-try:
-    import streamparser
-except ImportError:
-    streamparser = None
-
 from apertium_apy.handlers.base import BaseHandler
-from apertium_apy.utils import to_alpha3_code
-from apertium_apy.utils.translation import translate_simple
+from apertium_apy.utils import optional_import
+from apertium_apy.utils.cache import LRUCache
 
 
 class SpellerHandler(BaseHandler):
+    # (path, mode, mode version, token): suggestions
+    suggestion_cache = LRUCache(10000)
+
+    @staticmethod
+    def parse_suggestions(result):
+        suggestion = []
+        found_sugg = False
+        for line in result.splitlines():
+            if line.count('Corrections for'):
+                found_sugg = True
+                continue
+            if found_sugg and '\t' in line:
+                s, w = line.split('\t')
+                suggestion.append((s, w))
+        return suggestion
+
+    @gen.coroutine
+    def get_suggestions(self, path, mode, tokens):
+        """Suggestions for each distinct token, from the cache, or else
+        from the speller, which gets all the missing tokens in one
+        write, separated by NUL. If the output doesn't split into one
+        block per token, or the speller doesn't flush on NUL, we ask
+        one token at a time."""
+        flushes = yield self.mode_flushes(path, mode)
+        if flushes:
+            pipeline = self.get_mode_pipeline(path, mode)
+        # Keyed on the mode file's mtime, so a reinstalled speller's
+        # suggestions don't come from the old one:
+        version = self.mode_versions.get((path, mode))
+        suggestions = {}
+        for token in tokens:
+            cached = self.suggestion_cache.get((path, mode, version, token))
+            if cached is not None:
+                suggestions[token] = cached
+        missing = [token for token in dict.fromkeys(tokens) if token not in suggestions]
+        if missing:
+            results = []
+            if flushes:
+                with pipeline.use():
+                    output = yield pipeline.send(bytes('\0'.join(missing), 'utf-8'))
+                results = output.decode('utf-8').split('\0')
+                if len(results) < len(missing) or any(extra.strip() for extra in results[len(missing):]):
+                    logging.warning('Speller mode %s gave %d outputs for %d tokens, sending them one at a time',
+                                    mode, len([r for r in results if r.strip()]), len(missing))
+                    results = []
+            if not results:
+                for token in missing:
+                    result = yield self.run_mode(token, path, mode)
+                    results.append(result)
+            for token, result in zip(missing, results):
+                suggestions[token] = self.parse_suggestions(result)
+                self.suggestion_cache.put((path, mode, version, token), suggestions[token])
+        return suggestions
+
     @gen.coroutine
     def get(self):
         in_text = self.get_argument('q') + '*'
-        in_mode = to_alpha3_code(self.get_argument('lang'))
-        if '-' in in_mode:
-            l1, l2 = map(to_alpha3_code, in_mode.split('-', 1))
-            in_mode = '%s-%s' % (l1, l2)
-        in_mode = self.find_fallback_mode(in_mode, self.spellers)
+        in_mode = self.resolve_mode('spellers', self.get_argument('lang'))
         logging.info(in_text)
         logging.info(self.get_argument('lang'))
         logging.info(in_mode)
@@ -30,30 +75,18 @@ class SpellerHandler(BaseHandler):
             [path, mode] = self.spellers[in_mode]
             logging.info(path)
             logging.info(mode)
-            formatting = 'none'
-            commands = [['apertium', '-d', path, '-f', formatting, self.get_argument('lang') + '-tokenise']]
-            result = yield translate_simple(in_text, commands)
+            result = yield self.run_mode(in_text, path, self.get_argument('lang') + '-tokenise')
 
-            tokens = streamparser.parse(result)
+            streamparser = optional_import('streamparser')
+            tokens = list(streamparser.parse(result))
+            suggestions = yield self.get_suggestions(path, mode, [token.wordform for token in tokens
+                                                                  if token.knownness != streamparser.known])
             units = []
             for token in tokens:
                 if token.knownness == streamparser.known:
                     units.append({'token': token.wordform, 'known': True, 'sugg': []})
                 else:
-                    suggestion = []
-                    commands = [['apertium', '-d', path, '-f', formatting, mode]]
-
-                    result = yield translate_simple(token.wordform, commands)
-                    found_sugg = False
-                    for line in result.splitlines():
-                        if line.count('Corrections for'):
-                            found_sugg = True
-                            continue
-                        if found_sugg and '\t' in line:
-                            s, w = line.split('\t')
-                            suggestion.append((s, w))
-
-                    units.append({'token': token.wordform, 'known': False, 'sugg': suggestion})
+                    units.append({'token': token.wordform, 'known': False, 'sugg': suggestions[token.wordform]})
 
             self.send_response(units)
         else:
@@ -32,21 +32,38 @@ class StatsHandler(BaseHandler):
                          for (l1, l2), pipes in self.pipelines.items()
                          if pipes != []}
         holding_pipes = len(self.pipelines_holding)
+        pipe_resources = {'%s-%s' % (l1, l2): [pipe.resources() for pipe in pipes]
+                          for (l1, l2), pipes in self.pipelines.items()
+                          if pipes != []}
 
-        self.send_response({
-            'responseData': {
-                'uptime': uptime,
-                'useCount': use_count,
-                'runningPipes': running_pipes,
-                'holdingPipes': holding_pipes,
-                'periodStats': {
-                    'charsPerSec': chars_per_sec,
-                    'totChars': chars,
-                    'totTimeSpent': times.total_seconds(),
-                    'requests': nrequests,
-                    'ageFirstRequest': max_age,
-                },
+        response_data = {
+            'uptime': uptime,
+            'useCount': use_count,
+            'runningPipes': running_pipes,
+            'holdingPipes': holding_pipes,
+            'pipeResources': pipe_resources,
+            'resultCache': {
+                'hits': self.result_cache.hits,
+                'misses': self.result_cache.misses,
+                'coalesced': self.stats.coalesced,
+                'entries': len(self.result_cache),
+                'bytes': self.result_cache.size,
+            },
+            'periodStats': {
+                'charsPerSec': chars_per_sec,
+                'totChars': chars,
+                'totTimeSpent': times.total_seconds(),
+                'requests': nrequests,
+                'ageFirstRequest': max_age,
             },
+        }
+        if self.autoscaler is not None:
+            response_data['pairLoad'] = self.autoscaler.to_json()
+        if self.translation_memory is not None:
+            response_data['translationMemory'] = self.translation_memory.to_json()
+
+        self.send_response({
+            'responseData': response_data,
             'responseDetails': None,
             'responseStatus': 200,
         })
@@ -62,6 +62,9 @@ class SuggestionHandler(BaseHandler):
             self.send_error(400, explanation='All arguments were not provided')
             return
 
+        if not (yield self.wait_until_ready()):
+            return
+
         logging.info('Suggestion (%s): Context is %s \n Word: %s ; New Word: %s ', langpair, context, word, new_word)
         logging.info('Now verifying ReCAPTCHA.')
 
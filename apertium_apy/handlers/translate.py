@@ -1,7 +1,9 @@
 import heapq
 import logging
+import os
 import re
 import time
+import unicodedata
 from datetime import datetime
 
 from tornado import gen
@@ -9,13 +11,17 @@ import tornado.iostream
 import asyncio
 
 from apertium_apy import missing_freqs_db  # noqa: F401
-from apertium_apy.handlers.base import BaseHandler
+from apertium_apy.handlers.base import BaseHandler, dump_json, sizeof_cached_translation
+from apertium_apy.handlers.speller import SpellerHandler
 from apertium_apy.keys import ApiKeys
-from apertium_apy.utils import to_alpha3_code, scale_mt_log
-from apertium_apy.utils.translation import parse_mode_file, make_pipeline
+from apertium_apy.translation_memory import TieredSegmentCache
+from apertium_apy.utils import scale_mt_log
+from apertium_apy.utils.cache import LRUCache
+from apertium_apy.utils.formatting import prefer_native
+from apertium_apy.utils.translation import FlushingPipeline, ProcessFailureError, parse_mode_file, make_pipeline
 # Typing imports that flake8 doesn't understand:
-from apertium_apy.utils.translation import FlushingPipeline, SimplePipeline  # noqa: F401
-from typing import Union        # noqa: F401
+from apertium_apy.utils.translation import SimplePipeline  # noqa: F401
+from typing import Dict, List, Optional, Tuple, Union  # noqa: F401
 
 
 class TranslationInfo:
@@ -26,12 +32,51 @@ class TranslationInfo:
         self.referer = handler.request.headers.get('Referer', 'null')
 
 
+class DeadlineExceededError(Exception):
+    pass
+
+
 class TranslateHandler(BaseHandler):
     unknown_mark_re = re.compile(r'[*]([^.,;:\t\* ]+)')
     api_keys = None
+    # key: [translation task, number of requests waiting for it]
+    results_inflight = {}  # type: Dict[Tuple, List]
+    # pair: bumped whenever the pair's cached translations go stale
+    cache_generation = {}  # type: Dict[Tuple[str, str], int]
 
     def __init__(self, application, request, **kwargs):
         super().__init__(application, request, **kwargs)
+        self.translation = None  # type: Optional[asyncio.Future]
+
+    def on_connection_close(self):
+        if self.translation is not None and not self.translation.done():
+            logging.info('Client went away, cancelling its translation')
+            self.translation.cancel()
+
+    def deadline_secs(self):
+        """Seconds left until the deadline the client gave (relative to
+        when the request came in), if any."""
+        deadline = self.request.headers.get('X-Request-Deadline', self.get_argument('deadline', default=None))
+        if deadline is None:
+            return None
+        try:
+            return float(deadline) - self.request.request_time()
+        except ValueError:
+            logging.info('Ignoring unparseable deadline %r', deadline)
+            return None
+
+    @gen.coroutine
+    def cancellable(self, translation):
+        """Run translation so that it's cancelled, freeing its place in
+        the pipeline queues, if the client goes away (raising
+        CancelledError) or its deadline passes (raising
+        DeadlineExceededError)."""
+        self.translation = asyncio.ensure_future(translation)
+        done, _ = yield asyncio.wait([self.translation], timeout=self.deadline_secs())
+        if not done:
+            self.translation.cancel()
+            raise DeadlineExceededError()
+        return self.translation.result()
 
     @property
     def mark_unknown(self):
@@ -54,29 +99,91 @@ class TranslateHandler(BaseHandler):
                 missing_freqs_db.note_unknown(token, pair)
 
     def cleanable(self, i, pair, pipe):
+        """'restart' or 'shutdown' if the pipe should be replaced or
+        just stopped, else False."""
         if pipe.stuck:
             logging.info('A pipe for pair %s-%s seems stuck, scheduling restart',
                          pair[0], pair[1])
-            return True
-        if pipe.use_count > self.restart_pipe_after:
+            return 'restart'
+        if self.restart_pipe_after and pipe.use_count > self.restart_pipe_after:
             # Not affected by min_pipes_per_pair
             logging.info('A pipe for pair %s-%s has handled %d requests, scheduling restart',
                          pair[0], pair[1], self.restart_pipe_after)
-            return True
-        elif (i >= self.min_pipes_per_pair and
+            return 'restart'
+        if self.restart_pipe_rss and pipe.rss() > self.restart_pipe_rss:
+            logging.info('A pipe for pair %s-%s uses %d bytes of memory, scheduling restart',
+                         pair[0], pair[1], pipe.rss())
+            return 'restart'
+        if self.restart_pipe_cpu and pipe.cpu_secs() > self.restart_pipe_cpu:
+            logging.info('A pipe for pair %s-%s has used %.1f secs of CPU, scheduling restart',
+                         pair[0], pair[1], pipe.cpu_secs())
+            return 'restart'
+        elif (i >= self.pipe_limits(pair)[0] and
                 self.max_idle_secs != 0 and
                 time.time() - pipe.last_usage > self.max_idle_secs):
             logging.info("A pipe for pair %s-%s hasn't been used in %d secs, scheduling shutdown",
                          pair[0], pair[1], self.max_idle_secs)
-            return True
+            return 'shutdown'
         else:
             return False
 
+    @classmethod
+    def invalidate_cached_translations(cls, pair):
+        cls.cache_generation[pair] = cls.cache_generation.get(pair, 0) + 1
+        cls.result_cache.evict(lambda key: key[0] == pair)
+        cls.segment_caches.pop(pair, None)
+
+    @classmethod
+    def get_segment_cache(cls, pair):
+        if pair not in cls.segment_caches:
+            cls.segment_caches[pair] = LRUCache(cls.segment_cache_size, sizeof_cached_translation)
+        if cls.translation_memory is not None:
+            return TieredSegmentCache(cls.segment_caches[pair], cls.translation_memory,
+                                      '%s-%s' % pair, cls.pair_versions.get(pair, 0.0))
+        return cls.segment_caches[pair]
+
+    async def cached_translation(self, key, translate):
+        """The cached result for key if there is one, else the result of
+        translate(), shared with any identical requests that come in
+        meanwhile. The translation is only cancelled when every request
+        waiting for it is."""
+        if not self.result_cache.max_size:
+            return await translate()
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+        entry = self.results_inflight.get(key)
+        if entry is None:
+            entry = self.results_inflight[key] = [asyncio.ensure_future(translate()), 0]
+            entry[0].add_done_callback(self.cache_translation(key, self.cache_generation.get(key[0], 0)))
+        else:
+            self.stats.coalesced += 1
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def cache_translation(self, key, generation):
+        def done(translation):
+            if self.results_inflight.get(key, [None])[0] is translation:
+                del self.results_inflight[key]
+            if (not translation.cancelled() and translation.exception() is None and
+                    generation == self.cache_generation.get(key[0], 0)):
+                self.result_cache.put(key, translation.result())
+        return done
+
     def clean_pairs(self):
         for pair in self.pipelines:
             pipes = self.pipelines[pair]
-            to_clean = set(p for i, p in enumerate(pipes)
-                           if self.cleanable(i, pair, p))
+            reasons = {p: self.cleanable(i, pair, p) for i, p in enumerate(pipes)}
+            to_clean = set(p for p, reason in reasons.items() if reason)
+            # An idle pipe just shuts down, but a restarted one may
+            # have been going wrong, so we don't keep what it translated:
+            if 'restart' in reasons.values():
+                self.invalidate_cached_translations(pair)
             self.pipelines_holding += to_clean
             pipes[:] = [p for p in pipes if p not in to_clean]
             heapq.heapify(pipes)
@@ -88,11 +195,78 @@ class TranslateHandler(BaseHandler):
         if self.pipelines_holding:
             logging.info('%d pipelines still scheduled for shutdown', len(self.pipelines_holding))
 
-    def get_pipe_cmds(self, l1, l2):
-        if (l1, l2) not in self.pipeline_cmds:
-            mode_path = self.pairs['%s-%s' % (l1, l2)]
-            self.pipeline_cmds[(l1, l2)] = parse_mode_file(mode_path)
-        return self.pipeline_cmds[(l1, l2)]
+    @classmethod
+    def get_pipe_cmds(cls, l1, l2):
+        if (l1, l2) not in cls.pipeline_cmds:
+            mode_path = cls.pairs['%s-%s' % (l1, l2)]
+            cls.pair_versions[(l1, l2)] = os.path.getmtime(mode_path)
+            cls.pipeline_cmds[(l1, l2)] = parse_mode_file(mode_path)
+        return cls.pipeline_cmds[(l1, l2)]
+
+    @classmethod
+    def retire_pair(cls, pair):
+        """Let the pair's pipelines finish the requests they have, and
+        start new ones from its mode file next time it's used."""
+        cls.pipelines_holding.extend(cls.pipelines.pop(pair, []))
+        cls.pipeline_cmds.pop(pair, None)
+        cls.pair_versions.pop(pair, None)
+        cls.url_cache.pop(pair, None)
+        cls.invalidate_cached_translations(pair)
+
+    @classmethod
+    def replace_modes(cls, found, pairprefs):
+        """Switch to the modes in found ({kind: {code: mode}}, as from
+        apy.find_modes). Only the pipelines of modes that were removed
+        or whose mode file changed are replaced; requests already using
+        them are left to finish. The modes are shared by all handlers, so
+        they're set on BaseHandler."""
+        for kind in cls.mode_kinds:
+            old, new = getattr(cls, kind), found[kind]
+            added = set(new) - set(old)
+            removed = set(old) - set(new)
+            moved = set(code for code in set(old) & set(new) if old[code] != new[code])
+            if added or removed or moved:
+                logging.info('Reloaded %s: %d added, %d removed, %d moved', kind, len(added), len(removed), len(moved))
+            setattr(BaseHandler, kind, new)
+
+        for pair, version in list(cls.pair_versions.items()):
+            mode_path = cls.pairs.get('%s-%s' % pair)
+            try:
+                upgraded = mode_path is None or os.path.getmtime(mode_path) != version
+            except OSError:
+                upgraded = True
+            if upgraded:
+                logging.info('Mode file of %s-%s changed, replacing its pipelines', pair[0], pair[1])
+                cls.retire_pair(pair)
+        for pair in list(cls.pipelines):
+            if '%s-%s' % pair not in cls.pairs:
+                cls.retire_pair(pair)
+        cls.pipelines_holding[:] = [p for p in cls.pipelines_holding if p.users > 0]
+
+        # Only by their files, since some (like the speller's -tokenise)
+        # are run without being in any of the mode kinds:
+        for (path, mode), version in list(cls.mode_versions.items()):
+            try:
+                upgraded = os.path.getmtime(cls.mode_file(path, mode)) != version
+            except OSError:
+                upgraded = True
+            if upgraded:
+                logging.info('Mode %s changed, replacing its pipeline', mode)
+                cls.mode_pipelines.pop((path, mode), None)
+                cls.mode_flushing.pop((path, mode), None)
+                del cls.mode_versions[(path, mode)]
+                SpellerHandler.suggestion_cache.evict(lambda key: key[:2] == (path, mode))
+
+        BaseHandler.pairprefs = pairprefs
+        BaseHandler.init_mode_indexes()
+        BaseHandler.init_pairs_graph()
+        BaseHandler.init_paths()
+        BaseHandler.refresh_path_weights()
+
+    @classmethod
+    def pipe_limits(cls, pair):
+        """(min, max) pipelines for this pair."""
+        return cls.pair_pipe_limits.get(pair, (cls.min_pipes_per_pair, cls.max_pipes_per_pair))
 
     def should_start_pipe(self, l1, l2):
         pipes = self.pipelines.get((l1, l2), [])
@@ -102,23 +276,55 @@ class TranslateHandler(BaseHandler):
             return True
         else:
             min_p = pipes[0]
-            if len(pipes) < self.max_pipes_per_pair and min_p.users > self.max_users_per_pipe:
+            if len(pipes) < self.pipe_limits((l1, l2))[1] and min_p.users > self.max_users_per_pipe:
                 logging.info('%s-%s has ≥%d users per pipe but only %d pipes',
                              l1, l2, min_p.users, len(pipes))
                 return True
             else:
                 return False
 
+    @classmethod
+    def start_pipe(cls, pair):
+        (l1, l2) = pair
+        logging.info('Starting up a new pipeline for %s-%s …', l1, l2)
+        if pair not in cls.pipelines:
+            cls.pipelines[pair] = []
+        p = make_pipeline(cls.get_pipe_cmds(l1, l2), cls.timeout, cls.max_inflight_per_pipe, cls.pipe_size)
+        heapq.heappush(cls.pipelines[pair], p)
+
     def get_pipeline(self, pair):
         (l1, l2) = pair
         if self.should_start_pipe(l1, l2):
-            logging.info('Starting up a new pipeline for %s-%s …', l1, l2)
-            if pair not in self.pipelines:
-                self.pipelines[pair] = []
-            p = make_pipeline(self.get_pipe_cmds(l1, l2), self.timeout)
-            heapq.heappush(self.pipelines[pair], p)
+            self.start_pipe(pair)
         return self.pipelines[pair][0]
 
+    def get_helper_pipelines(self, pair, pipeline, text_length):
+        """Other pipelines of this pair that a request can spread its
+        chunks across; very large requests may start up more of them,
+        which are later shut down like any others."""
+        if self.scatter_spawn_chars and text_length >= self.scatter_spawn_chars:
+            while len(self.pipelines.get(pair, [])) < self.pipe_limits(pair)[1]:
+                logging.info('%s-%s got a request of %d chars, starting extra pipelines',
+                             pair[0], pair[1], text_length)
+                self.start_pipe(pair)
+        return [p for p in self.pipelines.get(pair, [])
+                if p is not pipeline and isinstance(p, FlushingPipeline) and not p.stuck]
+
+    def get_segmenting_pipeline(self, pair):
+        """A pipeline to translate sentence by sentence with, or None if
+        neither --segment-cache-size nor --translation-memory is on, or
+        the pair can't do it."""
+        if self.segment_cache_size or self.translation_memory:
+            pipeline = self.get_pipeline(pair)
+            if isinstance(pipeline, FlushingPipeline):
+                return pipeline
+        return None
+
+    async def translate_segments(self, pair, pipeline, to_translate, deformat, reformat, prefs=''):
+        helpers = self.get_helper_pipelines(pair, pipeline, len(to_translate))
+        return await pipeline.translate_segments(to_translate, deformat, reformat, prefs,
+                                                 self.get_segment_cache(pair), helpers)
+
     def log_before_translation(self):
         return datetime.now()
 
@@ -130,22 +336,25 @@ class TranslateHandler(BaseHandler):
             scale_mt_log(self.get_status(), after - before, t_info, key, length)
 
         if self.get_status() == 200:
-            timings = self.stats.timing
-            oldest = timings[0][0] if timings else datetime.now()
-            if datetime.now() - oldest > self.stat_period_max_age:
-                self.stats.timing.pop(0)
-            self.stats.timing.append(
-                (before, after, length))
+            self.note_timing(before, after, length)
+
+    def note_timing(self, before, after, length):
+        timings = self.stats.timing
+        oldest = timings[0][0] if timings else datetime.now()
+        if datetime.now() - oldest > self.stat_period_max_age:
+            self.stats.timing.pop(0)
+        self.stats.timing.append(
+            (before, after, length))
 
     def get_pair_or_error(self, langpair, text_length):
         try:
-            l1, l2 = map(to_alpha3_code, langpair.split('|'))
+            l1, l2 = langpair.split('|')
             in_mode = '%s-%s' % (l1, l2)
         except ValueError:
             self.send_error(400, explanation='That pair is invalid, use e.g. eng|spa')
             self.log_after_translation(self.log_before_translation(), text_length)
             return None
-        in_mode = self.find_fallback_mode(in_mode, self.pairs)
+        in_mode = self.resolve_mode('pairs', in_mode)
         if in_mode not in self.pairs:
             self.send_error(400, explanation='That pair is not installed')
             self.log_after_translation(self.log_before_translation(), text_length)
@@ -168,19 +377,39 @@ class TranslateHandler(BaseHandler):
             if 'apertium-re' not in reformat:
                 reformat = 'apertium-re' + reformat
 
+        return self.formatters(deformat, reformat)
+
+    def formatters(self, deformat, reformat):
+        if self.native_formatters:
+            return prefer_native(deformat, reformat)
         return deformat, reformat
 
+    async def translate_text(self, pair, pipeline, to_translate, mark_unknown, nosplit, deformat, reformat, prefs):
+        """Translate (or fetch from the cache), sentence by sentence if
+        that's turned on, and strip unknown marks if not wanted."""
+        async def translate():
+            if ((self.segment_cache_size or self.translation_memory) and
+                    not nosplit and isinstance(pipeline, FlushingPipeline)):
+                translated = await self.translate_segments(pair, pipeline, to_translate, deformat, reformat, prefs)
+            else:
+                helpers = self.get_helper_pipelines(pair, pipeline, len(to_translate))
+                translated = await pipeline.translate(to_translate, nosplit, deformat, reformat, prefs, helpers)
+            return self.maybe_strip_marks(mark_unknown, pair, translated)
+        key = (pair, unicodedata.normalize('NFC', to_translate), deformat, reformat, prefs, mark_unknown)
+        return await self.cached_translation(key, translate)
+
     @gen.coroutine
     def translate_and_respond(self, pair, pipeline, to_translate, mark_unknown, nosplit=False, deformat=True, reformat=True, prefs=''):
         mark_unknown = mark_unknown in ['yes', 'true', '1']
         self.note_pair_usage(pair)
         before = self.log_before_translation()
         try:
-            translated = yield pipeline.translate(to_translate, nosplit, deformat, reformat, prefs)
+            translated = yield self.cancellable(self.translate_text(pair, pipeline, to_translate, mark_unknown,
+                                                                    nosplit, deformat, reformat, prefs))
             self.log_after_translation(before, len(to_translate))
             self.send_response({
                 'responseData': {
-                    'translatedText': self.maybe_strip_marks(mark_unknown, pair, translated),
+                    'translatedText': translated,
                 },
                 'responseDetails': None,
                 'responseStatus': 200,
@@ -193,6 +422,57 @@ class TranslateHandler(BaseHandler):
             logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
             pipeline.stuck = True
             self.send_error(503, explanation='internal error')
+        except ProcessFailureError as e:
+            # e.g. a segment split in two, see send_batched:
+            logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+            self.send_error(503, explanation='internal error')
+        except DeadlineExceededError:
+            self.send_error(408, explanation='Translation did not finish before the request deadline')
+            self.log_after_translation(before, len(to_translate))
+        except asyncio.CancelledError:
+            pass                # nobody to respond to
+        self.clean_pairs()
+
+    def write_line(self, data):
+        self.write(dump_json(data) + '\n')
+
+    async def stream_translation(self, pair, pipeline, to_translate, mark_unknown, deformat, reformat, prefs):
+        helpers = self.get_helper_pipelines(pair, pipeline, len(to_translate))
+        chunks = pipeline.translate_iter(to_translate, deformat, reformat, prefs, helpers)
+        try:
+            async for chunk in chunks:
+                self.write_line({'translatedText': self.maybe_strip_marks(mark_unknown, pair, chunk)})
+                try:
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    raise asyncio.CancelledError()
+        finally:
+            await chunks.aclose()
+
+    @gen.coroutine
+    def stream_and_respond(self, pair, pipeline, to_translate, mark_unknown, deformat, reformat, prefs=''):
+        """Respond with newline-delimited JSON: a {"translatedText": …}
+        line for each chunk, written as soon as it's translated, then a
+        line with the responseStatus. Not cached, since the point is to
+        start answering before the whole translation is done."""
+        mark_unknown = mark_unknown in ['yes', 'true', '1']
+        self.note_pair_usage(pair)
+        before = self.log_before_translation()
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        try:
+            yield self.cancellable(self.stream_translation(pair, pipeline, to_translate, mark_unknown,
+                                                           deformat, reformat, prefs))
+            self.log_after_translation(before, len(to_translate))
+            self.write_line({'responseDetails': None, 'responseStatus': 200})
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError, ProcessFailureError) as e:
+            logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+            pipeline.stuck = True
+            self.write_line({'responseDetails': 'internal error', 'responseStatus': 503})
+        except DeadlineExceededError:
+            self.write_line({'responseDetails': 'Translation did not finish before the request deadline',
+                             'responseStatus': 408})
+        except asyncio.CancelledError:
+            pass                # nobody to respond to
         self.clean_pairs()
 
     @gen.coroutine
@@ -202,6 +482,16 @@ class TranslateHandler(BaseHandler):
         if pair is not None:
             pipeline = self.get_pipeline(pair)  # type: Union[FlushingPipeline, SimplePipeline]
             deformat, reformat = self.get_format()
+            if self.get_argument('stream', default='no').lower() in ['yes', 'true', '1'] and isinstance(pipeline, FlushingPipeline):
+                yield self.stream_and_respond(pair,
+                                              pipeline,
+                                              self.get_argument('q'),
+                                              self.get_argument('markUnknown', default='yes'),
+                                              deformat=deformat,
+                                              reformat=reformat,
+                                              prefs=self.get_argument('prefs', default=''),
+                                              )
+                return
             yield self.translate_and_respond(pair,
                                              pipeline,
                                              self.get_argument('q'),
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+import tornado.iostream
+import tornado.web
+from tornado import gen
+
+from apertium_apy.handlers.translate import DeadlineExceededError, TranslateHandler
+from apertium_apy.utils.translation import FlushingPipeline, ProcessFailureError
+
+if False:
+    from typing import Dict, List, Tuple  # noqa: F401
+
+
+class TranslateBatchHandler(TranslateHandler):
+    """Translate many texts in one request.
+
+    q is a JSON array (or the whole body, if it's sent as
+    application/json) of texts, or of {"q": …, "langpair": …} objects
+    for texts in other pairs than the langpair argument. The response
+    has one {"translatedText": …} per text, in the same order.
+    Texts of the same pair are sent to its pipeline NUL-separated, as
+    few chunks as they fit in.
+    """
+
+    def parse_batch(self):
+        if self.request.headers.get('Content-Type', '').startswith('application/json'):
+            batch = json.loads(self.request.body.decode('utf-8'))
+        else:
+            batch = json.loads(self.get_argument('q'))
+        if not isinstance(batch, list):
+            raise ValueError('q should be a JSON array')
+        default_langpair = self.get_argument('langpair', default=None)
+        items = []
+        for item in batch:
+            if isinstance(item, str):
+                item = {'q': item}
+            if not isinstance(item, dict) or not isinstance(item.get('q'), str):
+                raise ValueError('Each text should be a string or {"q": "…", "langpair": "…"}')
+            langpair = item.get('langpair', default_langpair)
+            if langpair is None:
+                raise ValueError('Text %r has no langpair' % item['q'][:20])
+            items.append((langpair, item['q']))
+        return items
+
+    async def translate_pair(self, pair, pipeline, texts, deformat, reformat, prefs):
+        try:
+            if isinstance(pipeline, FlushingPipeline):
+                helpers = self.get_helper_pipelines(pair, pipeline, sum(map(len, texts)))
+                return await pipeline.translate_batch(texts, deformat, reformat, prefs, helpers)
+            return [await pipeline.translate(text, False, deformat, reformat, prefs) for text in texts]
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError) as e:
+            logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+            pipeline.stuck = True
+            raise
+        except ProcessFailureError as e:
+            logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+            raise
+
+    @gen.coroutine
+    def get(self):
+        try:
+            items = self.parse_batch()
+        except (ValueError, tornado.web.MissingArgumentError) as e:
+            self.send_error(400, explanation='Expected a JSON array of texts: %s' % e)
+            return
+        length = sum(len(q) for _, q in items)
+        # pair: its distinct texts, each with where it goes in the response
+        by_pair = OrderedDict()  # type: OrderedDict
+        pairs = {}  # type: Dict[str, Tuple[str, str]]
+        for i, (langpair, q) in enumerate(items):
+            if langpair not in pairs:
+                pair = self.get_pair_or_error(langpair, length)
+                if pair is None:
+                    return
+                pairs[langpair] = pair
+            by_pair.setdefault(pairs[langpair], OrderedDict()).setdefault(q, []).append(i)
+
+        mark_unknown = self.mark_unknown
+        prefs = self.get_argument('prefs', default='')
+        deformat, reformat = self.get_format()
+        pipelines = {pair: self.get_pipeline(pair) for pair in by_pair}
+        for pair in by_pair:
+            self.note_pair_usage(pair)
+        before = self.log_before_translation()
+        try:
+            translated = yield self.cancellable(asyncio.gather(*[
+                self.translate_pair(pair, pipelines[pair], list(texts), deformat, reformat, prefs)
+                for pair, texts in by_pair.items()]))
+            response = [None] * len(items)  # type: List
+            for (pair, texts), pair_translated in zip(by_pair.items(), translated):
+                for indices, text in zip(texts.values(), pair_translated):
+                    for i in indices:
+                        response[i] = {'translatedText': self.maybe_strip_marks(mark_unknown, pair, text)}
+            self.log_after_translation(before, length)
+            self.send_response({
+                'responseData': response,
+                'responseDetails': None,
+                'responseStatus': 200,
+            })
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError, ProcessFailureError):
+            self.send_error(503, explanation='internal error')
+        except DeadlineExceededError:
+            self.send_error(408, explanation='Translation did not finish before the request deadline')
+            self.log_after_translation(before, length)
+        except asyncio.CancelledError:
+            pass                # nobody to respond to
+        self.clean_pairs()
@@ -1,8 +1,12 @@
+import asyncio
+import logging
+
+import tornado.iostream
 from tornado import gen
 
-from apertium_apy.handlers.translate import TranslateHandler
+from apertium_apy.handlers.translate import DeadlineExceededError, TranslateHandler
 from apertium_apy.utils import to_alpha3_code
-from apertium_apy.utils.translation import coreduce
+from apertium_apy.utils.translation import FlushingPipeline, ProcessFailureError, coreduce, translate_chain
 
 
 class TranslateChainHandler(TranslateHandler):
@@ -20,7 +24,10 @@ class TranslateChainHandler(TranslateHandler):
                 self.send_error(400, explanation='Need at least two languages, use e.g. eng|spa')
                 self.log_after_translation(self.log_before_translation(), text_length)
                 return None
-            return self.paths.get(langs[0], {}).get(langs[1])
+            if '{:s}-{:s}'.format(langs[0], langs[1]) in self.pairs:
+                # Never go around a pair that was asked for:
+                return langs
+            return self.path_index.path(langs[0], langs[1])
         for lang1, lang2 in self.pair_list(langs):
             if '{:s}-{:s}'.format(lang1, lang2) not in self.pairs:
                 self.send_error(400, explanation='Pair {:s}-{:s} is not installed'.format(lang1, lang2))
@@ -35,16 +42,29 @@ class TranslateChainHandler(TranslateHandler):
         for pair in pairs:
             self.note_pair_usage(pair)
         before = self.log_before_translation()
-        translated = yield coreduce(to_translate, [p.translate for p in pipelines], nosplit, deformat, reformat)
-        self.log_after_translation(before, len(to_translate))
-        self.send_response({
-            'responseData': {
-                'translatedText': self.maybe_strip_marks(mark_unknown, (pairs[0][0], pairs[-1][1]), translated),
-                'translationChain': chain,
-            },
-            'responseDetails': None,
-            'responseStatus': 200,
-        })
+        try:
+            if all(isinstance(p, FlushingPipeline) for p in pipelines):
+                translation = translate_chain(to_translate, pipelines, deformat, reformat, nosplit)
+            else:
+                translation = coreduce(to_translate, [p.translate for p in pipelines], nosplit, deformat, reformat)
+            translated = yield self.cancellable(translation)
+            self.log_after_translation(before, len(to_translate))
+            self.send_response({
+                'responseData': {
+                    'translatedText': self.maybe_strip_marks(mark_unknown, (pairs[0][0], pairs[-1][1]), translated),
+                    'translationChain': chain,
+                },
+                'responseDetails': None,
+                'responseStatus': 200,
+            })
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError, ProcessFailureError) as e:
+            logging.warning('Translation error in chain %s: %s', '|'.join(chain), e)
+            self.send_error(503, explanation='internal error')
+        except DeadlineExceededError:
+            self.send_error(408, explanation='Translation did not finish before the request deadline')
+            self.log_after_translation(before, len(to_translate))
+        except asyncio.CancelledError:
+            pass                # nobody to respond to
         self.clean_pairs()
 
     def prepare(self):
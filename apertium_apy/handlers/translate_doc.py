@@ -1,3 +1,5 @@
+import asyncio
+import logging
 import os
 import shutil
 import subprocess
@@ -8,6 +10,7 @@ import tornado
 from tornado import gen
 
 from apertium_apy.handlers.translate import TranslateHandler
+from apertium_apy.utils.translation import ProcessFailureError
 
 FILE_SIZE_LIMIT_BYTES = 32E6
 
@@ -33,6 +36,10 @@ ALLOWED_MIME_TYPES = {
     'application/x-tex': 'latex',
 }
 
+# Formats we can translate sentence by sentence on the pair's running
+# pipelines (with --segment-cache-size), instead of starting `apertium`:
+SEGMENTABLE_FORMATS = {'txt', 'html-noent'}
+
 OPEN_OFFICE_XML_FILE_MARKERS = {
     'word/document.xml': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
     'ppt/presentation.xml': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
@@ -109,11 +116,42 @@ class TranslateDocHandler(TranslateHandler):
                     return
                 self.request.headers['Content-Type'] = 'application/octet-stream'
                 self.request.headers['Content-Disposition'] = 'attachment'
+                fmt = ALLOWED_MIME_TYPES[mtype]
+                if (yield self.translate_segmented_doc(pair, body, fmt)):
+                    return
                 with (yield self.doc_pipe_sem.acquire()):
                     t = yield translate_doc(temp_file,
-                                            ALLOWED_MIME_TYPES[mtype],
+                                            fmt,
                                             self.pairs['%s-%s' % pair],
                                             self.mark_unknown,
                                             self.get_argument('prefs', default=''))
                 self.write(t)
                 self.finish()
+
+    async def translate_segmented_doc(self, pair, body, fmt):
+        """Translate the document and respond with it, returning False
+        if it has to go through the `apertium` script instead."""
+        pipeline = self.get_segmenting_pipeline(pair) if fmt in SEGMENTABLE_FORMATS else None
+        if pipeline is None:
+            return False
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+        deformat, reformat = self.formatters('apertium-des' + fmt.split('-')[0], 'apertium-re' + fmt)
+        with (await self.doc_pipe_sem.acquire()):
+            try:
+                translated = await self.translate_segments(pair, pipeline, text, deformat, reformat,
+                                                           self.get_argument('prefs', default=''))
+            except (asyncio.TimeoutError, tornado.iostream.StreamClosedError) as e:
+                logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+                pipeline.stuck = True
+                self.send_error(503, explanation='internal error')
+                return True
+            except ProcessFailureError as e:
+                logging.warning('Translation error in pair %s-%s: %s', pair[0], pair[1], e)
+                self.send_error(503, explanation='internal error')
+                return True
+        self.write(bytes(self.maybe_strip_marks(self.mark_unknown, pair, translated), 'utf-8'))
+        self.finish()
+        return True
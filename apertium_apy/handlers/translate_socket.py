@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+import tornado.iostream
+import tornado.websocket
+
+from apertium_apy.handlers.base import dump_json
+from apertium_apy.handlers.translate import TranslateHandler
+from apertium_apy.utils.translation import ProcessFailureError
+
+if False:
+    from typing import Set  # noqa: F401
+
+
+class TranslateSocketHandler(tornado.websocket.WebSocketHandler, TranslateHandler):
+    """A session for translating many small texts in one pair, e.g.
+    as someone types.
+
+    Connect to /translateSocket?langpair=eng|spa (format, deformat,
+    reformat and markUnknown as for /translate hold for the whole
+    session), then send messages like {"id": 1, "q": "…"}, optionally
+    with "prefs" or "markUnknown". Each is answered as soon as its
+    translation is ready, so answers may come in another order than the
+    messages; they carry the same id: {"id": 1, "translatedText": "…"},
+    or {"id": 1, "code": 503, "explanation": "…"} on errors. Messages
+    beyond max_inflight_messages waiting at once get a 429.
+    """
+    max_inflight_messages = 100
+
+    def __init__(self, application, request, **kwargs):
+        super().__init__(application, request, **kwargs)
+        self.inflight = set()  # type: Set[asyncio.Future]
+
+    def check_origin(self, origin):
+        # Like the Access-Control-Allow-Origin: * of the other endpoints
+        return True
+
+    async def get(self, *args, **kwargs):  # type: ignore[override]
+        self.pair = self.get_pair_or_error(self.get_argument('langpair'), 0)
+        if self.pair is None:
+            return
+        self.deformat, self.reformat = self.get_format()
+        self.mark_unknown_default = self.get_argument('markUnknown', default='yes')
+        await super().get(*args, **kwargs)
+
+    def on_message(self, message):
+        try:
+            request = json.loads(message)
+            to_translate = request['q']
+            if not isinstance(to_translate, str):
+                raise TypeError('q should be a string')
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(None, {'code': 400, 'explanation': 'Expected {"id": …, "q": "…"}, got error %s' % e})
+            return
+        if len(self.inflight) >= self.max_inflight_messages:
+            self.reply(request.get('id'), {'code': 429, 'explanation': 'Too many messages waiting for translation, wait for some answers first'})
+            return
+        translation = asyncio.ensure_future(self.translate_message(request.get('id'), to_translate, request))
+        self.inflight.add(translation)
+        translation.add_done_callback(self.inflight.discard)
+
+    def on_close(self):
+        for translation in self.inflight:
+            translation.cancel()
+
+    def reply(self, message_id, data):
+        data['id'] = message_id
+        try:
+            self.write_message(dump_json(data))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    async def translate_message(self, message_id, to_translate, request):
+        mark_unknown = str(request.get('markUnknown', self.mark_unknown_default)).lower() in ['yes', 'true', '1']
+        prefs = request.get('prefs', '')
+        pipeline = self.get_pipeline(self.pair)
+        self.note_pair_usage(self.pair)
+        before = datetime.now()
+        try:
+            translated = await self.translate_text(self.pair, pipeline, to_translate, mark_unknown,
+                                                   False, self.deformat, self.reformat, prefs)
+            self.note_timing(before, datetime.now(), len(to_translate))
+            self.reply(message_id, {'translatedText': translated})
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError) as e:
+            logging.warning('Translation error in pair %s-%s: %s', self.pair[0], self.pair[1], e)
+            pipeline.stuck = True
+            self.reply(message_id, {'code': 503, 'explanation': 'internal error'})
+        except ProcessFailureError as e:
+            logging.warning('Translation error in pair %s-%s: %s', self.pair[0], self.pair[1], e)
+            self.reply(message_id, {'code': 503, 'explanation': 'internal error'})
+        except Exception:
+            # Nothing else would see it, and the client should still get an answer:
+            logging.exception('Unexpected error translating in pair %s-%s', self.pair[0], self.pair[1])
+            self.reply(message_id, {'code': 500, 'explanation': 'internal error'})
+        self.clean_pairs()
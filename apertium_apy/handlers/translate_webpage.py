@@ -10,14 +10,7 @@ from tornado import gen
 from tornado import httpclient
 from typing import Optional  # noqa: F401
 
-
-try:
-    import chardet
-except ImportError:             # type should be Optional[Module] but there's no module in mypy? TODO
-    chardet = None              # type: ignore
-
-
-from apertium_apy.utils import translation
+from apertium_apy.utils import optional_import, translation
 from apertium_apy.handlers.translate import TranslateHandler
 
 
@@ -53,6 +46,7 @@ class TranslateWebpageHandler(TranslateHandler):
 
     def html_to_text(self, page, url):
         encoding = 'utf-8'
+        chardet = optional_import('chardet')
         if chardet:
             encoding = chardet.detect(page).get('encoding', 'utf-8') or encoding
         base = urlparse(url)
@@ -128,6 +122,15 @@ class TranslateWebpageHandler(TranslateHandler):
             if os.path.exists(origpath):
                 return open(origpath, 'r').read()
 
+    async def translate_page(self, pair, to_translate, mode_path, prefs):
+        pipeline = self.get_segmenting_pipeline(pair)
+        if pipeline is not None:
+            deformat, reformat = self.formatters('apertium-deshtml', 'apertium-rehtml-noent')
+            translated = await self.translate_segments(pair, pipeline, to_translate, deformat, reformat, prefs)
+            # Like translate_html_mark_headings, which runs without unknown marks:
+            return re.sub(self.unknown_mark_re, r'\1', translated)
+        return await translation.translate_html_mark_headings(to_translate, mode_path, prefs)
+
     @gen.coroutine
     def get(self):
         pair = self.get_pair_or_error(self.get_argument('langpair'),
@@ -181,7 +184,7 @@ class TranslateWebpageHandler(TranslateHandler):
                 self.send_error(503, explanation="Couldn't decode (or detect charset/encoding of) {}".format(url))
                 return
             before = self.log_before_translation()
-            translated = yield translation.translate_html_mark_headings(to_translate, mode_path, prefs)
+            translated = yield self.translate_page(pair, to_translate, mode_path, prefs)
             self.log_after_translation(before, len(to_translate))
             self.set_cached(pair, url, translated, to_translate)
         self.send_response({
@@ -194,6 +197,6 @@ class TranslateWebpageHandler(TranslateHandler):
         retranslate = self.retranslate_cache(pair, url, cached)
         if got304 and retranslate is not None:
             logging.info('Retranslating {}'.format(url))
-            translated = yield translation.translate_html_mark_headings(retranslate, mode_path, prefs)
+            translated = yield self.translate_page(pair, retranslate, mode_path, prefs)
             logging.info('Done retranslating {}'.format(url))
             self.set_cached(pair, url, translated, retranslate)
@@ -1,15 +1,12 @@
+import json
 import re
 import os
 import logging
-try:
-    from lxml import etree
-except ImportError:
-    etree = None
 
-from apertium_apy.utils import to_alpha3_code
+from apertium_apy.utils import optional_import, to_alpha3_code
 
 if False:
-    from typing import Dict, List, Tuple  # noqa: F401
+    from typing import Dict, Iterable, List, Tuple  # noqa: F401
 
 
 def is_loop(dirpath, rootpath, real_root=None):
@@ -32,65 +29,169 @@ def is_loop(dirpath, rootpath, real_root=None):
         return False
 
 
-def search_path(rootpath, include_pairs=True, verbosity=1):
-    lang_code = r'[a-z]{2,3}(?:_[A-Za-z0-9]+)*'
-    type_re = {
-        'pair': re.compile(r'({0})-({0})\.mode'.format(lang_code)),
-        'analyzer': re.compile(r'(({0}(-{0})?)-(an)?mor(ph)?)\.mode'.format(lang_code)),
-        'generator': re.compile(r'(({0}(-{0})?)-gener[A-z]*)\.mode'.format(lang_code)),
-        'tagger': re.compile(r'(({0}(-{0})?)-tagger)\.mode'.format(lang_code)),
-        'spell': re.compile(r'(({0}(-{0})?)-spell)\.mode'.format(lang_code)),
-        'tokenise': re.compile(r'(({0}(-{0})?)-tokenise)\.mode'.format(lang_code)),
-        'guesser': re.compile(r'(({0}(-{0})?)-guess(er)?)\.mode'.format(lang_code)),
-        'bilsearch': re.compile(r'({0})-({0})-bilsearch\.mode'.format(lang_code)),
-        'billookup': re.compile(r'({0})-({0})-billookup\.mode'.format(lang_code)),
-        'embeddings': re.compile(r'({0})-({0})-embeddings\.mode'.format(lang_code)),
-    }
-    modes = {
-        'pair': [],
-        'analyzer': [],
-        'generator': [],
-        'tagger': [],
-        'spell': [],
-        'tokenise': [],
-        'guesser': [],
-        'bilsearch': [],
-        'billookup': [],
-        'embeddings': [],
-    }  # type: Dict[str, List[Tuple[str, str, str]]]
+LANG_CODE = r'[a-z]{2,3}(?:_[A-Za-z0-9]+)*'
+TYPE_RE = {
+    'pair': re.compile(r'({0})-({0})\.mode'.format(LANG_CODE)),
+    'analyzer': re.compile(r'(({0}(-{0})?)-(an)?mor(ph)?)\.mode'.format(LANG_CODE)),
+    'generator': re.compile(r'(({0}(-{0})?)-gener[A-z]*)\.mode'.format(LANG_CODE)),
+    'tagger': re.compile(r'(({0}(-{0})?)-tagger)\.mode'.format(LANG_CODE)),
+    'spell': re.compile(r'(({0}(-{0})?)-spell)\.mode'.format(LANG_CODE)),
+    'tokenise': re.compile(r'(({0}(-{0})?)-tokenise)\.mode'.format(LANG_CODE)),
+    'guesser': re.compile(r'(({0}(-{0})?)-guess(er)?)\.mode'.format(LANG_CODE)),
+    'bilsearch': re.compile(r'({0})-({0})-bilsearch\.mode'.format(LANG_CODE)),
+    'billookup': re.compile(r'({0})-({0})-billookup\.mode'.format(LANG_CODE)),
+    'embeddings': re.compile(r'({0})-({0})-embeddings\.mode'.format(LANG_CODE)),
+}
+
+
+def classify_modes(dirpath, filenames):
+    """The (mtype, mode) of each mode file in dirpath."""
+    found = []  # type: List[Tuple[str, Tuple[str, str, str]]]
+    for filename in [f for f in filenames if f.endswith('.mode')]:
+        for mtype, regex in TYPE_RE.items():
+            m = regex.match(filename)
+            if m:
+                if mtype == 'bilsearch' or mtype == 'billookup' or mtype == 'embeddings':
+                    lang_src = to_alpha3_code(m.group(1))
+                    lang_trg = to_alpha3_code(m.group(2))
+                    lang_pair = f'{lang_src}-{lang_trg}'
+                    modename = f'{lang_pair}-{mtype}'
+                    dir_of_modes = os.path.dirname(dirpath)
+                    found.append((mtype, (dir_of_modes, modename, lang_pair)))
+                elif mtype != 'pair':
+                    modename = m.group(1)  # e.g. en-es-anmorph
+                    langlist = [to_alpha3_code(x) for x in m.group(2).split('-')]
+                    lang_pair = '-'.join(langlist)  # e.g. en-es
+                    dir_of_modes = os.path.dirname(dirpath)
+                    found.append((mtype, (dir_of_modes, modename, lang_pair)))
+                else:
+                    lang_src = m.group(1)
+                    lang_trg = m.group(2)
+                    found.append((mtype, (os.path.join(dirpath, filename),
+                                          to_alpha3_code(lang_src),
+                                          to_alpha3_code(lang_trg))))
+    return found
+
+
+class SearchIndex(object):
+    """What search_path and search_prefs found last time, saved as
+    JSON in path.
+
+    A directory is only listed again if its mtime changed, i.e. if
+    files or subdirectories were added, removed or renamed in it; the
+    others are just stat'ed on the way down to their subdirectories.
+    Preferences files are only parsed again if their own mtime changed.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        # dirpath: {'mtime': …, 'subdirs': [name], 'modes': [[mtype, mode]]}
+        self.dirs = {}  # type: Dict[str, Dict]
+        # prefs file path: {'mtime': …, 'prefs': {…}}
+        self.prefs = {}  # type: Dict[str, Dict]
+        self.seen_dirs = {}  # type: Dict[str, Dict]
+        self.seen_prefs = {}  # type: Dict[str, Dict]
+        self.relisted = 0
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get('version') == self.version:
+                self.dirs = saved['dirs']
+                self.prefs = saved['prefs']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning('Ignoring unreadable mode search index %s: %s', self.path, e)
+        return self
+
+    def save(self):
+        """Keep only what this run looked at, so uninstalled pairs are
+        forgotten."""
+        if not self.changed and set(self.seen_dirs) == set(self.dirs) and set(self.seen_prefs) == set(self.prefs):
+            return
+        saved = {'version': self.version, 'dirs': self.seen_dirs, 'prefs': self.seen_prefs}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('Could not save mode search index %s: %s', self.path, e)
+        logging.info('Mode search index: listed %d of %d directories again', self.relisted, len(self.seen_dirs))
+
+    def list_dir(self, dirpath):
+        """Like one step of os.walk(followlinks=True): dirpath's
+        subdirectories and modes, or None if it's gone."""
+        try:
+            # Before listing, so changes made meanwhile show next time:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return None
+        entry = self.dirs.get(dirpath)
+        if entry is None or entry['mtime'] != mtime:
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError:
+                return None
+            subdirs = sorted(e.name for e in entries if e.is_dir())
+            files = [e.name for e in entries if not e.is_dir()]
+            entry = {'mtime': mtime, 'subdirs': subdirs,
+                     'modes': [list(found) for found in classify_modes(dirpath, files)]}
+            self.relisted += 1
+            self.changed = True
+        self.seen_dirs[dirpath] = entry
+        return entry
+
+    def parse_prefs(self, fp):
+        mtime = os.stat(fp).st_mtime
+        entry = self.prefs.get(fp)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'prefs': parse_prefs(fp)}
+            self.changed = True
+        self.seen_prefs[fp] = entry
+        return entry['prefs']
 
-    real_root = os.path.abspath(os.path.realpath(rootpath))
 
-    for dirpath, dirnames, files in os.walk(rootpath, followlinks=True):
+def walk_modes(rootpath, index):
+    """(mtype, mode) of every mode file below rootpath, following
+    symlinks except those back up the tree."""
+    real_root = os.path.abspath(os.path.realpath(rootpath))
+    stack = [rootpath]
+    while stack:
+        dirpath = stack.pop()
         if is_loop(dirpath, rootpath, real_root):
-            dirnames[:] = []
             continue
-        for filename in [f for f in files if f.endswith('.mode')]:
-            for mtype, regex in type_re.items():
-                m = regex.match(filename)
-                if m:
-                    if mtype == 'bilsearch' or mtype == 'billookup' or mtype == 'embeddings':
-                        lang_src = to_alpha3_code(m.group(1))
-                        lang_trg = to_alpha3_code(m.group(2))
-                        lang_pair = f'{lang_src}-{lang_trg}'
-                        modename = f'{lang_pair}-{mtype}'
-                        dir_of_modes = os.path.dirname(dirpath)
-                        mode = (dir_of_modes, modename, lang_pair)
-                        modes[mtype].append(mode)
-                    elif mtype != 'pair':
-                        modename = m.group(1)  # e.g. en-es-anmorph
-                        langlist = [to_alpha3_code(x) for x in m.group(2).split('-')]
-                        lang_pair = '-'.join(langlist)  # e.g. en-es
-                        dir_of_modes = os.path.dirname(dirpath)
-                        mode = (dir_of_modes, modename, lang_pair)
-                        modes[mtype].append(mode)
-                    elif include_pairs:
-                        lang_src = m.group(1)
-                        lang_trg = m.group(2)
-                        mode = (os.path.join(dirpath, filename),
-                                to_alpha3_code(lang_src),
-                                to_alpha3_code(lang_trg))
-                        modes[mtype].append(mode)
+        entry = index.list_dir(dirpath)
+        if entry is None:
+            continue
+        for mtype, mode in entry['modes']:
+            yield mtype, tuple(mode)
+        stack.extend(os.path.join(dirpath, subdir) for subdir in reversed(entry['subdirs']))
+
+
+def search_path(rootpath, include_pairs=True, verbosity=1, index=None):
+    modes = {mtype: [] for mtype in TYPE_RE}  # type: Dict[str, List[Tuple[str, str, str]]]
+
+    if index is not None:
+        found = walk_modes(rootpath, index)  # type: Iterable[Tuple[str, Tuple[str, str, str]]]
+    else:
+        found = []
+        real_root = os.path.abspath(os.path.realpath(rootpath))
+        for dirpath, dirnames, files in os.walk(rootpath, followlinks=True):
+            if is_loop(dirpath, rootpath, real_root):
+                dirnames[:] = []
+                continue
+            found += classify_modes(dirpath, files)
+
+    for mtype, mode in found:
+        if mtype != 'pair' or include_pairs:
+            modes[mtype].append(mode)
 
     if verbosity > 1:
         _log_modes(modes)
@@ -98,8 +199,16 @@ def search_path(rootpath, include_pairs=True, verbosity=1):
     return modes
 
 
-def search_prefs(rootpath):
-    if etree is None:
+def parse_prefs(fp):
+    etree = optional_import('lxml.etree')
+    return {pref.get('id'): {dsc.get('lang'): dsc.text
+                             for dsc in pref.xpath('./description')}
+            for pref
+            in etree.parse(fp).xpath('//preference')}
+
+
+def search_prefs(rootpath, index=None):
+    if optional_import('lxml.etree') is None:
         logging.warning('Please install python3-lxml to enable /pairprefs endpoint')
         return
     real_root = os.path.abspath(os.path.realpath(rootpath))
@@ -111,10 +220,7 @@ def search_prefs(rootpath):
         fp = os.path.join(prefspath, f)
         try:
             mode = re.sub(r'[.]xml$', '', f)
-            pairprefs[mode] = {pref.get('id'): {dsc.get('lang'): dsc.text
-                               for dsc in pref.xpath('./description')}
-                               for pref
-                               in etree.parse(fp).xpath('//preference')}
+            pairprefs[mode] = index.parse_prefs(fp) if index is not None else parse_prefs(fp)
         except Exception:
             logging.warning('Exception on parsing preferences file {}'.format(fp))
     return pairprefs
@@ -0,0 +1,176 @@
+"""Sentence translations kept on disk, shared by all server processes.
+
+Backs the in-memory segment caches of --segment-cache-size, so that
+translations survive restarts and are shared between -j workers.
+Entries are tagged with the mtime of the pair's mode file, so
+upgrading (reinstalling) a pair leaves its old entries unused; they're
+deleted on the next start-up.
+"""
+
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime
+from hashlib import sha1
+
+from tornado.ioloop import IOLoop
+
+from apertium_apy.missingdb import timedelta_to_milliseconds
+
+if False:
+    from typing import Dict, Tuple  # noqa: F401
+
+
+def segment_hash(key):
+    """key is (prefs, deformatted segment)."""
+    return sha1('\0'.join(key).encode('utf-8')).digest()
+
+
+class TranslationMemory(object):
+    # Write buffered translations once we have this many, or every so often:
+    max_pending = 1000
+    commit_interval_secs = 10
+    # SQLite limits the number of parameters to a query:
+    max_lookup = 500
+
+    def __init__(self, db_path):
+        # Held while using the connection, which may be from an executor thread:
+        self.lock = threading.RLock()
+        # Held only briefly, around pending and committing, so the IOLoop
+        # never waits for the disk:
+        self.pending_lock = threading.Lock()
+        # Connect lazily, so each forked process gets its own connection:
+        self.conn = None
+        self.db_path = db_path
+        self.pending = {}  # type: Dict[Tuple[str, float, bytes], str]
+        # What commit is writing right now, still readable meanwhile:
+        self.committing = {}  # type: Dict[Tuple[str, float, bytes], str]
+        self.commit_queued = False
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if not self.conn:
+            self.conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            with closing(self.conn.cursor()) as c:
+                # WAL lets the other processes read while one of us writes:
+                c.execute('PRAGMA journal_mode = WAL')
+                c.execute('PRAGMA synchronous = NORMAL')
+                c.execute('CREATE TABLE IF NOT EXISTS segments ('
+                          'pair TEXT, version REAL, hash BLOB, translation TEXT, '
+                          'PRIMARY KEY (pair, hash)) WITHOUT ROWID')
+        return self.conn
+
+    def forget_other_versions(self, versions):
+        """Delete entries of pairs whose mode file has changed since
+        they were stored; versions is {'eng-spa': mtime}."""
+        with self.lock:
+            conn = self.connect()
+            with closing(conn.cursor()) as c:
+                c.executemany('DELETE FROM segments WHERE pair = ? AND version != ?', versions.items())
+                deleted = c.rowcount
+            conn.commit()
+        if deleted > 0:
+            logging.info('Deleted %d outdated translations from %s', deleted, self.db_path)
+
+    def get_many(self, pair, version, keys):
+        """The stored translations of whichever of keys we have. Blocks
+        on the database, so call it from an executor when serving."""
+        found = {}
+        by_hash = {}
+        with self.pending_lock:
+            for key in keys:
+                k = (pair, version, segment_hash(key))
+                buffered = self.pending.get(k, self.committing.get(k))
+                if buffered is not None:
+                    found[key] = buffered
+                else:
+                    by_hash[k[2]] = key
+        hashes = list(by_hash)
+        with self.lock:
+            conn = self.connect()
+            for i in range(0, len(hashes), self.max_lookup):
+                batch = hashes[i:i + self.max_lookup]
+                with closing(conn.cursor()) as c:
+                    c.execute('SELECT hash, translation FROM segments WHERE pair = ? AND version = ? AND hash IN (%s)'
+                              % ','.join('?' * len(batch)), [pair, version] + batch)
+                    for hsh, translation in c.fetchall():
+                        found[by_hash[hsh]] = translation
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, pair, version, key, translation):
+        with self.pending_lock:
+            self.pending[(pair, version, segment_hash(key))] = translation
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.commit_in_background()
+
+    def commit_in_background(self):
+        """Run commit in the IOLoop's executor, unless one is already
+        queued there."""
+        if self.commit_queued or not self.pending:
+            return
+        self.commit_queued = True
+        loop = IOLoop.current()
+        loop.add_future(loop.run_in_executor(None, self.commit), lambda future: future.result())
+
+    def commit(self):
+        with self.lock:
+            self.commit_queued = False
+            with self.pending_lock:
+                if not self.pending:
+                    return
+                self.committing, self.pending = self.pending, {}
+            time_before = datetime.now()
+            try:
+                conn = self.connect()
+                with closing(conn.cursor()) as c:
+                    c.executemany('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)',
+                                  ((pair, version, hsh, translation)
+                                   for (pair, version, hsh), translation in self.committing.items()))
+                conn.commit()
+                ms = timedelta_to_milliseconds(datetime.now() - time_before)
+                logging.info('\tSaving %s translations to the translation memory (%s ms)', len(self.committing), ms)
+            finally:
+                with self.pending_lock:
+                    self.committing = {}
+
+    def close_db(self):
+        if self.conn:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+    def to_json(self):
+        return {'hits': self.hits, 'misses': self.misses, 'pending': len(self.pending)}
+
+
+class TieredSegmentCache(object):
+    """A pair's in-memory segment cache, falling back to the translation
+    memory; has the get_many/put that FlushingPipeline.translate_segments
+    wants, though get_many is a coroutine here, reading the translation
+    memory in the IOLoop's executor."""
+
+    def __init__(self, cache, memory, pair, version):
+        self.cache = cache
+        self.memory = memory
+        self.pair = pair
+        self.version = version
+
+    async def get_many(self, keys):
+        found = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            stored = await IOLoop.current().run_in_executor(None, self.memory.get_many,
+                                                            self.pair, self.version, missing)
+            for key, translation in stored.items():
+                self.cache.put(key, translation)
+            found.update(stored)
+        return found
+
+    def put(self, key, translation):
+        self.cache.put(key, translation)
+        self.memory.put(self.pair, self.version, key, translation)
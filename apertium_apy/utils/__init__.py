@@ -1,13 +1,18 @@
+import importlib
 import logging
 import re
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 from threading import Thread
 
 from tornado import gen
 from tornado.process import Subprocess
 
 from apertium_apy.missingdb import timedelta_to_milliseconds
+from apertium_apy.utils.cache import LRUCache
+
+if False:
+    from typing import Dict  # noqa: F401
 
 iso639_codes = {'abk': 'ab', 'aar': 'aa', 'afr': 'af', 'aka': 'ak', 'sqi': 'sq', 'amh': 'am', 'ara': 'ar', 'arg': 'an', 'hye': 'hy', 'asm': 'as', 'ava': 'av', 'ave': 'ae', 'aym': 'ay', 'aze': 'az', 'bam': 'bm', 'bak': 'ba', 'eus': 'eu', 'bel': 'be', 'ben': 'bn', 'bih': 'bh', 'bis': 'bi', 'bos': 'bs', 'bre': 'br', 'bul': 'bg', 'mya': 'my', 'cat': 'ca', 'cha': 'ch', 'che': 'ce', 'nya': 'ny', 'zho': 'zh', 'chv': 'cv', 'cor': 'kw', 'cos': 'co', 'cre': 'cr', 'hrv': 'hr', 'ces': 'cs', 'dan': 'da', 'div': 'dv', 'nld': 'nl', 'dzo': 'dz', 'eng': 'en', 'epo': 'eo', 'est': 'et', 'ewe': 'ee', 'fao': 'fo', 'fij': 'fj', 'fin': 'fi', 'fra': 'fr', 'ful': 'ff', 'glg': 'gl', 'kat': 'ka', 'deu': 'de', 'ell': 'el', 'grn': 'gn', 'guj': 'gu', 'hat': 'ht', 'hau': 'ha', 'heb': 'he', 'her': 'hz', 'hin': 'hi', 'hmo': 'ho', 'hun': 'hu', 'ina': 'ia', 'ind': 'id', 'ile': 'ie', 'gle': 'ga', 'ibo': 'ig', 'ipk': 'ik', 'ido': 'io', 'isl': 'is', 'ita': 'it', 'iku': 'iu', 'jpn': 'ja', 'jav': 'jv', 'kal': 'kl', 'kan': 'kn', 'kau': 'kr', 'kas': 'ks', 'kaz': 'kk', 'khm': 'km', 'kik': 'ki', 'kin': 'rw', 'kir': 'ky', 'kom': 'kv', 'kon': 'kg', 'kor': 'ko', 'kur': 'ku', 'kua': 'kj', 'lat': 'la', 'ltz': 'lb', 'lug': 'lg', 'lim': 'li', 'lin': 'ln', 'lao': 'lo', 'lit': 'lt', 'lub': 'lu', 'lav': 'lv', 'glv': 'gv', 'mkd': 'mk', 'mlg': 'mg', 'msa': 'ms', 'mal': 'ml', 'mlt': 'mt', 'mri': 'mi', 'mar': 'mr', 'mah': 'mh', 'mon': 'mn', 'nau': 'na', 'nav': 'nv', 'nob': 'nb', 'nde': 'nd', 'nep': 'ne', 'ndo': 'ng', 'nno': 'nn', 'nor': 'no', 'iii': 'ii', 'nbl': 'nr', 'oci': 'oc', 'oji': 'oj', 'chu': 'cu', 'orm': 'om', 'ori': 'or', 'oss': 'os', 'pan': 'pa', 'pli': 'pi', 'fas': 'fa', 'pol': 'pl', 'pus': 'ps', 'por': 'pt', 'que': 'qu', 'roh': 'rm', 'run': 'rn', 'ron': 'ro', 'rus': 'ru', 'san': 'sa', 'srd': 'sc', 'snd': 'sd', 'sme': 'se', 'smo': 'sm', 'sag': 'sg', 'srp': 'sr', 'gla': 'gd', 'sna': 'sn', 'sin': 'si', 'slk': 'sk', 'slv': 'sl', 'som': 'so', 'sot': 'st', 'azb': 'az', 'spa': 'es', 'sun': 'su', 'swa': 'sw', 'ssw': 'ss', 'swe': 'sv', 'tam': 'ta', 'tel': 'te', 'tgk': 'tg', 'tha': 'th', 'tir': 'ti', 'bod': 'bo', 'tuk': 'tk', 'tgl': 'tl', 'tsn': 'tn', 'ton': 'to', 'tur': 'tr', 'tso': 'ts', 'tat': 'tt', 'twi': 'tw', 'tah': 'ty', 'uig': 'ug', 'ukr': 'uk', 'urd': 'ur', 'uzb': 'uz', 'ven': 've', 'vie': 'vi', 'vol': 'vo', 'wln': 'wa', 'cym': 'cy', 'wol': 'wo', 'fry': 'fy', 'xho': 'xh', 'yid': 'yi', 'yor': 'yo', 'zha': 'za', 'zul': 'zu', 'hbs': 'sh', 'arg': 'an', 'pes': 'fa'}  # noqa: E501
 """
@@ -18,6 +23,17 @@ iso639_codes = {'abk': 'ab', 'aar': 'aa', 'afr': 'af', 'aka': 'ak', 'sqi': 'sq',
 """
 
 
+@lru_cache(maxsize=None)
+def optional_import(name):
+    """The module name, or None if it isn't installed. Imported the
+    first time it's needed rather than at start-up, since some (e.g.
+    fasttext, which pulls in numpy) take a while."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
 def run_async_thread(func):
     @wraps(func)
     def async_func(*args, **kwargs):
@@ -36,8 +52,10 @@ def to_alpha2_code(code):
         return iso639_codes[code] if code in iso639_codes else code
 
 
+iso639_codes_inverse = {v: k for k, v in iso639_codes.items()}
+
+
 def to_alpha3_code(code):
-    iso639_codes_inverse = {v: k for k, v in iso639_codes.items()}
     if '_' in code:
         code, variant = code.split('_', 1)
         return '%s_%s' % ((iso639_codes_inverse[code], variant) if code in iso639_codes_inverse else (code, variant))
@@ -65,6 +83,55 @@ def to_fallback_code(code, installed_modes):
     return None
 
 
+def mode_spellings(mode):
+    """Every way of writing mode (e.g. 'eng_US-spa' or 'eng') with
+    alpha-2 and alpha-3 codes."""
+    spellings = ['']
+    for i, code in enumerate(mode.split('-', 1)):
+        alternatives = {code, to_alpha2_code(code)}
+        spellings = [spelling + ('-' if i > 0 else '') + alternative
+                     for spelling in spellings
+                     for alternative in alternatives]
+    return spellings
+
+
+class ModeIndex(object):
+    """Resolves a language or pair written any way we accept (alpha-2
+    or alpha-3 codes, with or without variants) to the installed mode
+    to use for it, see resolve."""
+
+    # How many other spellings (mostly variants that fall back) to remember:
+    max_fallbacks = 10000
+
+    def __init__(self, installed_modes):
+        self.modes = installed_modes
+        self.spellings = {}  # type: Dict[str, str]
+        for mode in installed_modes:
+            for spelling in mode_spellings(mode):
+                # Some alpha-2 codes stand for several installed alpha-3
+                # ones (fa for fas and pes); to_alpha3_code's one wins:
+                if spelling not in self.spellings or self.to_alpha3(spelling) == mode:
+                    self.spellings[spelling] = mode
+        for mode in installed_modes:
+            self.spellings[mode] = mode
+        self.fallbacks = LRUCache(self.max_fallbacks)
+
+    @staticmethod
+    def to_alpha3(code):
+        return '-'.join(map(to_alpha3_code, code.split('-', 1)))
+
+    def resolve(self, code):
+        """The installed mode for code, falling back from variants to
+        less specific modes (e.g. from eng_US-spa to eng-spa) if need
+        be; or code in alpha-3 if nothing is installed for it."""
+        mode = self.spellings.get(code) or self.fallbacks.get(code)
+        if mode is None:
+            alpha3 = self.to_alpha3(code)
+            mode = self.spellings.get(alpha3) or to_fallback_code(alpha3, self.modes) or alpha3
+            self.fallbacks.put(code, mode)
+        return mode
+
+
 def remove_dot_from_deformat(query, analyses):
     """When using the txt format, a dot is added at EOF (also, double line
     breaks) if the last part of the query isn't itself a dot"""
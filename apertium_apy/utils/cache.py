@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A dict that forgets its least recently used entries once they
+    add up to more than max_size, as measured by sizeof (by default,
+    each entry counts as 1)."""
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda key, value: 1)
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        else:
+            self.misses += 1
+            return default
+
+    def get_many(self, keys):
+        """A dict of those keys we have, with their values."""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+        if size > self.max_size:
+            return
+        self.pop(key)
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.size -= self.sizeof(old_key, old_value)
+
+    def pop(self, key):
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.size -= self.sizeof(key, value)
+            return value
+
+    def evict(self, predicate):
+        """Forget every entry whose key matches predicate."""
+        for key in [key for key in self.entries if predicate(key)]:
+            self.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
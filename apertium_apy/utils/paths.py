@@ -0,0 +1,96 @@
+"""Cheapest chains of installed pairs between two languages, for
+/translateChain and /list?q=pairs&src=."""
+
+import heapq
+import math
+
+if False:
+    from typing import Dict, List, Tuple  # noqa: F401
+
+
+def parse_pair_weights(spec):
+    """Parse e.g. 'eng-spa=2,spa-cat=0.5' into
+    {('eng', 'spa'): 2.0, ('spa', 'cat'): 0.5}."""
+    weights = {}  # type: Dict[Tuple[str, str], float]
+    for item in filter(None, spec.split(',')):
+        try:
+            pair, weight = item.strip().split('=')
+            l1, l2 = pair.split('-')
+            weights[(l1, l2)] = float(weight)
+        except ValueError:
+            raise ValueError('Expected pair=weight, e.g. eng-spa=2, got %r' % item)
+        if not weights[(l1, l2)] > 0:
+            raise ValueError('Weights have to be positive, got %r' % item)
+    return weights
+
+
+def slowness(rates):
+    """{pair: chars per busy sec} to {pair: extra weight}: 0 for the fastest
+    pair, 1 for one half as fast, 2 for one a quarter as fast, …"""
+    fastest = max(rates.values(), default=0)
+    return {pair: math.log2(fastest / rate) if rate > 0 else 0.0
+            for pair, rate in rates.items()}
+
+
+class PathIndex(object):
+    """Lowest-weight paths over the graph of pairs, computed with
+    Dijkstra from a source language the first time it's asked about.
+
+    A pair's weight is its configured weight (default 1) plus its
+    slowness, so a chain avoids a pair when going around it costs
+    fewer hops than the pair is slow."""
+
+    # How often to look at measured speeds again:
+    refresh_secs = 60
+
+    def __init__(self, pairs_graph, weights=None):
+        self.pairs_graph = pairs_graph    # {'eng': ['spa', 'fra']}
+        self.weights = weights or {}
+        self.slowness = {}  # type: Dict[Tuple[str, str], float]
+        # source: {target: path}
+        self.paths = {}  # type: Dict[str, Dict[str, List[str]]]
+
+    def weight(self, l1, l2):
+        return self.weights.get((l1, l2), 1.0) + self.slowness.get((l1, l2), 0.0)
+
+    def set_rates(self, rates, resolution=0.25):
+        """Take measured pair speeds (see PairLoad.speed) into account;
+        the paths are only recomputed if some weight moved by at least
+        resolution."""
+        new = slowness(rates)
+        pairs = set(new) | set(self.slowness)
+        if any(abs(new.get(pair, 0.0) - self.slowness.get(pair, 0.0)) >= resolution for pair in pairs):
+            self.slowness = new
+            self.paths.clear()
+
+    def paths_from(self, src):
+        if src not in self.paths:
+            self.paths[src] = self.dijkstra(src)
+        return self.paths[src]
+
+    def path(self, src, trg):
+        return self.paths_from(src).get(trg)
+
+    def dijkstra(self, src):
+        dists = {src: 0.0}
+        prevs = {}  # type: Dict[str, str]
+        heap = [(0.0, src)]
+        done = set()
+        while heap:
+            dist, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            for v in self.pairs_graph.get(u, []):
+                other = dist + self.weight(u, v)
+                if v not in done and other < dists.get(v, math.inf):
+                    dists[v] = other
+                    prevs[v] = u
+                    heapq.heappush(heap, (other, v))
+        paths = {}
+        for trg in prevs:
+            path = [trg]
+            while path[-1] != src:
+                path.append(prevs[path[-1]])
+            paths[trg] = list(reversed(path))
+        return paths
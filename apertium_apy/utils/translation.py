@@ -1,8 +1,10 @@
+import fcntl
 import logging
 import os
 import re
-from collections import namedtuple
-from contextlib import contextmanager
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, ExitStack
+from inspect import isawaitable
 from select import PIPE_BUF
 from subprocess import Popen, PIPE
 from time import time
@@ -13,9 +15,11 @@ import tornado.iostream
 import tornado.locks as locks
 import tornado.process
 from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 if False:
-    from typing import List  # noqa: F401
+    from typing import Deque, Dict, List, Optional, Tuple  # noqa: F401
 
 
 class Pipeline(object):
@@ -31,6 +35,34 @@ class Pipeline(object):
         self.last_usage = 0.0
         self.use_count = 0
         self.stuck = False
+        # Load figures, read by the autoscaler:
+        self.waiting = 0        # requests currently waiting to get in
+        self.waited = 0         # requests that have got in …
+        self.wait_secs = 0.0    # … and how long they waited in total
+        self.chars = 0          # chars translated
+        self.busy_secs = 0.0    # time spent with work in the pipeline …
+        self.busy_since = None  # type: Optional[float]
+
+    def resources(self):
+        """Per-process memory and CPU use; see FlushingPipeline."""
+        return []
+
+    def rss(self):
+        return sum(r['rss'] for r in self.resources())
+
+    def cpu_secs(self):
+        return sum(r['cpuSecs'] for r in self.resources())
+
+    @contextmanager
+    def queued(self):
+        self.waiting += 1
+        started = time()
+        try:
+            yield
+        finally:
+            self.waiting -= 1
+            self.waited += 1
+            self.wait_secs += time() - started
 
     @contextmanager
     def use(self):
@@ -43,18 +75,149 @@ class Pipeline(object):
             self.last_usage = time()
             self.use_count += 1
 
+    def busy_time(self):
+        """Seconds this pipeline has had work in it, so chars per busy
+        second is how fast it translates, however much traffic it gets."""
+        if self.busy_since is not None:
+            return self.busy_secs + time() - self.busy_since
+        return self.busy_secs
+
+    def start_busy(self):
+        if self.busy_since is None:
+            self.busy_since = time()
+
+    def stop_busy(self):
+        if self.busy_since is not None:
+            self.busy_secs += time() - self.busy_since
+            self.busy_since = None
+
     def __lt__(self, other):
         return self.users < other.users
 
-    @gen.coroutine
-    def translate(self, to_translate, nosplit, deformat, reformat, prefs):
+    async def translate(self, to_translate, nosplit, deformat, reformat, prefs, helpers):
         raise Exception('Not implemented, subclass me!')
 
 
+class FairScheduler(object):
+    """Hands out slots (chunks in flight on a pipeline) to waiting
+    sends by deficit round-robin on bytes: each key with chunks
+    waiting gets quantum bytes of credit per round, so a long document
+    and a one-sentence request take turns instead of the document's
+    chunks all going first.
+
+    A send with key None (e.g. the first chunk of a request) of at
+    most quantum bytes goes on a fast path ahead of the rounds, though
+    never more than max_fast times in a row.
+    """
+    quantum = PIPE_BUF
+    max_fast = 4
+
+    def __init__(self, slots):
+        self.free = slots
+        self.fast = deque()  # type: Deque[Future]
+        self.fast_streak = 0
+        # key: waiting (size, Future)s, in round-robin order
+        self.queues = OrderedDict()  # type: OrderedDict
+        self.deficits = {}  # type: Dict
+        # Whether the key at the head of queues has had its quantum this round:
+        self.credited = False
+
+    def waiting(self):
+        return len(self.fast) + sum(len(queue) for queue in self.queues.values())
+
+    async def acquire(self, key, size):
+        if self.free > 0 and not self.fast and not self.queues:
+            self.free -= 1
+            return
+        waiter = Future()  # type: Future
+        if key is None and size <= self.quantum:
+            self.fast.append(waiter)
+        else:
+            if key is None:
+                key = waiter
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.deficits[key] = 0
+            self.queues[key].append((size, waiter))
+        self.dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            self.discard(key, waiter)
+            raise
+
+    def discard(self, key, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # We were granted a slot but won't use it
+            self.release()
+        elif waiter in self.fast:
+            self.fast.remove(waiter)
+        elif key in self.queues:
+            queue = self.queues[key]
+            for item in queue:
+                if item[1] is waiter:
+                    queue.remove(item)
+                    break
+            if not queue:
+                self.drop(key)
+
+    def drop(self, key):
+        if self.credited and next(iter(self.queues)) is key:
+            self.credited = False
+        del self.queues[key]
+        del self.deficits[key]
+
+    def release(self):
+        self.free += 1
+        self.dispatch()
+
+    def grant(self, waiter):
+        if not waiter.done():   # else it was cancelled, and discard will tidy up
+            self.free -= 1
+            waiter.set_result(None)
+
+    def dispatch(self):
+        while self.free > 0 and (self.fast or self.queues):
+            if self.fast and (self.fast_streak < self.max_fast or not self.queues):
+                self.fast_streak += 1
+                self.grant(self.fast.popleft())
+                continue
+            self.fast_streak = 0
+            key, queue = next(iter(self.queues.items()))
+            if not self.credited:
+                self.deficits[key] += self.quantum
+                self.credited = True
+            size, waiter = queue[0]
+            if size <= self.deficits[key]:
+                queue.popleft()
+                self.deficits[key] -= size
+                if not queue:
+                    self.drop(key)
+                self.grant(waiter)
+            else:
+                self.queues.move_to_end(key)
+                self.credited = False
+
+
 class FlushingPipeline(Pipeline):
-    def __init__(self, timeout, commands, *args, **kwargs):
+    def __init__(self, timeout, commands, max_inflight=1, pipe_size=0, *args, **kwargs):
         self.timeout = timeout
-        self.inpipe, self.outpipe = start_pipeline(commands)
+        procs = start_pipeline_procs(commands)
+        self.inpipe, self.outpipe = procs[0], procs[-1]
+        self.procs = list(zip((os.path.basename(cmd[0]) for cmd in commands), procs))
+        self.sampled = []  # type: List[Dict]
+        self.sampled_at = 0.0
+        # What the pipes can hold, if we asked for something other than the default:
+        self.pipe_capacity = set_pipe_sizes(procs, pipe_size) if pipe_size else None
+        # Chunks that have been written to inpipe but not yet read
+        # back from outpipe, in the order their output will appear:
+        self.inflight = deque()  # type: Deque[Tuple[str, Future, float]]
+        # With max_inflight > 1, chunks from several requests are
+        # queued up in the pipeline at once, so every stage has work
+        # to do; outputs are handed back by read_outputs. Who gets to
+        # go next is up to the scheduler.
+        self.scheduler = FairScheduler(max_inflight)
+        self.reading = False
         super().__init__(*args, **kwargs)
 
     def __del__(self):
@@ -65,17 +228,248 @@ class FlushingPipeline(Pipeline):
         # but only completely removed after a second request to the
         # server – why?
 
-    @gen.coroutine
-    def translate(self, to_translate, nosplit=False, deformat=True, reformat=True, prefs=''):
+    # /proc is read at most this often per pipeline:
+    sample_interval = 5.0
+
+    def resources(self):
+        now = time()
+        if now - self.sampled_at >= self.sample_interval:
+            self.sampled_at = now
+            self.sampled = []
+            for cmd, proc in self.procs:
+                sample = proc_resources(proc.pid)
+                if sample is not None:
+                    self.sampled.append(dict(sample, cmd=cmd, pid=proc.pid))
+        return self.sampled
+
+    async def translate(self, to_translate, nosplit=False, deformat=True, reformat=True, prefs='', helpers=()):
+        """Chunks are spread in turn across this pipeline and helpers
+        (other pipelines of the same pair), and put back together in
+        order."""
         with self.use():
             if nosplit:
-                res = yield translate_nul_flush(to_translate, self, deformat, reformat, self.timeout, prefs)
-                return res
-            else:
-                all_split = split_for_translation(to_translate, n_users=self.users)
-                parts = yield [translate_nul_flush(part, self, deformat, reformat, self.timeout, prefs)
-                               for part in all_split]
-                return ''.join(parts)
+                self.chars += len(to_translate)
+                return await translate_nul_flush(to_translate, self, deformat, reformat, self.timeout, prefs)
+            return ''.join([chunk async for chunk in self.translated_chunks(to_translate, deformat, reformat, prefs, helpers)])
+
+    async def translate_iter(self, to_translate, deformat=True, reformat=True, prefs='', helpers=()):
+        """Yield the translation chunk by chunk, in order, each as soon
+        as it and those before it are done; chunks not yet yielded
+        are cancelled if the caller stops early."""
+        with self.use():
+            chunks = self.translated_chunks(to_translate, deformat, reformat, prefs, helpers)
+            try:
+                async for chunk in chunks:
+                    yield chunk
+            finally:
+                await chunks.aclose()
+
+    async def translated_chunks(self, to_translate, deformat, reformat, prefs, helpers):
+        """translate_iter for callers that are already using this
+        pipeline, so each request counts as one user."""
+        pipes = [self] + [helper for helper in helpers if not helper.stuck]
+        request = object()
+        parts = deque()  # type: deque
+        with ExitStack() as helpers_used:
+            try:
+                for i, part in enumerate(split_for_translation(to_translate, n_users=self.users, capacity=self.pipe_capacity)):
+                    pipe = pipes[i % len(pipes)]
+                    if i > 0 and i < len(pipes):
+                        helpers_used.enter_context(pipe.use())
+                    pipe.chars += len(part)
+                    # Get each chunk into the pipeline as soon as it's split off:
+                    # Only the first chunk may take the scheduler's fast path:
+                    key = None if i == 0 else request
+                    parts.append(asyncio.ensure_future(
+                        translate_nul_flush(part, pipe, deformat, reformat, pipe.timeout, prefs, key)))
+                    await asyncio.sleep(0)
+                while parts:
+                    yield await parts[0]
+                    parts.popleft()
+            finally:
+                for part in parts:
+                    part.cancel()
+
+    async def translate_batch(self, texts, deformat=True, reformat=True, prefs='', helpers=()):
+        """Translate each of texts (a list of strings) separately, but
+        with as few sends as possible, like translate_segments. Texts
+        too long for one send are split up, as by translate."""
+        deformat, reformat = validate_formatters(deformat, reformat)
+        with self.use():
+            request = object()
+            hardbreak = hardbreak_fn(self.users, self.pipe_capacity)
+            long_texts = [text for text in texts if len(bytes(text, 'utf-8')) > hardbreak]
+            short_texts = [text for text in texts if len(bytes(text, 'utf-8')) <= hardbreak]
+
+            async def translate_short():
+                deformatted = await asyncio.gather(*[deformat_text(text, deformat, self.timeout, request) for text in short_texts])
+                # A NUL would end up splitting its text in two:
+                outputs = await self.send_batched([d.replace(b'\0', b'') for d in deformatted], prefs, request, helpers)
+                return await asyncio.gather(*[reformat_output(output, reformat, self.timeout, request) for output in outputs])
+
+            async def translate_long(text):
+                return ''.join([chunk async for chunk in self.translated_chunks(text, deformat, reformat, prefs, helpers)])
+
+            short_translated, *long_translated = await asyncio.gather(translate_short(), *map(translate_long, long_texts))
+            translated = dict(zip(long_texts, long_translated))
+            translated.update(zip(short_texts, short_translated))
+            return [translated[text] for text in texts]
+
+    async def send_batched(self, items, prefs, request, helpers=()):
+        """Send items (a list of bytes without NULs) packed NUL-separated
+        into chunks that fit the pipeline, spread over this pipeline and
+        helpers; returns the outputs, one per item. An item longer than
+        a chunk is sent on its own, unsplit, so callers split up long
+        texts before deformatting them (see translate_batch)."""
+        pipes = [self] + [helper for helper in helpers if not helper.stuck]
+        hardbreak = hardbreak_fn(self.users, self.pipe_capacity)
+        with ExitStack() as helpers_used:
+            batches, sends = [], []  # type: List[List[bytes]], List
+            size = hardbreak
+            for item in items:
+                if size + len(item) + 1 > hardbreak:
+                    batches.append([])
+                    size = 0
+                batches[-1].append(item)
+                size += len(item) + 1
+            for i, batch in enumerate(batches):
+                pipe = pipes[i % len(pipes)]
+                if 0 < i < len(pipes):
+                    helpers_used.enter_context(pipe.use())
+                pipe.chars += sum(map(len, batch))
+                # Only the first chunk may take the scheduler's fast path:
+                key = None if i == 0 else request
+                sends.append(pipe.send(b'\0'.join(batch), prefs, pipe.timeout, key))
+            outputs = []
+            for batch, output in zip(batches, await asyncio.gather(*sends)):
+                results = output.split(b'\0')
+                # Anything but blanks after the last output means some were split in two:
+                if len(results) < len(batch) or any(extra.strip() for extra in results[len(batch):]):
+                    raise ProcessFailureError('Got %d outputs for %d segments' % (len(results), len(batch)))
+                outputs.extend(results[:len(batch)])
+            return outputs
+
+    async def translate_segments(self, to_translate, deformat, reformat, prefs, segment_cache, helpers=()):
+        """Translate each distinct sentence of the deformatted input
+        once, reusing what's in segment_cache (the pair's earlier
+        segment translations, with get_many and put like LRUCache;
+        get_many may also return an awaitable, like TieredSegmentCache's).
+        Uncached segments go through send_batched."""
+        deformat, reformat = validate_formatters(deformat, reformat)
+        with self.use():
+            request = object()
+            deformatted = (await deformat_text(to_translate, deformat, self.timeout, request)).decode('utf-8')
+            segments = split_segments(deformatted)
+            unique = list(OrderedDict.fromkeys(segment for _, segment in segments if segment))
+            cached = segment_cache.get_many([(prefs, segment) for segment in unique])
+            if isawaitable(cached):
+                cached = await cached
+            translated = {segment: cached.get((prefs, segment)) for segment in unique}
+            missing = [segment for segment in unique if translated[segment] is None]
+            outputs = await self.send_batched([bytes(segment, 'utf-8') for segment in missing], prefs, request, helpers)
+            for segment, output in zip(missing, outputs):
+                translated[segment] = output.decode('utf-8')
+                segment_cache.put((prefs, segment), translated[segment])
+            output = ''.join(blank + translated[segment] if segment else blank
+                             for blank, segment in segments)
+            return await reformat_output(bytes(output, 'utf-8'), reformat, self.timeout, request)
+
+    async def send(self, data, prefs='', timeout=None, key=None):
+        """Write data (bytes) followed by a NUL and a nonce, and wait
+        for the corresponding output, with the nonce and prefs
+        stripped. Several sends may be in flight at once; the
+        pipeline keeps them in order, so read_outputs can pair them
+        up again. Sends with the same key (e.g. the chunks of one
+        request) take turns with other keys, see FairScheduler. Once
+        the pipeline is stuck, sends fail with StreamClosedError."""
+        with self.queued():
+            await self.scheduler.acquire(key, len(data))
+        try:
+            if self.stuck:
+                # read_outputs gave up on the output, so nothing sent now would be read:
+                raise tornado.iostream.StreamClosedError()
+            nonce = '[/NONCE:' + token_urlsafe(8) + ']'
+            # A single write, so chunks from concurrent sends never interleave:
+            written = self.inpipe.stdin.write(bytes(format_prefs(prefs), 'utf-8') +
+                                              data +
+                                              bytes('\0' + nonce + '\0', 'utf-8'))
+            # TODO: PipeIOStream has no flush, but seems to work anyway?
+            output = Future()  # type: Future
+            self.inflight.append((nonce, output, timeout or self.timeout))
+            self.start_busy()
+            if not self.reading:
+                self.reading = True
+                IOLoop.current().spawn_callback(self.read_outputs)
+            try:
+                await written
+                return await output
+            finally:
+                # No-op if we got our output; otherwise tells read_outputs nobody's waiting
+                output.cancel()
+        finally:
+            self.scheduler.release()
+
+    async def read_output(self, nonce):
+        output = await self.outpipe.stdout.read_until(bytes(nonce + '\0', 'utf-8'))
+        return strip_prefs(output.replace(bytes(nonce, 'utf-8'), b''))
+
+    async def read_outputs(self):
+        try:
+            while self.inflight:
+                nonce, output, timeout = self.inflight[0]
+                # If the output has no \0, this hangs, locking the pipeline, so we use a timeout
+                result = await asyncio.wait_for(self.read_output(nonce), timeout=timeout)
+                self.inflight.popleft()
+                if not output.done():
+                    output.set_result(result)
+        except (asyncio.TimeoutError, tornado.iostream.StreamClosedError) as e:
+            # We can no longer tell which output belongs to whom, so
+            # fail everything that's queued up:
+            self.stuck = True
+            while self.inflight:
+                _, output, _ = self.inflight.popleft()
+                if not output.done():
+                    output.set_exception(e)
+        finally:
+            self.stop_busy()
+            self.reading = False
+
+
+FORMATTER_MAX_INFLIGHT = 32
+
+
+class FormatterPipeline(FlushingPipeline):
+    """A long-running deformatter or reformatter in NUL-flushing mode.
+
+    Formatters escape or unescape whatever we send them, nonces
+    included, so instead of looking for the nonce verbatim we read
+    NUL-terminated blocks until we see the one holding its token.
+    """
+    def __init__(self, timeout, formatter, *args, **kwargs):
+        self.formatter = formatter
+        # Formatters keep no state between blocks, so there's no reason not to multiplex:
+        super().__init__(timeout, [[formatter, '-z']], FORMATTER_MAX_INFLIGHT, *args, **kwargs)
+
+    async def read_output(self, nonce):
+        token = bytes(nonce.split(':', 1)[1].rstrip(']'), 'utf-8')
+        blocks = []
+        while True:
+            block = await self.outpipe.stdout.read_until(b'\0')
+            if token in block:
+                return b'\0'.join(blocks)
+            blocks.append(block[:-1])
+
+
+# One long-running process per deformatter/reformatter command, see get_formatter:
+formatters = {}  # type: Dict[str, FormatterPipeline]
+
+
+def get_formatter(formatter, timeout):
+    pipeline = formatters.get(formatter)
+    if pipeline is None or pipeline.stuck:
+        logging.info('Starting up a new formatter %s …', formatter)
+        pipeline = formatters[formatter] = FormatterPipeline(timeout, formatter)
+    return pipeline
 
 
 class SimplePipeline(Pipeline):
@@ -83,25 +477,35 @@ class SimplePipeline(Pipeline):
         self.commands = list(commands)
         super().__init__(*args, **kwargs)
 
-    @gen.coroutine
-    def translate(self, to_translate, nosplit='ignored', deformat='ignored', reformat='ignored', prefs=''):
+    async def translate(self, to_translate, nosplit='ignored', deformat='ignored', reformat='ignored', prefs='', helpers='ignored'):
         with self.use():
-            with (yield self.lock.acquire()):
-                res = yield translate_simple(to_translate, self.commands, prefs)
-                return res
+            self.chars += len(to_translate)
+            with self.queued():
+                releaser = await self.lock.acquire()
+            with releaser:
+                self.start_busy()
+                try:
+                    return await translate_simple(to_translate, self.commands, prefs)
+                finally:
+                    self.stop_busy()
 
 
 ParsedModes = namedtuple('ParsedModes', 'do_flush commands')
 
 
-def make_pipeline(modes_parsed, timeout):
+def make_pipeline(modes_parsed, timeout, max_inflight=1, pipe_size=0):
     if modes_parsed.do_flush:
-        return FlushingPipeline(timeout, modes_parsed.commands)
+        return FlushingPipeline(timeout, modes_parsed.commands, max_inflight, pipe_size)
     else:
         return SimplePipeline(modes_parsed.commands)
 
 
 def start_pipeline(commands):
+    procs = start_pipeline_procs(commands)
+    return procs[0], procs[-1]
+
+
+def start_pipeline_procs(commands):
     procs = []  # type: List[tornado.process.Subprocess]
     for i, cmd in enumerate(commands):
         if i == 0:
@@ -115,7 +519,59 @@ def start_pipeline(commands):
         procs.append(tornado.process.Subprocess(cmd,
                                                 stdin=in_from,
                                                 stdout=out_from))
-    return procs[0], procs[-1]
+    return procs
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def proc_resources(pid):
+    """Resident memory (bytes) and CPU time (user+system secs) of a
+    process, from /proc; None if it's gone or there's no /proc."""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            rss_pages = int(f.read().split()[1])
+        with open('/proc/%d/stat' % pid) as f:
+            # The command name may contain spaces, so count fields from its closing paren:
+            fields = f.read().rsplit(')', 1)[1].split()
+        utime, stime = int(fields[11]), int(fields[12])
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        'rss': rss_pages * PAGE_SIZE,
+        'cpuSecs': (utime + stime) / CLOCK_TICKS,
+    }
+
+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)  # Linux-only, and only named in Python 3.10+
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+
+def pipe_max_size():
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def set_pipe_sizes(procs, size):
+    """Try to make every pipe of a pipeline (its input, those between
+    stages, and its output) hold size bytes, capped by
+    pipe-max-size. Returns the smallest capacity we actually got."""
+    max_size = pipe_max_size()
+    if max_size is not None and size > max_size:
+        logging.info('Pipe size %d is above /proc/sys/fs/pipe-max-size, using %d', size, max_size)
+        size = max_size
+    capacities = []
+    for fd in [procs[0].stdin.fileno()] + [proc.stdout.fileno() for proc in procs]:
+        try:
+            capacities.append(fcntl.fcntl(fd, F_SETPIPE_SZ, size))
+        except OSError as e:
+            logging.warning('Could not set pipe size to %d: %s', size, e)
+            capacities.append(fcntl.fcntl(fd, F_GETPIPE_SZ))
+    return min(capacities)
 
 
 def cmd_needs_z(cmd):
@@ -171,79 +627,109 @@ def parse_mode_file(mode_path):
         raise Exception('Could not parse mode file %s', mode_path)
 
 
-def up_to_bytes(string, max_bytes):
-    """Find the unicode string length of the first up-to-max_bytes bytes.
-
-    At least it's much faster than going through the string adding
-    bytes of each char.
-    """
-    b = bytes(string, 'utf-8')
-    bl = max_bytes
-    while bl:
-        try:
-            dec = b[:bl].decode('utf-8')
-            return len(dec)
-        except UnicodeDecodeError:
-            bl -= 1
-    return 0
-
-
-def hardbreak_fn(string, n_users):
+def hardbreak_fn(n_users, capacity=None):
     """If others are queueing up to translate at the same time, we send
     short requests, otherwise we try to minimise the number of
     requests, but without letting buffers fill up.
 
-    These numbers could probably be tweaked a lot.
+    If we know the capacity of the pipeline's pipes, we go up to a
+    quarter of it, since the stream grows a lot between stages.
+
+    These numbers (in bytes) could probably be tweaked a lot.
     """
     if n_users > 2:
         return 1000
+    elif capacity:
+        return max(PIPE_BUF, capacity // 4)
     else:
-        return up_to_bytes(string, PIPE_BUF)
+        return PIPE_BUF
 
 
-def prefer_punct_break(string, last, hardbreak):
-    """We would prefer to split on a period or space seen before the
-    hardbreak, if we can. If the remaining string is smaller or equal
-    than the hardbreak, return end of the string
-    """
+# We would prefer to split after sentence punctuation – including that
+# of scripts that don't use . or spaces, like CJK, Devanagari/Bengali
+# danda and Arabic/Urdu – or failing that, after a space:
+sentence_breaks = [bytes(c, 'utf-8') for c in '\n.!?。！？｡।॥؟۔']
+word_breaks = [b' ', b'\t']
 
-    if len(string[last:]) <= hardbreak:
-        return last + hardbreak + 1
 
-    softbreak = int(hardbreak / 2) + 1
-    softnext = last + softbreak
+def prefer_punct_break(b, last, hardbreak):
+    """Find where to end the chunk of b (UTF-8 bytes) starting at last,
+    preferring a break in the second half of the hardbreak window."""
     hardnext = last + hardbreak
-    dot = string.rfind('.', softnext, hardnext)
-    if dot > -1:
-        return dot + 1
-    else:
-        space = string.rfind(' ', softnext, hardnext)
-        if space > -1:
-            return space + 1
-        else:
-            return hardnext
-
-
-def split_for_translation(to_translate, n_users):
+    if len(b) <= hardnext:
+        return len(b)
+    softnext = last + hardbreak // 2
+    for breaks in (sentence_breaks, word_breaks):
+        found = [i + len(brk) for brk in breaks for i in [b.rfind(brk, softnext, hardnext)] if i > -1]
+        if found:
+            return max(found)
+    # Don't cut a character in half:
+    while hardnext > last + 1 and (b[hardnext] & 0xC0) == 0x80:
+        hardnext -= 1
+    return hardnext
+
+
+def split_for_translation(to_translate, n_users, capacity=None):
     """Splitting it up a bit ensures we don't fill up FIFO buffers (leads
-    to processes hanging on read/write)."""
-    all_split = []              # [].append and join faster than str +=
+    to processes hanging on read/write).
+
+    Chunks are yielded as they're found, in one pass over the UTF-8
+    bytes, so translation can start before splitting is done.
+    """
+    b = bytes(to_translate, 'utf-8')
+    hardbreak = hardbreak_fn(n_users, capacity)
     last = 0
-    rounds = 0
-    while last < len(to_translate) and rounds < 10:
-        rounds += 1
-        hardbreak = hardbreak_fn(to_translate[last:], n_users)
-        next = prefer_punct_break(to_translate, last, hardbreak)
-        all_split.append(to_translate[last:next])
-        # logging.getLogger().setLevel(logging.DEBUG)
-        logging.debug('split_for_translation: last:%s hardbreak:%s next:%s appending:%s', last, hardbreak, next, to_translate[last:next])
+    while last < len(b):
+        next = prefer_punct_break(b, last, hardbreak)
+        logging.debug('split_for_translation: last:%s hardbreak:%s next:%s', last, hardbreak, next)
+        yield b[last:next].decode('utf-8')
         last = next
-    return all_split
+
+
+# Superblanks (incl. word-bound blanks), escaped characters,
+# whitespace, or runs of anything else:
+_stream_token_re = re.compile(r'\[\[(?:\\.|[^]\\])*\]\]'
+                              r'|(\[(?:\\.|[^]\\])*\])'
+                              r'|\\.'
+                              r'|(\s+)'
+                              r'|[^[\\\s]+',
+                              re.DOTALL)
+_sentence_end_chars = tuple(c.decode('utf-8') for c in sentence_breaks)
+
+
+def split_segments(deformatted):
+    """Split a deformatted stream into sentences, at sentence-ending
+    punctuation followed by blanks, or at blanks with a line break.
+    Returns (blank, segment) pairs that add up to the input; the
+    blanks (whitespace and superblanks) are never split up."""
+    pairs = []
+    blank, segment = [], []     # type: List[str], List[str]
+    in_blank = True             # still collecting the blank before segment
+    ends_sentence = False
+    for m in _stream_token_re.finditer(deformatted):
+        token = m.group()
+        if m.group(1) is not None or m.group(2) is not None:
+            if segment and (ends_sentence or '\n' in token):
+                pairs.append((''.join(blank), ''.join(segment)))
+                blank, segment = [], []
+                in_blank = True
+            (blank if in_blank else segment).append(token)
+        else:
+            in_blank = False
+            segment.append(token)
+            ends_sentence = token.endswith(_sentence_end_chars) and not token.startswith('\\')
+    if segment:
+        # Trailing blanks stay with the last segment, there's nothing to separate
+        pairs.append((''.join(blank), ''.join(segment)))
+    elif blank:
+        pairs.append((''.join(blank), ''))
+    return pairs
 
 
 def validate_formatters(deformat, reformat):
     def valid1(elt, lst):
-        if elt in lst:
+        # Callables are in-process formatters from utils.formatting
+        if elt in lst or callable(elt):
             return elt
         else:
             return lst[0]
@@ -262,65 +748,91 @@ def check_ret_code(name, proc):
         raise ProcessFailureError('%s failed, exit code %s', name, proc.returncode)
 
 
-@gen.coroutine
-def coreduce(init, funcs, *args):
+async def coreduce(init, funcs, *args):
     """
     Like the reduce() function in functools, this function applies the
     next function in the list to the output of the previous function
     (starting with init), supplying the additional args; this is just a
     coroutine version for use with the asynchronous translation pipelines.
     """
-    result = yield funcs[0](init, *args)
+    result = await funcs[0](init, *args)
     for func in funcs[1:]:
-        result = yield func(result, *args)
+        result = await func(result, *args)
     return result
 
 
-async def translate_nul_flush(to_translate, pipeline, unsafe_deformat, unsafe_reformat, timeout, prefs):
-    with (await pipeline.lock.acquire()):
-        proc_in, proc_out = pipeline.inpipe, pipeline.outpipe
-        deformat, reformat = validate_formatters(unsafe_deformat, unsafe_reformat)
+async def deformat_text(to_translate, deformat, timeout, key=None):
+    if callable(deformat):
+        return bytes(deformat(to_translate), 'utf-8')
+    elif deformat:
+        return await get_formatter(deformat, timeout).send(bytes(to_translate, 'utf-8'), key=key)
+    else:
+        return bytes(to_translate, 'utf-8')
 
-        if deformat:
-            proc_deformat = Popen(deformat, stdin=PIPE, stdout=PIPE)
-            assert proc_deformat.stdin is not None  # stupid mypy
-            proc_deformat.stdin.write(bytes(to_translate, 'utf-8'))
-            deformatted = proc_deformat.communicate()[0]
-            check_ret_code('Deformatter', proc_deformat)
-        else:
-            deformatted = bytes(to_translate, 'utf-8')
-
-        nonce = '[/NONCE:' + token_urlsafe(8) + ']'
-        await proc_in.stdin.write(bytes(format_prefs(prefs), 'utf-8'))
-        await proc_in.stdin.write(deformatted)
-        await proc_in.stdin.write(bytes('\0' + nonce + '\0', 'utf-8'))
-        # TODO: PipeIOStream has no flush, but seems to work anyway?
-        # proc_in.stdin.flush()
-
-        # If the output has no \0, this hangs, locking the pipeline, so we use a timeout
-        noncereader = proc_out.stdout.read_until(bytes(nonce + '\0', 'utf-8'))
-        output = await asyncio.wait_for(noncereader, timeout=timeout)
-        output = output.replace(bytes(nonce, 'utf-8'), b'')
-        output = strip_prefs(output)
-
-        if reformat:
-            proc_reformat = Popen(reformat, stdin=PIPE, stdout=PIPE)
-            assert proc_reformat.stdin is not None  # stupid mypy
-            proc_reformat.stdin.write(output)
-            result = proc_reformat.communicate()[0]
-            check_ret_code('Reformatter', proc_reformat)
-        else:
-            result = output.replace(b'\0', b'')
-        return result.decode('utf-8')
+
+async def reformat_output(output, reformat, timeout, key=None):
+    if callable(reformat):
+        return reformat(output.rstrip(b'\0').decode('utf-8'))
+    elif reformat:
+        result = await get_formatter(reformat, timeout).send(output.rstrip(b'\0'), key=key)
+    else:
+        result = output.replace(b'\0', b'')
+    return result.decode('utf-8')
+
+
+async def translate_nul_flush(to_translate, pipeline, unsafe_deformat, unsafe_reformat, timeout, prefs, key=None):
+    deformat, reformat = validate_formatters(unsafe_deformat, unsafe_reformat)
+    deformatted = await deformat_text(to_translate, deformat, timeout, key)
+    output = await pipeline.send(deformatted, prefs, timeout, key)
+    return await reformat_output(output, reformat, timeout, key)
+
+
+async def translate_chain(to_translate, pipelines, unsafe_deformat, unsafe_reformat, nosplit=False):
+    """Translate through each of pipelines in turn, deformatting only
+    before the first and reformatting only after the last. Each chunk
+    moves on to the next pipeline as soon as it's out of the previous
+    one, so the pipelines all work at once, on different chunks (or on
+    the whole text as one chunk if nosplit)."""
+    deformat, reformat = validate_formatters(unsafe_deformat, unsafe_reformat)
+    first, last = pipelines[0], pipelines[-1]
+    request = object()
+
+    async def translate_chunk(part, key):
+        data = await deformat_text(part, deformat, first.timeout, key)
+        for pipeline in pipelines:
+            pipeline.chars += len(part)
+            data = (await pipeline.send(data, '', pipeline.timeout, key)).rstrip(b'\0')
+        return await reformat_output(data, reformat, last.timeout, key)
+
+    with ExitStack() as used:
+        for pipeline in pipelines:
+            used.enter_context(pipeline.use())
+        parts = []
+        try:
+            if nosplit:
+                chunks = [to_translate]
+            else:
+                chunks = split_for_translation(to_translate, n_users=first.users, capacity=first.pipe_capacity)
+            for i, part in enumerate(chunks):
+                # Only the first chunk may take the scheduler's fast path:
+                parts.append(asyncio.ensure_future(translate_chunk(part, None if i == 0 else request)))
+                await asyncio.sleep(0)
+            return ''.join(await asyncio.gather(*parts))
+        finally:
+            for part in parts:
+                part.cancel()
 
 
 @gen.coroutine
-def translate_pipeline(to_translate, commands):
-    proc_deformat = Popen('apertium-deshtml', stdin=PIPE, stdout=PIPE)
-    assert proc_deformat.stdin is not None  # stupid mypy
-    proc_deformat.stdin.write(bytes(to_translate, 'utf-8'))
-    deformatted = proc_deformat.communicate()[0]
-    check_ret_code('Deformatter', proc_deformat)
+def translate_pipeline(to_translate, commands, deformat='apertium-deshtml', reformat='apertium-rehtml-noent'):
+    if callable(deformat):
+        deformatted = bytes(deformat(to_translate), 'utf-8')
+    else:
+        proc_deformat = Popen(deformat, stdin=PIPE, stdout=PIPE)
+        assert proc_deformat.stdin is not None  # stupid mypy
+        proc_deformat.stdin.write(bytes(to_translate, 'utf-8'))
+        deformatted = proc_deformat.communicate()[0]
+        check_ret_code('Deformatter', proc_deformat)
 
     towrite = deformatted
 
@@ -329,7 +841,7 @@ def translate_pipeline(to_translate, commands):
     output.append(towrite.decode('utf-8'))
 
     all_cmds = []
-    all_cmds.append('apertium-deshtml')
+    all_cmds.append(getattr(deformat, '__name__', deformat))
 
     for cmd in commands:
         proc = Popen(cmd, stdin=PIPE, stdout=PIPE)
@@ -341,14 +853,17 @@ def translate_pipeline(to_translate, commands):
         output.append(towrite.decode('utf-8'))
         all_cmds.append(cmd)
 
-    proc_reformat = Popen('apertium-rehtml-noent', stdin=PIPE, stdout=PIPE)
-    assert proc_reformat.stdin is not None  # stupid mypy
-    proc_reformat.stdin.write(towrite)
-    towrite = proc_reformat.communicate()[0]
-    check_ret_code('Reformatter', proc_reformat)
+    if callable(reformat):
+        towrite = bytes(reformat(towrite.decode('utf-8')), 'utf-8')
+    else:
+        proc_reformat = Popen(reformat, stdin=PIPE, stdout=PIPE)
+        assert proc_reformat.stdin is not None  # stupid mypy
+        proc_reformat.stdin.write(towrite)
+        towrite = proc_reformat.communicate()[0]
+        check_ret_code('Reformatter', proc_reformat)
 
     output.append(towrite.decode('utf-8'))
-    all_cmds.append('apertium-rehtml-noent')
+    all_cmds.append(getattr(reformat, '__name__', reformat))
 
     return output, all_cmds
 
@@ -17,7 +17,8 @@ import urllib.request
 import uuid
 
 from tornado.log import enable_pretty_logging
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
 
 base_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '..')
 sys.path.append(base_path)
@@ -222,6 +223,20 @@ class TestTranslateHandler(BaseTestCase):
         response = self.fetch_translation('notaword', 'eng|spa', params={'markUnknown': False})
         self.assertEqual(response['responseData']['translatedText'], 'notaword')
 
+    def test_deadline_passed(self):
+        response = self.fetch_translation('government', 'eng|spa', params={'deadline': 0}, expect_success=False)
+        self.assertEqual(response['code'], 408)
+
+        response = self.fetch_translation('government', 'eng|spa', headers={'X-Request-Deadline': '60'})
+        self.assertEqual(response['responseData']['translatedText'], 'Gobierno')
+
+    def test_stream(self):
+        response = self.fetch('/translate', params={'q': 'government', 'langpair': 'eng|spa', 'stream': 'yes'})
+        self.assertEqual(response.code, 200)
+        lines = [json.loads(line) for line in response.body.decode('utf-8').splitlines()]
+        self.assertEqual(''.join(line['translatedText'] for line in lines[:-1]), 'Gobierno')
+        self.assertEqual(lines[-1]['responseStatus'], 200)
+
     def test_valid_giella_pair(self):
         response = self.fetch_translation('ja', 'sme|nob')
         self.assertEqual(response['responseData']['translatedText'], 'og')
@@ -262,6 +277,34 @@ class TestTranslateHandler(BaseTestCase):
         })
 
 
+class TestTranslateBatchHandler(BaseTestCase):
+    def test_translate_batch(self):
+        response = self.fetch_json('/translateBatch', params={
+            'langpair': 'eng|spa',
+            'q': json.dumps(['government', 'notaword', {'q': 'ja', 'langpair': 'sme|nob'}, 'government']),
+        })
+        self.assertEqual([r['translatedText'] for r in response['responseData']],
+                         ['Gobierno', '*notaword', 'og', 'Gobierno'])
+
+    def test_invalid_batch(self):
+        response = self.fetch_json('/translateBatch', params={'q': json.dumps(['government'])}, expect_success=False)
+        self.assertEqual(response['code'], 400)
+
+
+class TestTranslateSocketHandler(BaseTestCase):
+    @gen_test
+    def test_translate_socket(self):
+        conn = yield websocket_connect('ws://localhost:{}/translateSocket?langpair=eng|spa'.format(PORT))
+        conn.write_message(json.dumps({'id': 1, 'q': 'government'}))
+        conn.write_message(json.dumps({'id': 2, 'q': 'notaword', 'markUnknown': 'no'}))
+        replies = []
+        for _ in range(2):
+            replies.append(json.loads((yield conn.read_message())))
+        self.assertEqual(sorted((r['id'], r['translatedText']) for r in replies),
+                         [(1, 'Gobierno'), (2, 'notaword')])
+        conn.close()
+
+
 class TestTranslateWebpageHandler(BaseTestCase):
     def test_translate_webpage(self):
         response = self.fetch_json('/translatePage', params={
@@ -390,7 +433,7 @@ class TestStatsHandler(BaseTestCase):
         response = self.fetch_json('/stats')
         data = response['responseData']
         self.assertGreater(data['uptime'], 0)
-        for key in ['useCount', 'runningPipes', 'holdingPipes', 'periodStats']:
+        for key in ['useCount', 'runningPipes', 'holdingPipes', 'pipeResources', 'periodStats']:
             self.assertIn(key, data)
         for period_key in ['charsPerSec', 'totChars', 'totTimeSpent', 'requests', 'ageFirstRequest']:
             self.assertIn(period_key, data['periodStats'])
@@ -0,0 +1,102 @@
+from unittest import TestCase
+
+from apertium_apy.autoscaler import Autoscaler, parse_pipe_limits
+
+
+class FakePipe:
+    def __init__(self):
+        self.users = 0
+        self.last_usage = 0.0
+        self.stuck = False
+        self.waiting = 0
+        self.waited = 0
+        self.wait_secs = 0.0
+        self.chars = 0
+        self.busy = 0.0
+
+    def busy_time(self):
+        return self.busy
+
+    def __lt__(self, other):
+        return self.users < other.users
+
+
+class FakeHandler:
+    pairs = {'eng-spa': '/modes/eng-spa.mode', 'spa-eng': '/modes/spa-eng.mode'}
+    pipelines = {}  # type: dict
+    pair_pipe_limits = {('eng', 'spa'): (1, 3)}
+
+    @classmethod
+    def pipe_limits(cls, pair):
+        return cls.pair_pipe_limits.get(pair, (0, 1))
+
+    @classmethod
+    def start_pipe(cls, pair):
+        cls.pipelines.setdefault(pair, []).append(FakePipe())
+
+
+class TestAutoscaler(TestCase):
+    pair = ('eng', 'spa')
+
+    def setUp(self):
+        FakeHandler.pipelines = {}
+        self.scaler = Autoscaler(FakeHandler, 1)
+        self.scaler.cooldown_secs = 0
+
+    def test_parse_pipe_limits(self):
+        self.assertEqual(parse_pipe_limits('eng-spa=1:4, nob-nno=0:2'),
+                         {('eng', 'spa'): (1, 4), ('nob', 'nno'): (0, 2)})
+        self.assertEqual(parse_pipe_limits(''), {})
+        for bad in ['eng-spa', 'eng-spa=4:1', 'eng-spa=0:0', 'eng=1:2']:
+            with self.assertRaises(ValueError):
+                parse_pipe_limits(bad)
+
+    def test_starts_up_to_min(self):
+        self.scaler.tick()
+        self.assertEqual(len(FakeHandler.pipelines[self.pair]), 1)
+
+    def test_scales_up_after_hysteresis(self):
+        self.scaler.tick()
+        pipe = FakeHandler.pipelines[self.pair][0]
+        pipe.waiting = 10
+        self.scaler.tick()
+        self.assertEqual(len(FakeHandler.pipelines[self.pair]), 1)
+        for _ in range(5):
+            self.scaler.tick()
+        # Never beyond max:
+        self.assertEqual(len(FakeHandler.pipelines[self.pair]), 3)
+
+    def test_scales_down_when_quiet(self):
+        FakeHandler.pipelines[self.pair] = [FakePipe(), FakePipe(), FakePipe()]
+        FakeHandler.pipelines[self.pair][0].users = 1
+        for _ in range(self.scaler.down_ticks * 3):
+            self.scaler.tick()
+        # Never below min, and never the pipe in use:
+        self.assertEqual(len(FakeHandler.pipelines[self.pair]), 1)
+        self.assertEqual(FakeHandler.pipelines[self.pair][0].users, 1)
+
+    def test_stays_up_while_busy(self):
+        FakeHandler.pipelines[self.pair] = [FakePipe(), FakePipe()]
+        for _ in range(self.scaler.down_ticks * 2):
+            for p in FakeHandler.pipelines[self.pair]:
+                p.waiting = 3
+            self.scaler.tick()
+        self.assertEqual(len(FakeHandler.pipelines[self.pair]), 3)
+
+    def test_speed_is_not_traffic(self):
+        self.scaler.tick()
+        pipe = FakeHandler.pipelines[self.pair][0]
+        quiet = ('spa', 'eng')
+        FakeHandler.start_pipe(quiet)
+        quiet_pipe = FakeHandler.pipelines[quiet][0]
+        for _ in range(5):
+            # Both translate 1000 chars per busy sec, but eng-spa gets 50 times the traffic:
+            pipe.chars += 5000
+            pipe.busy += 5.0
+            quiet_pipe.chars += 100
+            quiet_pipe.busy += 0.1
+            self.scaler.tick()
+        busy_load, quiet_load = self.scaler.loads[self.pair], self.scaler.loads[quiet]
+        self.assertGreater(busy_load.chars_per_sec, 10 * quiet_load.chars_per_sec)
+        self.assertAlmostEqual(busy_load.speed(), 1000)
+        self.assertAlmostEqual(quiet_load.speed(), 1000)
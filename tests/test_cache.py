@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from apertium_apy.utils.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_forgets_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual([cache.get('a'), cache.get('c')], [1, 3])
+        self.assertEqual((cache.hits, cache.misses), (3, 0))
+
+    def test_sized_entries(self):
+        cache = LRUCache(10, sizeof=lambda key, value: len(value))
+        cache.put('a', 'xxxx')
+        cache.put('b', 'xxxx')
+        cache.put('c', 'xxxx')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+        cache.put('big', 'x' * 11)
+        self.assertNotIn('big', cache)
+        cache.put('c', 'x')
+        self.assertEqual(cache.size, 5)
+
+    def test_missing(self):
+        cache = LRUCache(1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 0), 0)
+        self.assertEqual(cache.misses, 2)
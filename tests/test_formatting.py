@@ -0,0 +1,92 @@
+import asyncio
+import shutil
+import subprocess
+from unittest import TestCase, skipUnless
+
+from apertium_apy.utils.formatting import deformat_html, deformat_txt, reformat_html_noent, reformat_txt
+from apertium_apy.utils.translation import FormatterPipeline
+
+TXT_SAMPLES = [
+    'government',
+    'Two  spaces, a\ttab and\n\nparagraphs.',
+    'Stream characters: [x] ^y$ a/b @c <d> {e} \\f',
+]
+
+HTML_SAMPLES = [
+    '<p>Hello <b>world</b></p>',
+    '<p>One</p>\n<p>Two  spaces and [brackets]</p>',
+    '<!-- a comment --><a href="x.html" title="[x]">link</a> text',
+    '<script>if (a < b) { c[0] = "$"; }</script><div>After script</div>',
+]
+
+
+def external(cmd, text):
+    return subprocess.run([cmd], input=text.encode('utf-8'), stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+
+
+def external_flushing(cmd, texts):
+    """Each of texts through one long-running cmd -z, like the server
+    runs formatters without --native-formatters."""
+    async def main():
+        pipeline = FormatterPipeline(10, cmd)
+        return [(await pipeline.send(text.encode('utf-8'))).decode('utf-8') for text in texts]
+    return asyncio.run(main())
+
+
+class TestNativeFormatters(TestCase):
+    def test_txt_roundtrip(self):
+        for text in TXT_SAMPLES:
+            self.assertEqual(reformat_txt(deformat_txt(text)), text)
+
+    def test_html_roundtrip(self):
+        for text in HTML_SAMPLES:
+            self.assertEqual(reformat_html_noent(deformat_html(text)), text)
+
+    def test_txt_escapes(self):
+        self.assertEqual(deformat_txt('a [b]\n^c$'), 'a \\[b\\][\n]\\^c\\$')
+
+    def test_html_superblanks(self):
+        self.assertEqual(deformat_html('<p>a <b>b</b></p>\n<p>c</p>'), '[<p>]a [<b>]b[</b></p>\n<p>]c[</p>]')
+
+    def test_html_entities(self):
+        self.assertEqual(deformat_html('caf&eacute; &amp; &#60;b&#62;'), 'café &amp; &#60;b&#62;')
+
+    def test_keeps_nul_separators(self):
+        self.assertEqual(reformat_txt(deformat_txt('a\0b')), 'a\0b')
+
+    def test_reformat_drops_wordbound_blanks(self):
+        self.assertEqual(reformat_html_noent('[[t:b:123]]^a$[[/]] \\[b\\]'), '^a$ [b]')
+
+
+@skipUnless(shutil.which('apertium-destxt') and shutil.which('apertium-retxt'), 'apertium txt formatters not installed')
+class TestTxtParity(TestCase):
+    def test_same_deformat(self):
+        self.assertEqual([deformat_txt(text) for text in TXT_SAMPLES],
+                         external_flushing('apertium-destxt', TXT_SAMPLES))
+
+    def test_same_roundtrip(self):
+        for text in TXT_SAMPLES:
+            self.assertEqual(reformat_txt(deformat_txt(text)),
+                             external('apertium-retxt', external('apertium-destxt', text)))
+
+    def test_external_reformats_native(self):
+        for text in TXT_SAMPLES:
+            self.assertEqual(external('apertium-retxt', deformat_txt(text)),
+                             reformat_txt(deformat_txt(text)))
+
+
+@skipUnless(shutil.which('apertium-deshtml') and shutil.which('apertium-rehtml-noent'), 'apertium html formatters not installed')
+class TestHtmlParity(TestCase):
+    def test_same_deformat(self):
+        self.assertEqual([deformat_html(text) for text in HTML_SAMPLES],
+                         external_flushing('apertium-deshtml', HTML_SAMPLES))
+
+    def test_same_roundtrip(self):
+        for text in HTML_SAMPLES:
+            self.assertEqual(reformat_html_noent(deformat_html(text)),
+                             external('apertium-rehtml-noent', external('apertium-deshtml', text)))
+
+    def test_external_reformats_native(self):
+        for text in HTML_SAMPLES:
+            self.assertEqual(external('apertium-rehtml-noent', deformat_html(text)),
+                             reformat_html_noent(deformat_html(text)))
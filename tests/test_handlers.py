@@ -0,0 +1,386 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import tornado.httputil
+import tornado.web
+from tornado.locks import Semaphore
+
+from apertium_apy.apy import run_in_background
+from apertium_apy.handlers import (AnalyzeHandler, BaseHandler, IdentifyLangHandler, PerWordHandler, SpellerHandler, StatsHandler,
+                                   TranslateChainHandler, TranslateDocHandler, TranslateHandler, TranslateSocketHandler,
+                                   TranslateWebpageHandler)
+from apertium_apy.handlers.base import Stats, sizeof_cached_translation
+from apertium_apy.handlers.per_word import get_bilingual_pipeline
+from apertium_apy.utils.cache import LRUCache
+from apertium_apy.utils.paths import PathIndex
+from apertium_apy.utils.translation import FlushingPipeline, ParsedModes, ProcessFailureError, SimplePipeline
+
+# Marks the unknown word like a pair's pipeline does, flushing on NUL:
+MARKING_PIPELINE = ParsedModes(True, [['sed', '-u', '-z', 's/ hus/ *hus/g']])
+
+# Suggests each token with a 1 after it, except that it splits tokens on commas:
+FAKE_SPELLER = ['sed', '-u', '-z', r's/,/\x00/g; s/^\([^[].*\)$/Corrections for:\n\11\t1.0/']
+
+
+def make_handler(cls, uri='/'):
+    request = tornado.httputil.HTTPServerRequest(method='GET', uri=uri, connection=mock.Mock())
+    return cls(tornado.web.Application(), request)
+
+
+class TestTranslatePage(TestCase):
+    def test_segmented_has_no_unknown_marks(self):
+        async def main():
+            handler = make_handler(TranslateWebpageHandler)
+            return await handler.translate_page(('nob', 'nno'), '<p>Eit hus. Eit hus!</p>', None, '')
+
+        with mock.patch.multiple(BaseHandler, segment_cache_size=1024 * 1024, native_formatters=True,
+                                 pipelines={}, segment_caches={},
+                                 pipeline_cmds={('nob', 'nno'): MARKING_PIPELINE}):
+            self.assertEqual(asyncio.run(main()), '<p>Eit hus. Eit hus!</p>')
+
+
+class TestRunMode(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'modes'))
+        # parse_mode_file gives sed -z, but only -u makes it flush:
+        for mode, cmd in [('nob-flushing', "sed -u 's/hus/heim/'"), ('nob-buffering', "sed 's/hus/heim/'")]:
+            with open(os.path.join(self.root, 'modes', mode + '.mode'), 'w') as mode_file:
+                mode_file.write(cmd)
+        self.patch = mock.patch.multiple(BaseHandler, mode_pipelines={}, mode_versions={}, mode_flushing={},
+                                         flush_probe_secs=0.2)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.root)
+
+    def test_flushing_mode_stays_warm(self):
+        async def main():
+            handler = make_handler(AnalyzeHandler)
+            return [await handler.run_mode(text, self.root, 'nob-flushing') for text in ['eit hus', 'to hus']]
+        self.assertEqual(asyncio.run(main()), ['eit heim', 'to heim'])
+        self.assertTrue(BaseHandler.mode_flushing[(self.root, 'nob-flushing')])
+        self.assertIn((self.root, 'nob-flushing'), BaseHandler.mode_pipelines)
+
+    def test_buffering_mode_runs_once_per_request(self):
+        async def main():
+            handler = make_handler(AnalyzeHandler)
+            return await handler.run_mode('eit hus', self.root, 'nob-buffering', formatting='txt')
+        with mock.patch('apertium_apy.handlers.base.translate_simple', mock.AsyncMock(return_value='eit heim')) as simple:
+            self.assertEqual(asyncio.run(main()), 'eit heim')
+        simple.assert_called_once_with('eit hus', [['apertium', '-d', self.root, '-f', 'txt', 'nob-buffering']])
+        self.assertFalse(BaseHandler.mode_flushing[(self.root, 'nob-buffering')])
+        self.assertNotIn((self.root, 'nob-buffering'), BaseHandler.mode_pipelines)
+
+
+class TestBilingualPipeline(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'modes'))
+        with open(os.path.join(self.root, 'modes', 'nob-flushing.mode'), 'w') as mode_file:
+            mode_file.write("sed -u 's/hus/heim/'")
+        # lt-proc -b -z that looks nothing up:
+        with open(os.path.join(self.root, 'lt-proc'), 'w') as script:
+            script.write('#!/bin/sh\nexec cat\n')
+        os.chmod(os.path.join(self.root, 'lt-proc'), 0o755)
+        self.autobil = os.path.join(self.root, 'nob-nno.autobil.bin')
+        open(self.autobil, 'w').close()
+        self.patch = mock.patch.multiple(BaseHandler, mode_pipelines={}, mode_versions={}, mode_flushing={}, max_idle_secs=60)
+        self.patch.start()
+        self.path_patch = mock.patch.dict(os.environ, {'PATH': self.root + os.pathsep + os.environ['PATH']})
+        self.path_patch.start()
+
+    def tearDown(self):
+        self.path_patch.stop()
+        self.patch.stop()
+        shutil.rmtree(self.root)
+
+    def test_idle_sweep(self):
+        async def main():
+            handler = make_handler(PerWordHandler)
+            key = (self.autobil, BaseHandler.bilingual_mode)
+            pipeline = get_bilingual_pipeline(handler, self.autobil)
+            self.assertEqual(BaseHandler.mode_versions[key], os.path.getmtime(self.autobil))
+            pipeline.last_usage = 0
+            BaseHandler.get_mode_pipeline(self.root, 'nob-flushing')
+            self.assertEqual(set(BaseHandler.mode_pipelines), {(self.root, 'nob-flushing')})
+            self.assertEqual(set(BaseHandler.mode_versions), {(self.root, 'nob-flushing')})
+        asyncio.run(main())
+
+
+class TestSpeller(TestCase):
+    def get_suggestions(self, tokens, version=1.0):
+        async def main():
+            key = ('/path', 'nob-spell')
+            if key not in BaseHandler.mode_pipelines:
+                BaseHandler.mode_pipelines[key] = FlushingPipeline(10, [FAKE_SPELLER], 1)
+            BaseHandler.mode_versions[key] = version
+            handler = make_handler(SpellerHandler)
+            return await handler.get_suggestions(key[0], key[1], tokens)
+        return asyncio.run(main())
+
+    def test_suggestions(self):
+        with mock.patch.multiple(BaseHandler, mode_pipelines={}, mode_versions={}, mode_flushing={}):
+            self.assertEqual(self.get_suggestions(['hus', 'bil', 'hus']), {'hus': [('hus1', '1.0')], 'bil': [('bil1', '1.0')]})
+            self.assertEqual(SpellerHandler.suggestion_cache.get(('/path', 'nob-spell', 1.0, 'bil')), [('bil1', '1.0')])
+            self.assertIsNone(SpellerHandler.suggestion_cache.get(('/path', 'nob-spell', 2.0, 'bil')))
+
+    def test_falls_back_to_one_token_at_a_time(self):
+        with mock.patch.multiple(BaseHandler, mode_pipelines={}, mode_versions={}, mode_flushing={}):
+            # Three outputs for two tokens; don't give hus the suggestions of "a":
+            self.assertEqual(self.get_suggestions(['a,b', 'hus'], version=3.0), {'a,b': [('ab1', '1.0')], 'hus': [('hus1', '1.0')]})
+
+
+class TestTranslateChain(TestCase):
+    def test_uses_pair_asked_for(self):
+        graph = {'eng': ['spa', 'cat'], 'cat': ['spa']}
+        # eng-spa is so slow that chains go around it …
+        index = PathIndex(graph, {('eng', 'spa'): 10})
+        with mock.patch.multiple(BaseHandler, pairs={'eng-spa': '', 'eng-cat': '', 'cat-spa': ''}, path_index=index):
+            handler = make_handler(TranslateChainHandler)
+            self.assertEqual(index.path('eng', 'spa'), ['eng', 'cat', 'spa'])
+            # … but not when it's the one asked for:
+            self.assertEqual(handler.get_pairs_or_error('eng|spa', 0), ['eng', 'spa'])
+            self.assertEqual(handler.get_pairs_or_error('spa|cat', 0), None)
+
+
+class TestTranslateSocket(TestCase):
+    def make_socket(self):
+        handler = make_handler(TranslateSocketHandler)
+        handler.pair = ('nob', 'nno')
+        handler.deformat, handler.reformat, handler.mark_unknown_default = 'html', 'html', 'yes'
+        handler.replies = []
+        handler.reply = lambda message_id, data: handler.replies.append(dict(data, id=message_id))
+        return handler
+
+    def test_unexpected_error_is_answered(self):
+        handler = self.make_socket()
+        with mock.patch.object(handler, 'get_pipeline'), mock.patch.object(handler, 'clean_pairs'), \
+                mock.patch.object(handler, 'translate_text', mock.AsyncMock(side_effect=KeyError('oops'))):
+            asyncio.run(handler.translate_message(7, 'hus', {}))
+        self.assertEqual(handler.replies, [{'id': 7, 'code': 500, 'explanation': 'internal error'}])
+
+    def test_caps_messages_in_flight(self):
+        async def main():
+            handler.on_message('{"id": 1, "q": "hus"}')
+            handler.on_message('{"id": 2, "q": "hus"}')
+            await asyncio.sleep(0)
+            handler.on_close()
+
+        async def slow_translation(*args):
+            await asyncio.sleep(10)
+        handler = self.make_socket()
+        handler.max_inflight_messages = 1
+        with mock.patch.object(handler, 'translate_message', slow_translation):
+            asyncio.run(main())
+        self.assertEqual([(reply['id'], reply['code']) for reply in handler.replies], [(2, 429)])
+
+
+class FakePipe(object):
+    def __init__(self, stuck=False):
+        self.stuck = stuck
+        self.users = 0
+        self.use_count = 0
+        self.last_usage = 0.0
+
+    def __lt__(self, other):
+        return False
+
+
+class TestTranslateDoc(TestCase):
+    def translate_doc(self, error):
+        """The status sent when translating a document sentence by
+        sentence fails with error, and the pipeline used."""
+        async def main():
+            handler = make_handler(TranslateDocHandler)
+            with mock.patch.object(handler, 'get_segmenting_pipeline', return_value=pipeline), \
+                    mock.patch.object(handler, 'translate_segments', mock.AsyncMock(side_effect=error)), \
+                    mock.patch.object(handler, 'send_error') as send_error:
+                self.assertTrue(await handler.translate_segmented_doc(('nob', 'nno'), b'Eit hus.', 'txt'))
+            return send_error.call_args[0][0]
+        pipeline = FakePipe()
+        with mock.patch.object(BaseHandler, 'doc_pipe_sem', Semaphore(1)):
+            return asyncio.run(main()), pipeline
+
+    def test_hung_pipeline_is_stuck(self):
+        status, pipeline = self.translate_doc(asyncio.TimeoutError())
+        self.assertEqual((status, pipeline.stuck), (503, True))
+
+    def test_failed_pipeline(self):
+        status, pipeline = self.translate_doc(ProcessFailureError('missing output'))
+        self.assertEqual((status, pipeline.stuck), (503, False))
+
+
+class TestStreamTranslation(TestCase):
+    def test_failed_pipeline_ends_stream(self):
+        async def failing_iter(*args):
+            yield 'Eit'
+            raise ProcessFailureError('missing output')
+
+        async def main():
+            await handler.stream_and_respond(('nob', 'nno'), pipeline, 'Eit hus.', 'yes', 'txt', 'txt')
+        handler = make_handler(TranslateHandler)
+        pipeline = FakePipe()
+        pipeline.translate_iter = failing_iter  # type: ignore[attr-defined]
+        with mock.patch.object(handler, 'get_helper_pipelines', return_value=[]), \
+                mock.patch.object(handler, 'note_pair_usage'), mock.patch.object(handler, 'clean_pairs'), \
+                mock.patch.object(handler, 'flush', mock.AsyncMock()), \
+                mock.patch.object(handler, 'write_line') as write_line:
+            asyncio.run(main())
+        self.assertEqual([args[0] for args, _ in write_line.call_args_list],
+                         [{'translatedText': 'Eit'}, {'responseDetails': 'internal error', 'responseStatus': 503}])
+        self.assertTrue(pipeline.stuck)
+
+
+class TestResultCache(TestCase):
+    KEY = (('nob', 'nno'), 'Eit hus.', 'html', 'html', '', True)
+
+    def setUp(self):
+        self.patches = [
+            mock.patch.multiple(BaseHandler, result_cache=LRUCache(1024 * 1024, sizeof_cached_translation),
+                                stats=Stats(), segment_caches={}, pipelines={}, pipelines_holding=[],
+                                max_idle_secs=1, min_pipes_per_pair=0),
+            mock.patch.multiple(TranslateHandler, results_inflight={}, cache_generation={}),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.calls = 0
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    async def translate(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return 'Eit hus.'
+
+    def test_coalesces_identical_requests(self):
+        async def main():
+            handler = make_handler(TranslateHandler)
+            first = await asyncio.gather(*[handler.cached_translation(self.KEY, self.translate) for _ in range(3)])
+            return first + [await handler.cached_translation(self.KEY, self.translate)]
+        self.assertEqual(asyncio.run(main()), ['Eit hus.'] * 4)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(BaseHandler.stats.coalesced, 2)
+        self.assertEqual(TranslateHandler.results_inflight, {})
+
+        async def stats():
+            handler = make_handler(StatsHandler)
+            with mock.patch.object(handler, 'send_response') as send_response:
+                await handler.get()
+            return send_response.call_args[0][0]['responseData']['resultCache']
+        result_cache = asyncio.run(stats())
+        self.assertEqual((result_cache['hits'], result_cache['misses'], result_cache['coalesced'], result_cache['entries']),
+                         (1, 3, 2, 1))
+
+    def test_cancelled_only_when_all_requests_are(self):
+        async def main():
+            handler = make_handler(TranslateHandler)
+            waiting = [asyncio.ensure_future(handler.cached_translation(self.KEY, self.translate)) for _ in range(2)]
+            await asyncio.sleep(0)
+            translation = TranslateHandler.results_inflight[self.KEY][0]
+            waiting[0].cancel()
+            await asyncio.sleep(0)
+            self.assertFalse(translation.cancelled())
+            waiting[1].cancel()
+            await asyncio.wait([translation], timeout=1)
+            self.assertTrue(translation.cancelled())
+        asyncio.run(main())
+        self.assertIsNone(BaseHandler.result_cache.get(self.KEY))
+
+    def test_invalidated_while_translating(self):
+        async def main():
+            handler = make_handler(TranslateHandler)
+            translation = asyncio.ensure_future(handler.cached_translation(self.KEY, self.translate))
+            await asyncio.sleep(0)
+            TranslateHandler.invalidate_cached_translations(('nob', 'nno'))
+            return await translation
+        self.assertEqual(asyncio.run(main()), 'Eit hus.')
+        # It was translated by the pipeline we were told to forget about:
+        self.assertIsNone(BaseHandler.result_cache.get(self.KEY))
+        self.assertEqual(TranslateHandler.cache_generation, {('nob', 'nno'): 1})
+
+    def test_kept_over_idle_shutdown_but_not_restart(self):
+        BaseHandler.result_cache.put(self.KEY, 'Eit hus.')
+        handler = make_handler(TranslateHandler)
+        BaseHandler.pipelines[('nob', 'nno')] = [FakePipe()]  # type: ignore[list-item]
+        handler.clean_pairs()
+        self.assertEqual(BaseHandler.pipelines[('nob', 'nno')], [])
+        self.assertEqual(BaseHandler.result_cache.get(self.KEY), 'Eit hus.')
+        BaseHandler.pipelines[('nob', 'nno')] = [FakePipe(stuck=True)]  # type: ignore[list-item]
+        handler.clean_pairs()
+        self.assertIsNone(BaseHandler.result_cache.get(self.KEY))
+
+
+class TestHelperPipelines(TestCase):
+    PAIR = ('nob', 'nno')
+
+    def setUp(self):
+        self.patch = mock.patch.multiple(BaseHandler, pipelines={}, pair_versions={}, pair_pipe_limits={},
+                                         pipeline_cmds={self.PAIR: ParsedModes(True, [['cat']])},
+                                         min_pipes_per_pair=1, max_pipes_per_pair=3, scatter_spawn_chars=10000)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_large_requests_spread_out(self):
+        async def main():
+            handler = make_handler(TranslateHandler)
+            pipeline = handler.get_pipeline(self.PAIR)
+            self.assertEqual(handler.get_helper_pipelines(self.PAIR, pipeline, 100), [])
+            text = 'This is a sentence. ' * 1000
+            helpers = handler.get_helper_pipelines(self.PAIR, pipeline, len(text))
+            self.assertEqual(len(BaseHandler.pipelines[self.PAIR]), 3)
+            self.assertEqual(len(helpers), 2)
+            self.assertNotIn(pipeline, helpers)
+
+            self.assertEqual(await pipeline.translate(text, deformat=False, reformat=False, helpers=helpers), text)
+            for pipe in [pipeline] + helpers:
+                self.assertGreater(pipe.chars, 0)
+                self.assertEqual((pipe.users, pipe.use_count), (0, 1))
+
+            # Only working pipelines that can take chunks help:
+            helpers[0].stuck = True
+            BaseHandler.pipelines[self.PAIR].append(SimplePipeline([['cat']]))
+            self.assertEqual(handler.get_helper_pipelines(self.PAIR, pipeline, len(text)), helpers[1:])
+        asyncio.run(main())
+
+
+class TestWaitUntilReady(TestCase):
+    def wait_until_ready(self, finish_after=None, works=True):
+        """What wait_until_ready says, and the status it sent if any,
+        for set-up that finishes after finish_after secs (None: never)."""
+        async def main():
+            ready = asyncio.get_running_loop().create_future()
+            if finish_after is not None:
+                asyncio.get_running_loop().call_later(finish_after, ready.set_result, works)
+            handler = make_handler(IdentifyLangHandler)
+            with mock.patch.object(IdentifyLangHandler, 'ready', ready), \
+                    mock.patch.object(handler, 'send_error') as send_error:
+                ok = await handler.wait_until_ready()
+            return ok, send_error.call_args[0][0] if send_error.called else None
+
+        with mock.patch.object(BaseHandler, 'startup_wait_secs', 0.2):
+            return asyncio.run(main())
+
+    def test_waits_for_set_up(self):
+        self.assertEqual(self.wait_until_ready(finish_after=0), (True, None))
+        self.assertEqual(self.wait_until_ready(finish_after=0.05), (True, None))
+
+    def test_still_starting_up(self):
+        self.assertEqual(self.wait_until_ready(), (False, 503))
+
+    def test_failed_set_up(self):
+        self.assertEqual(self.wait_until_ready(finish_after=0, works=False), (False, 503))
+        self.assertEqual(self.wait_until_ready(finish_after=0.05, works=False), (False, 503))
+
+    def test_run_in_background_records_failure(self):
+        self.assertTrue(run_in_background('nothing', lambda: None))
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(run_in_background('wiki login', lambda: 1 / 0))
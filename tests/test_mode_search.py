@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from apertium_apy.mode_search import SearchIndex, search_path
+
+
+def touch(*parts):
+    open(os.path.join(*parts), 'w').close()
+
+
+class TestSearchIndex(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.index_dir, 'index.json')
+        for pkg in ['apertium-eng-spa', 'apertium-nob']:
+            os.makedirs(os.path.join(self.root, pkg, 'modes'))
+        touch(self.root, 'apertium-eng-spa', 'modes', 'en-es.mode')
+        touch(self.root, 'apertium-nob', 'modes', 'nob-morph.mode')
+        # Loops back to the root, which must not be searched again:
+        os.symlink(self.root, os.path.join(self.root, 'apertium-nob', 'loop'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.index_dir)
+
+    def search(self):
+        index = SearchIndex(self.index_path).load()
+        modes = search_path(self.root, index=index)
+        index.save()
+        self.assertEqual({mtype: sorted(found) for mtype, found in modes.items()},
+                         {mtype: sorted(found) for mtype, found in search_path(self.root).items()})
+        return index, modes
+
+    def test_lists_only_changed_directories(self):
+        index, modes = self.search()
+        self.assertEqual(len(modes['pair']), 1)
+        self.assertEqual(len(modes['analyzer']), 1)
+
+        index, modes = self.search()
+        self.assertEqual(index.relisted, 0)
+
+        touch(self.root, 'apertium-eng-spa', 'modes', 'es-en.mode')
+        index, modes = self.search()
+        self.assertEqual(index.relisted, 1)
+        self.assertEqual(len(modes['pair']), 2)
+
+        shutil.rmtree(os.path.join(self.root, 'apertium-nob'))
+        index, modes = self.search()
+        self.assertEqual(modes['analyzer'], [])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+from apertium_apy.utils.paths import PathIndex, parse_pair_weights
+
+GRAPH = {
+    'eng': ['spa', 'cat'],
+    'spa': ['cat', 'oci'],
+    'cat': ['oci'],
+}
+
+
+class TestPathIndex(TestCase):
+    def test_fewest_hops(self):
+        index = PathIndex(GRAPH)
+        self.assertEqual(len(index.path('eng', 'oci')), 3)
+        self.assertEqual(index.path('eng', 'cat'), ['eng', 'cat'])
+        self.assertEqual(set(index.paths_from('spa')), {'cat', 'oci'})
+        self.assertIsNone(index.path('oci', 'eng'))
+        self.assertEqual(index.paths_from('xxx'), {})
+
+    def test_configured_weights(self):
+        self.assertEqual(PathIndex(GRAPH, {('spa', 'oci'): 3}).path('eng', 'oci'), ['eng', 'cat', 'oci'])
+        self.assertEqual(PathIndex(GRAPH, {('cat', 'oci'): 3}).path('eng', 'oci'), ['eng', 'spa', 'oci'])
+
+    def test_avoids_slow_pairs(self):
+        index = PathIndex(GRAPH)
+        self.assertEqual(index.path('eng', 'cat'), ['eng', 'cat'])
+        index.set_rates({('eng', 'spa'): 1000, ('spa', 'cat'): 1000, ('eng', 'cat'): 100})
+        self.assertEqual(index.path('eng', 'cat'), ['eng', 'spa', 'cat'])
+
+    def test_parse_pair_weights(self):
+        self.assertEqual(parse_pair_weights('eng-spa=2, spa-cat=0.5'), {('eng', 'spa'): 2.0, ('spa', 'cat'): 0.5})
+        for bad in ['eng-spa', 'eng-spa=0', 'eng=1']:
+            with self.assertRaises(ValueError):
+                parse_pair_weights(bad)
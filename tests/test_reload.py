@@ -0,0 +1,111 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from apertium_apy.apy import reload_modes
+from apertium_apy.handlers import BaseHandler, SpellerHandler, TranslateHandler
+
+if False:
+    from typing import Any, Dict  # noqa: F401
+
+
+class FakePipeline(object):
+    def __init__(self, users=0):
+        self.users = users
+
+
+class TestReplaceModes(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.modes = {name: os.path.join(self.root, name + '.mode') for name in ['eng-spa', 'spa-eng', 'eng-cat']}
+        for path in self.modes.values():
+            open(path, 'w').close()
+        self.busy = FakePipeline(users=1)
+        patches = {kind: {} for kind in BaseHandler.mode_kinds if kind != 'pairs'}  # type: Dict[str, Any]
+        self.patch = mock.patch.multiple(BaseHandler, pairs=dict(self.modes), pipelines={
+            ('eng', 'spa'): [self.busy, FakePipeline()],
+            ('spa', 'eng'): [FakePipeline()],
+            ('eng', 'cat'): [FakePipeline()],
+        }, pipeline_cmds={}, pair_versions={}, pipelines_holding=[], pairs_graph={},
+            mode_pipelines={}, mode_versions={}, pairprefs={}, mode_search_paths=(self.root, None, None), **patches)
+        self.patch.start()
+        for pair in BaseHandler.pipelines:
+            BaseHandler.pipeline_cmds[pair] = 'cmds'
+            BaseHandler.pair_versions[pair] = os.path.getmtime(self.modes['%s-%s' % pair])
+
+    def tearDown(self):
+        self.patch.stop()
+        BaseHandler.init_mode_indexes()
+        BaseHandler.init_pairs_graph()
+        BaseHandler.init_paths()
+        shutil.rmtree(self.root)
+
+    def test_replaces_only_changed_pairs(self):
+        spa_eng = BaseHandler.pipelines[('spa', 'eng')]
+        os.utime(self.modes['eng-spa'], (0, 0))
+        found = {kind: {} for kind in BaseHandler.mode_kinds}
+        found['pairs'] = {'eng-spa': self.modes['eng-spa'], 'spa-eng': self.modes['spa-eng'], 'spa-cat': '/new'}
+        TranslateHandler.replace_modes(found, {})
+
+        self.assertEqual(set(BaseHandler.pipelines), {('spa', 'eng')})
+        self.assertIs(BaseHandler.pipelines[('spa', 'eng')], spa_eng)
+        self.assertEqual(set(BaseHandler.pipeline_cmds), {('spa', 'eng')})
+        # The busy pipeline finishes its requests before shutting down:
+        self.assertEqual(BaseHandler.pipelines_holding, [self.busy])
+        self.assertEqual(BaseHandler.path_index.path('eng', 'cat'), ['eng', 'spa', 'cat'])
+        self.assertNotIn('eng-cat', BaseHandler.pairs)
+        self.assertEqual(BaseHandler.mode_indexes['pairs'].resolve('es-ca'), 'spa-cat')
+
+    def test_replaces_changed_speller(self):
+        os.mkdir(os.path.join(self.root, 'modes'))
+        open(os.path.join(self.root, 'modes', 'nob-spell.mode'), 'w').close()
+        key = (self.root, 'nob-spell')
+        BaseHandler.mode_pipelines[key] = FakePipeline()  # type: ignore[assignment]
+        BaseHandler.mode_versions[key] = 0.0
+        SpellerHandler.suggestion_cache.put(key + (0.0, 'hus'), [])
+        found = {kind: {} for kind in BaseHandler.mode_kinds}
+        found['pairs'] = dict(self.modes)
+        found['spellers'] = {'nob': key}
+        TranslateHandler.replace_modes(found, {})
+
+        self.assertEqual(BaseHandler.mode_pipelines, {})
+        self.assertIsNone(SpellerHandler.suggestion_cache.get(key + (0.0, 'hus')))
+
+    def test_keeps_unchanged_tokeniser(self):
+        os.mkdir(os.path.join(self.root, 'modes'))
+        mode_file = os.path.join(self.root, 'modes', 'nob-tokenise.mode')
+        open(mode_file, 'w').close()
+        key = (self.root, 'nob-tokenise')
+        BaseHandler.mode_pipelines[key] = FakePipeline()  # type: ignore[assignment]
+        BaseHandler.mode_versions[key] = os.path.getmtime(mode_file)
+        SpellerHandler.suggestion_cache.put(key + (0.0, 'hus'), [])
+        found = {kind: {} for kind in BaseHandler.mode_kinds}
+        found['pairs'] = dict(self.modes)
+        TranslateHandler.replace_modes(found, {})
+
+        self.assertIn(key, BaseHandler.mode_pipelines)
+        self.assertEqual(SpellerHandler.suggestion_cache.get(key + (0.0, 'hus')), [])
+
+    def test_replaces_upgraded_bilingual_dictionary(self):
+        autobil = os.path.join(self.root, 'eng-spa.autobil.bin')
+        open(autobil, 'w').close()
+        key = (autobil, BaseHandler.bilingual_mode)
+        BaseHandler.mode_pipelines[key] = FakePipeline()  # type: ignore[assignment]
+        BaseHandler.mode_versions[key] = os.path.getmtime(autobil)
+        found = {kind: {} for kind in BaseHandler.mode_kinds}
+        found['pairs'] = dict(self.modes)
+        TranslateHandler.replace_modes(found, {})
+        self.assertIn(key, BaseHandler.mode_pipelines)
+
+        os.utime(autobil, (0, 0))
+        TranslateHandler.replace_modes(found, {})
+        self.assertEqual(BaseHandler.mode_pipelines, {})
+        self.assertEqual(BaseHandler.mode_versions, {})
+
+    def test_reload_modes(self):
+        open(os.path.join(self.root, 'spa-cat.mode'), 'w').close()
+        asyncio.run(reload_modes())
+        self.assertEqual(set(BaseHandler.pairs), {'eng-spa', 'spa-eng', 'eng-cat', 'spa-cat'})
+        self.assertIn(('spa', 'eng'), BaseHandler.pipelines)
@@ -0,0 +1,305 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipUnless
+
+from apertium_apy.utils.translation import (
+    FORMATTER_MAX_INFLIGHT, FairScheduler, FlushingPipeline, FormatterPipeline, ProcessFailureError, formatters,
+    get_formatter, hardbreak_fn, proc_resources, split_for_translation, split_segments, translate_chain,
+)
+
+
+class TestSplitForTranslation(TestCase):
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(list(split_for_translation('Hello world.', n_users=0)), ['Hello world.'])
+
+    def test_no_length_cap(self):
+        text = 'This is a sentence. ' * 10000
+        chunks = list(split_for_translation(text, n_users=0))
+        self.assertEqual(''.join(chunks), text)
+        self.assertGreater(len(chunks), 10)
+
+    def test_chunks_fit_hardbreak(self):
+        text = 'ordlista ' * 5000
+        for n_users in [0, 5]:
+            for chunk in split_for_translation(text, n_users):
+                self.assertLessEqual(len(chunk.encode('utf-8')), hardbreak_fn(n_users))
+
+    def test_prefers_sentence_breaks(self):
+        text = 'word ' * 600 + 'end. ' + 'word ' * 1000
+        first = next(split_for_translation(text, n_users=0))
+        self.assertTrue(first.endswith('end.'), first[-20:])
+
+    def test_breaks_cjk_and_danda(self):
+        for sentence in ['这是一个句子。', 'यह एक वाक्य है।', 'هل هذه جملة؟']:
+            text = sentence * 1000
+            chunks = list(split_for_translation(text, n_users=0))
+            self.assertEqual(''.join(chunks), text)
+            for chunk in chunks:
+                self.assertTrue(chunk.endswith(sentence[-1]), chunk[-10:])
+
+    def test_never_splits_characters(self):
+        text = 'æøå' * 5000
+        chunks = list(split_for_translation(text, n_users=0))
+        self.assertEqual(''.join(chunks), text)
+
+    def test_is_lazy(self):
+        chunks = split_for_translation('x ' * 100000, n_users=0)
+        self.assertEqual(len(next(chunks).encode('utf-8')), hardbreak_fn(0))
+
+    def test_chunks_sized_to_capacity(self):
+        text = 'ordlista ' * 100000
+        chunks = list(split_for_translation(text, n_users=0, capacity=1024 * 1024))
+        self.assertEqual(''.join(chunks), text)
+        self.assertLessEqual(max(len(chunk.encode('utf-8')) for chunk in chunks), 256 * 1024)
+        self.assertGreater(len(chunks[0].encode('utf-8')), hardbreak_fn(0))
+
+
+class TestSplitSegments(TestCase):
+    def test_adds_up_to_input(self):
+        for text in ['Hi there. Hi there.[<p>\n]Bye! ', 'One\n\nTwo. ', '[x]', '']:
+            self.assertEqual(''.join(blank + segment for blank, segment in split_segments(text)), text)
+
+    def test_splits_sentences(self):
+        self.assertEqual(split_segments('Hi there. Hi there.[<p>\n]Bye! '),
+                         [('', 'Hi there.'), (' ', 'Hi there.'), ('[<p>\n]', 'Bye!'), (' ', '')])
+
+    def test_not_at_escaped_or_inline(self):
+        self.assertEqual(split_segments('A\\. b[<b>]c'), [('', 'A\\. b[<b>]c')])
+
+
+@skipUnless(os.path.exists('/proc/self/statm'), 'no /proc')
+class TestProcResources(TestCase):
+    def test_own_process(self):
+        sample = proc_resources(os.getpid())
+        self.assertGreater(sample['rss'], 0)
+        self.assertGreaterEqual(sample['cpuSecs'], 0)
+
+    def test_missing_process(self):
+        self.assertIsNone(proc_resources(2 ** 22 + 1))
+
+
+class TestFairScheduler(TestCase):
+    def run_sends(self, sends, slots=1):
+        """Queue up (name, key, size) sends behind one that holds every
+        slot, and return the names in the order they get a slot."""
+        order = []
+
+        async def send(scheduler, name, key, size):
+            await scheduler.acquire(key, size)
+            order.append(name)
+            await asyncio.sleep(0)
+            scheduler.release()
+
+        async def main():
+            scheduler = FairScheduler(slots)
+            for _ in range(slots):
+                await scheduler.acquire('blocker', 1)
+            tasks = [asyncio.ensure_future(send(scheduler, *s)) for s in sends]
+            await asyncio.sleep(0)
+            for _ in range(slots):
+                scheduler.release()
+            await asyncio.gather(*tasks)
+            self.assertEqual(scheduler.free, slots)
+        asyncio.run(main())
+        return order
+
+    def test_first_come_first_served_alone(self):
+        self.assertEqual(self.run_sends([(i, 'doc', 1000) for i in range(5)]), list(range(5)))
+
+    def test_short_request_skips_document(self):
+        doc = [('doc%d' % i, 'doc', 4000) for i in range(20)]
+        order = self.run_sends(doc + [('short', None, 100)])
+        self.assertLess(order.index('short'), 2)
+
+    def test_documents_interleave(self):
+        order = self.run_sends([('a', 'a', 4000)] * 4 + [('b', 'b', 4000)] * 4)
+        self.assertEqual(order, ['a', 'b'] * 4)
+
+    def test_bytes_not_chunks(self):
+        # b sends chunks a quarter the size, so gets about four per a:
+        order = self.run_sends([('a', 'a', 4000)] * 3 + [('b', 'b', 1000)] * 8)
+        self.assertEqual(order[:6], ['a', 'b', 'b', 'b', 'b', 'a'])
+
+    def test_cancelled_waiter_is_dropped(self):
+        async def main():
+            scheduler = FairScheduler(1)
+            await scheduler.acquire('blocker', 1)
+            waiting = asyncio.ensure_future(scheduler.acquire('doc', 1000))
+            await asyncio.sleep(0)
+            waiting.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.waiting(), 0)
+            scheduler.release()
+            self.assertEqual(scheduler.free, 1)
+        asyncio.run(main())
+
+
+class TestFlushingPipeline(TestCase):
+    """Over cat, which flushes on NUL like the Apertium tools do with -z."""
+
+    def run_with_pipeline(self, test, max_inflight=1):
+        async def main():
+            return await test(FlushingPipeline(10, [['cat']], max_inflight))
+        return asyncio.run(main())
+
+    @staticmethod
+    def record_sends(pipeline):
+        sends = []
+        send = pipeline.send
+
+        def record_send(data, *args, **kwargs):
+            sends.append(data)
+            return send(data, *args, **kwargs)
+        pipeline.send = record_send
+        return sends
+
+    def test_concurrent_sends(self):
+        async def main():
+            # Like a pair that takes a while to load:
+            pipeline = FlushingPipeline(10, [['sh', '-c', 'sleep 0.2; exec cat']], 4)
+            sends = [asyncio.ensure_future(pipeline.send(bytes('text %d' % i, 'utf-8'), key=i % 2)) for i in range(10)]
+            await asyncio.sleep(0.05)
+            self.assertEqual((len(pipeline.inflight), pipeline.scheduler.waiting()), (4, 6))
+            outputs = await asyncio.gather(*sends)
+            self.assertEqual(outputs, [bytes('text %d\0\0' % i, 'utf-8') for i in range(10)])
+            self.assertEqual((len(pipeline.inflight), pipeline.scheduler.free, pipeline.reading), (0, 4, False))
+        asyncio.run(main())
+
+    def test_cancelled_mid_flight(self):
+        async def main():
+            pipeline = FlushingPipeline(10, [['sh', '-c', 'sleep 0.2; exec cat']], 2)
+            sends = [asyncio.ensure_future(pipeline.send(bytes('text %d' % i, 'utf-8'))) for i in range(4)]
+            await asyncio.sleep(0.05)
+            # One written and waiting for its output, one waiting for a slot:
+            sends[1].cancel()
+            sends[3].cancel()
+            self.assertEqual(await sends[0], b'text 0\0\0')
+            self.assertEqual(await sends[2], b'text 2\0\0')
+            for cancelled in [sends[1], sends[3]]:
+                self.assertTrue(cancelled.cancelled())
+            # The cancelled output was read and thrown away, so later sends still pair up:
+            self.assertEqual(await pipeline.send(b'text 4'), b'text 4\0\0')
+            self.assertEqual((len(pipeline.inflight), pipeline.scheduler.free, pipeline.scheduler.waiting()), (0, 2, 0))
+            self.assertFalse(pipeline.stuck)
+        asyncio.run(main())
+
+    def test_send_batched(self):
+        async def test(pipeline):
+            sends = self.record_sends(pipeline)
+            items = [b'a' * 3000, b'b', b'c' * 3000, b'd']
+            self.assertEqual(await pipeline.send_batched(items, '', object()), items)
+            self.assertEqual(sends, [b'a' * 3000 + b'\0b', b'c' * 3000 + b'\0d'])
+            with self.assertRaises(ProcessFailureError):
+                await pipeline.send_batched([b'e\0f', b'g'], '', object())
+        self.run_with_pipeline(test)
+
+    def test_translate_batch_splits_long_texts(self):
+        async def test(pipeline):
+            long_text = 'This is a sentence. ' * 1000
+            texts = ['Short.', long_text, 'Short.', 'Also short.']
+            sends = self.record_sends(pipeline)
+            self.assertEqual(await pipeline.translate_batch(texts, False, False), texts)
+            self.assertIn(b'Short.\0Short.\0Also short.', sends)
+            self.assertGreater(len(sends), 2)
+            self.assertLessEqual(max(map(len, sends)), hardbreak_fn(1))
+            self.assertEqual((pipeline.users, pipeline.use_count), (0, 1))
+        self.run_with_pipeline(test)
+
+    def test_translate_counts_one_use(self):
+        async def test(pipeline):
+            text = 'This is a sentence. ' * 1000
+            self.assertEqual(await pipeline.translate(text, deformat=False, reformat=False), text)
+            self.assertEqual((pipeline.users, pipeline.use_count), (0, 1))
+            self.assertIsNone(pipeline.busy_since)
+            self.assertGreater(pipeline.busy_time(), 0)
+            chunks = [chunk async for chunk in pipeline.translate_iter(text, False, False)]
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(''.join(chunks), text)
+            self.assertEqual((pipeline.users, pipeline.use_count), (0, 2))
+        self.run_with_pipeline(test)
+
+
+class TestFormatterPipeline(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.formatter = os.path.join(self.dir, 'fake-deformatter')
+        with open(self.formatter, 'w') as script:
+            # Escapes [ like the Apertium formatters do, nonces included:
+            script.write("#!/bin/sh\nexec sed -u -z 's/\\[/\\\\[/g'\n")
+        os.chmod(self.formatter, 0o755)
+
+    def tearDown(self):
+        formatters.pop(self.formatter, None)
+        shutil.rmtree(self.dir)
+
+    def test_output_per_block(self):
+        async def main():
+            pipeline = FormatterPipeline(10, self.formatter)
+            texts = [bytes('[%d] a\0[b]' % i, 'utf-8') for i in range(50)]
+            outputs = await asyncio.gather(*[pipeline.send(text) for text in texts])
+            self.assertEqual(outputs, [bytes('\\[%d] a\0\\[b]' % i, 'utf-8') for i in range(50)])
+            self.assertEqual((len(pipeline.inflight), pipeline.scheduler.free), (0, FORMATTER_MAX_INFLIGHT))
+        asyncio.run(main())
+
+    def test_one_process_per_formatter(self):
+        async def main():
+            pipeline = get_formatter(self.formatter, 10)
+            self.assertIs(get_formatter(self.formatter, 10), pipeline)
+            pipeline.stuck = True
+            self.assertIsNot(get_formatter(self.formatter, 10), pipeline)
+        asyncio.run(main())
+
+
+class TestTranslateChain(TestCase):
+    def test_keeps_order_and_formats_once(self):
+        calls = []
+
+        def deformat(text):
+            calls.append('deformat')
+            return text
+
+        def reformat(text):
+            calls.append('reformat')
+            return text
+
+        async def main():
+            pipelines = [FlushingPipeline(10, [['cat']], 4) for _ in range(3)]
+            text = ''.join('This is sentence number %d. ' % i for i in range(2000))
+            self.assertEqual(await translate_chain(text, pipelines, deformat, reformat), text)
+            chunks = len(list(split_for_translation(text, n_users=0)))
+            self.assertGreater(chunks, 1)
+            # Once per chunk, not once per chunk per pair:
+            self.assertEqual(calls, ['deformat'] * chunks + ['reformat'] * chunks)
+            self.assertEqual([p.users for p in pipelines], [0, 0, 0])
+        asyncio.run(main())
+
+    def test_nosplit_sends_one_chunk(self):
+        calls = []
+
+        def deformat(text):
+            calls.append('deformat')
+            return text
+
+        async def main():
+            pipelines = [FlushingPipeline(10, [['cat']], 4) for _ in range(2)]
+            text = 'This is a sentence. ' * 2000
+            self.assertEqual(await translate_chain(text, pipelines, deformat, False, nosplit=True), text)
+            self.assertEqual(calls, ['deformat'])
+        asyncio.run(main())
+
+    def test_failing_pair_cancels_the_rest(self):
+        async def main():
+            first = FlushingPipeline(10, [['cat']], 4)
+            # Never answers:
+            stuck = FlushingPipeline(0.2, [['sleep', '10']], 1)
+            text = 'This is a sentence. ' * 2000
+            with self.assertRaises(asyncio.TimeoutError):
+                await translate_chain(text, [first, stuck], False, False)
+            await asyncio.sleep(0)
+            self.assertTrue(stuck.stuck)
+            self.assertEqual((stuck.scheduler.waiting(), stuck.scheduler.free, len(stuck.inflight)), (0, 1, 0))
+            self.assertEqual((first.scheduler.waiting(), first.scheduler.free, len(first.inflight)), (0, 4, 0))
+            self.assertEqual((first.users, stuck.users), (0, 0))
+        asyncio.run(main())
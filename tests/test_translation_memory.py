@@ -0,0 +1,63 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+
+from apertium_apy.translation_memory import TieredSegmentCache, TranslationMemory
+from apertium_apy.utils.cache import LRUCache
+
+
+class TestTranslationMemory(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'tm.db')
+        self.memory = TranslationMemory(self.path)
+
+    def tearDown(self):
+        self.memory.close_db()
+        self.dir.cleanup()
+
+    def test_shared_after_commit(self):
+        self.memory.put('eng-spa', 1.0, ('', 'Hello.'), 'Hola.')
+        other = TranslationMemory(self.path)
+        self.assertEqual(other.get_many('eng-spa', 1.0, [('', 'Hello.')]), {})
+        self.memory.commit()
+        self.assertEqual(other.get_many('eng-spa', 1.0, [('', 'Hello.'), ('', 'Bye.')]),
+                         {('', 'Hello.'): 'Hola.'})
+        other.close_db()
+
+    def test_versions(self):
+        self.memory.put('eng-spa', 1.0, ('', 'Hello.'), 'Hola.')
+        self.memory.put('eng-cat', 1.0, ('', 'Hello.'), 'Hola.')
+        self.memory.commit()
+        self.assertEqual(self.memory.get_many('eng-spa', 2.0, [('', 'Hello.')]), {})
+        self.memory.forget_other_versions({'eng-spa': 2.0, 'eng-cat': 1.0})
+        self.memory.put('eng-spa', 2.0, ('', 'Hi.'), 'Hola.')
+        self.memory.commit()
+        self.assertEqual(self.memory.get_many('eng-spa', 1.0, [('', 'Hello.')]), {})
+        self.assertEqual(len(self.memory.get_many('eng-cat', 1.0, [('', 'Hello.')])), 1)
+
+    def test_tiered(self):
+        self.memory.put('eng-spa', 1.0, ('', 'Hello.'), 'Hola.')
+        cache = LRUCache(10)
+        tiered = TieredSegmentCache(cache, self.memory, 'eng-spa', 1.0)
+        self.assertEqual(asyncio.run(tiered.get_many([('', 'Hello.')])), {('', 'Hello.'): 'Hola.'})
+        self.assertIn(('', 'Hello.'), cache)
+        tiered.put(('', 'Bye.'), 'Adiós.')
+        self.assertEqual(self.memory.get_many('eng-spa', 1.0, [('', 'Bye.')]), {('', 'Bye.'): 'Adiós.'})
+
+    def test_commit_in_background(self):
+        async def main():
+            self.memory.max_pending = 2
+            self.memory.put('eng-spa', 1.0, ('', 'Hello.'), 'Hola.')
+            self.assertFalse(self.memory.commit_queued)
+            self.memory.put('eng-spa', 1.0, ('', 'Bye.'), 'Adiós.')
+            # Still readable while the commit is on its way:
+            self.assertEqual(len(self.memory.get_many('eng-spa', 1.0, [('', 'Hello.'), ('', 'Bye.')])), 2)
+            while self.memory.commit_queued or self.memory.committing:
+                await asyncio.sleep(0.01)
+        asyncio.run(main())
+        self.assertEqual(self.memory.pending, {})
+        other = TranslationMemory(self.path)
+        self.assertEqual(len(other.get_many('eng-spa', 1.0, [('', 'Hello.'), ('', 'Bye.')])), 2)
+        other.close_db()
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from apertium_apy.utils import ModeIndex, to_alpha3_code
+
+
+class TestModeIndex(TestCase):
+    index = ModeIndex({'eng-spa': None, 'spa-eng_US': None, 'nob': None, 'sme-nob': None})
+
+    def test_spellings(self):
+        for code in ['eng-spa', 'en-es', 'eng-es', 'en-spa']:
+            self.assertEqual(self.index.resolve(code), 'eng-spa')
+        self.assertEqual(self.index.resolve('se-nb'), 'sme-nob')
+        self.assertEqual(self.index.resolve('es-en_US'), 'spa-eng_US')
+        self.assertEqual(self.index.resolve('nb'), 'nob')
+
+    def test_falls_back_from_variants(self):
+        self.assertEqual(self.index.resolve('en_GB-es'), 'eng-spa')
+        self.assertEqual(self.index.resolve('nob_x_y'), 'nob')
+
+    def test_not_installed(self):
+        self.assertEqual(self.index.resolve('en-fr'), 'eng-fra')
+        self.assertEqual(self.index.resolve('xyz'), 'xyz')
+
+    def test_ambiguous_alpha2(self):
+        for modes in [['fas-eng', 'pes-eng', 'aze', 'azb'], ['pes-eng', 'fas-eng', 'azb', 'aze']]:
+            index = ModeIndex(dict.fromkeys(modes))
+            self.assertEqual(index.resolve('fa-en'), 'pes-eng')
+            self.assertEqual(index.resolve('fas-en'), 'fas-eng')
+            self.assertEqual(index.resolve('az'), 'azb')
+
+    def test_to_alpha3_code(self):
+        self.assertEqual(to_alpha3_code('en_US'), 'eng_US')
+        self.assertEqual(to_alpha3_code('eng'), 'eng')
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Warm up a server's translation memory by replaying the /translate
+requests found in access logs (APY's own tornado.access log lines, or
+nginx/Apache ones), most frequent first.
+
+Start APY with --translation-memory, then e.g.
+
+    tools/replay-log.py http://localhost:2737 /var/log/apy/apy.log
+
+Each distinct request is only sent once.
+"""
+
+import argparse
+import re
+import sys
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+translate_re = re.compile(r'\bGET (/translate\?[^\s"]+)')
+
+
+def read_requests(paths):
+    counts = Counter()  # type: Counter
+    for path in paths:
+        with open(path, errors='replace') as log:
+            for line in log:
+                m = translate_re.search(line)
+                if m:
+                    counts[m.group(1)] += 1
+    return counts
+
+
+def replay(server, path, timeout):
+    try:
+        with urllib.request.urlopen(server.rstrip('/') + path, timeout=timeout) as response:
+            response.read()
+        return True
+    except OSError as e:
+        print('{}: {}'.format(path[:80], e), file=sys.stderr)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('server', help='base url of the APY server, e.g. http://localhost:2737')
+    parser.add_argument('logs', nargs='+', help='access log files')
+    parser.add_argument('-n', '--top', type=int, default=0, help='only replay this many of the most frequent requests')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='how many requests to send at once (default = 4)')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='seconds to wait for each request (default = 60)')
+    args = parser.parse_args()
+
+    counts = read_requests(args.logs)
+    paths = [path for path, _ in counts.most_common(args.top or None)]
+    print('Replaying {} distinct requests …'.format(len(paths)), file=sys.stderr)
+    with ThreadPoolExecutor(args.jobs) as executor:
+        ok = sum(executor.map(lambda path: replay(args.server, path, args.timeout), paths))
+    print('{} ok, {} failed'.format(ok, len(paths) - ok), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()